@@ -14,6 +14,7 @@ import sys
 from contextlib import contextmanager
 import pathlib
 import logging
+import threading
 from typing import Dict, List, Tuple
 
 import numpy as np
@@ -21,28 +22,41 @@ import tensorflow as tf
 from tensorflow.data import Dataset
 from tensorflow.compat.v1 import logging as tf_logging
 
-from sklearn.model_selection import train_test_split
 import joblib
 
-from finetune.util import list_transpose
 from finetune.encoding.input_encoder import EncodedOutput
-from finetune.config import all_gpus, assert_valid_config, get_default_config
+from finetune.config import all_gpus, assert_valid_config, get_config, get_default_config
 from finetune.saver import Saver, InitializeHook
 from finetune.errors import FinetuneError
 from finetune.model import get_model_fn, PredictMode
 from finetune.util.download import download_data_if_required
 from finetune.util.shapes import shape_list
+from finetune.util.text_generation import kv_cached_generate
 from finetune.util.timing import ProgressBar
 from finetune.util.in_memory_finetune import make_in_memory_finetune_hooks
 from finetune.util.indico_estimator import IndicoEstimator
 from finetune.util.gpu_info import gpu_info
 
 from finetune.base_models.bert.model import _BaseBert
-from finetune.base_models import GPTModel, GPTModelSmall
+from finetune.base_models import (
+    GPTModel,
+    GPTModelSmall,
+    GPT2Model,
+    GPT2Model345,
+    GPT2Model762,
+    GPT2Model1558,
+)
 from finetune.input_pipeline import InputMode
+from finetune.util.input_utils import pad_batch, example_length
+from finetune.util.weight_file import write_weight_file
+from finetune.util.grid_search import grid_search
+from finetune.serving import EXPORTED_MODEL_FILE, SAVED_MODEL_DIR, SERVING_SIGNATURE
 
 LOGGER = logging.getLogger("finetune")
 
+# Base models whose featurizers support int8_predict.
+INT8_BASE_MODELS = (_BaseBert, GPT2Model, GPT2Model345, GPT2Model762, GPT2Model1558)
+
 def issubclass_or_instance(a, b):
     try:
         return issubclass(a, b)
@@ -50,6 +64,15 @@ def issubclass_or_instance(a, b):
         return isinstance(a, b)
 
 
+def _best_config(results):
+    scored = [result for result in results if result[1] is not None]
+    if not scored:
+        raise FinetuneError(
+            "No config was scored on every split, increase halving_eta or reduce halving_rounds."
+        )
+    return max(scored, key=lambda x: x[1])[0]
+
+
 def start_end_gen(gen):
     """
     yields from generator along with booleans for start and end.
@@ -69,6 +92,12 @@ class BaseModel(object, metaclass=ABCMeta):
     """
 
     defaults = dict()
+    # Keys of the featurizer state read by the target model during training. Models that set this can train
+    # from cached featurizer outputs, see the `cache_featurizer_outputs` option.
+    _cached_featurizer_keys = None
+    # Models whose _predict decodes the output of process_long_sequence, forwarding its keyword arguments to it.
+    # predict_iter decodes these one document at a time as soon as inference over that document is done.
+    _streaming_predict = False
 
     def __init__(self, **kwargs):
         """
@@ -146,12 +175,19 @@ class BaseModel(object, metaclass=ABCMeta):
 
         overrides = config.base_model.get_optimal_params(config)
         for ak in auto_keys:
-            if ak in ["val_size", "use_gpu_crf_predict"]:
+            if ak in ["val_size", "use_gpu_crf_predict", "predict_max_tokens"]:
                 continue  # this auto is resolved after data is provided.
             if ak not in overrides:
                 raise ValueError("There is no auto setting for {}".format(ak))
             config[ak] = overrides[ak]
 
+        if config.int8_predict:
+            if not issubclass_or_instance(config.base_model, INT8_BASE_MODELS):
+                LOGGER.warning("int8_predict is only supported by bert based and GPT2 models")
+                config.int8_predict = False
+            else:
+                config.float_16_predict = False
+
         if hasattr(self, "input_pipeline"):
             self.input_pipeline.config = config
 
@@ -186,6 +222,10 @@ class BaseModel(object, metaclass=ABCMeta):
         # state for prediction caching
         self._cached_predict = False
         self._cached_estimator = None
+        self._generation_graphs = {}
+        # Runs inference in place of the estimator, eg. an exported graph, see finetune.serving.ExportedModel.
+        self._inference_backend = None
+        self._inference_overrides = threading.local()
 
         try:
             self.estimator_dir = os.path.abspath(
@@ -205,6 +245,8 @@ class BaseModel(object, metaclass=ABCMeta):
             fallback_filename=self.config.base_model_path,
             exclude_matches=None if self.config.save_adam_vars else "OptimizeLoss",
             save_dtype=self.config.save_dtype,
+            save_format=self.config.save_format,
+            save_sparse_deltas=self.config.save_sparse_deltas,
             permit_uninitialized=self.config.permit_uninitialized,
             add_tokens=getattr(self.config.base_model, "_add_tokens", None),
         )
@@ -216,6 +258,8 @@ class BaseModel(object, metaclass=ABCMeta):
             fallback_filename=checkpoint_path,
             exclude_matches=None if self.config.save_adam_vars else "OptimizeLoss",
             save_dtype=self.config.save_dtype,
+            save_format=self.config.save_format,
+            save_sparse_deltas=self.config.save_sparse_deltas,
             restart_global_step=False,
         )
 
@@ -249,8 +293,111 @@ class BaseModel(object, metaclass=ABCMeta):
         steps = int(math.ceil(n_examples / (batch_size * n_gpus)))
         return steps
 
+    def _use_cached_featurizer(self, generator_input, has_targets):
+        if not self.config.cache_featurizer_outputs:
+            return False
+        reasons = []
+        if self.config.num_layers_trained != 0 or self.config.train_embeddings:
+            reasons.append("the featurizer is trained, set num_layers_trained=0 and train_embeddings=False")
+        if self._cached_featurizer_keys is None:
+            reasons.append("{} does not support it".format(type(self).__name__))
+        if generator_input:
+            reasons.append("training data is provided as a generator")
+        if not has_targets or self.config.lm_loss_coef > 0.0:
+            reasons.append("a language model is trained")
+        if reasons:
+            LOGGER.warning(
+                "Not caching featurizer outputs as {}.".format(", ".join(reasons))
+            )
+            return False
+        return True
+
+    def _new_featurizer_cache(self):
+        """
+        Starts a fresh directory for the memory mapped featurizer outputs of a fit, deleting the outputs
+        cached by any previous fit of this model.
+        """
+        if getattr(self, "_featurizer_cache_dir", None) is not None:
+            self._featurizer_cache_dir.cleanup()
+        self._featurizer_cache_dir = tempfile.TemporaryDirectory(prefix="finetune-features-")
+
+    def _featurize_examples(self, examples):
+        """
+        Runs the frozen featurizer once over tokenized examples and adds its outputs to each example as
+        cached_features and / or cached_sequence_features. Outputs are stored in memory mapped files so
+        that datasets larger than RAM can be cached.
+        """
+        if not examples:
+            return examples
+        with_targets = isinstance(examples[0], tuple)
+        features = [ex[0] if with_targets else ex for ex in examples]
+        types = self.input_pipeline.feed_shape_type_def()[0][0]
+        batch_size = self.config.predict_batch_size
+
+        def batches():
+            for i in range(0, len(features), batch_size):
+                yield pad_batch(features[i : i + batch_size], types)
+
+        if getattr(self, "_featurizer_cache_dir", None) is None:
+            self._new_featurizer_cache()
+
+        def cache_path(name):
+            fd, path = tempfile.mkstemp(prefix=name + "-", suffix=".npy", dir=self._featurizer_cache_dir.name)
+            os.close(fd)
+            return path
+
+        n_embed = self.config.n_embed
+        lengths = [int(example_length(f)) for f in features]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        pooled = sequence = None
+        predict_keys = []
+        if "features" in self._cached_featurizer_keys:
+            predict_keys.append(PredictMode.FEATURIZE)
+            pooled = np.lib.format.open_memmap(
+                cache_path("features"), mode="w+", dtype=np.float32, shape=(len(features), n_embed)
+            )
+        if "sequence_features" in self._cached_featurizer_keys:
+            predict_keys.append(PredictMode.SEQUENCE)
+            sequence = np.lib.format.open_memmap(
+                cache_path("sequence_features"), mode="w+", dtype=np.float32, shape=(int(offsets[-1]), n_embed)
+            )
+
+        estimator, hooks = self.get_estimator()
+        try:
+            outputs = estimator.cached_predict(
+                features=batches(),
+                feature_spec=self.input_pipeline.predict_feature_spec(),
+                predict_keys=predict_keys,
+                hooks=hooks,
+            )
+            for i, output in enumerate(
+                ProgressBar(outputs, total=len(features), desc="Caching features")
+            ):
+                if pooled is not None:
+                    pooled[i] = output[PredictMode.FEATURIZE]
+                if sequence is not None:
+                    sequence[offsets[i] : offsets[i + 1]] = output[PredictMode.SEQUENCE][: lengths[i]]
+        finally:
+            estimator.close_predict()
+
+        cached_examples = []
+        for i, (example, feats) in enumerate(zip(examples, features)):
+            feats = dict(feats)
+            if pooled is not None:
+                feats["cached_features"] = pooled[i]
+            if sequence is not None:
+                feats["cached_sequence_features"] = sequence[offsets[i] : offsets[i + 1]]
+            cached_examples.append((feats, example[1]) if with_targets else feats)
+        return cached_examples
+
     def finetune(self, Xs, Y=None, context=None, update_hook=None, log_hooks=None):
+        # predict_recompute_factor only applies to inference, models are trained on the usual chunks.
+        with self.input_pipeline.training_chunks():
+            self._finetune(Xs, Y=Y, context=context, update_hook=update_hook, log_hooks=log_hooks)
+
+    def _finetune(self, Xs, Y=None, context=None, update_hook=None, log_hooks=None):
         if callable(Xs):
+            self._use_cached_featurizer(generator_input=True, has_targets=Y is not None)
             datasets = self.input_pipeline.get_dataset_from_generator(
                 Xs, input_mode=InputMode.TRAIN, update_hook=update_hook
             )
@@ -258,8 +405,15 @@ class BaseModel(object, metaclass=ABCMeta):
             zipped_data_list = self.input_pipeline.zip_list_to_dict(
                 X=Xs, Y=Y, context=context
             )
+            featurize_fn = None
+            if self._use_cached_featurizer(generator_input=False, has_targets=Y is not None):
+                self._new_featurizer_cache()
+                featurize_fn = self._featurize_examples
             datasets = self.input_pipeline.get_dataset_from_list(
-                zipped_data_list, input_mode=InputMode.TRAIN, update_hook=update_hook
+                zipped_data_list,
+                input_mode=InputMode.TRAIN,
+                update_hook=update_hook,
+                featurize_fn=featurize_fn,
             )
 
         if self.config.keep_best_model:
@@ -274,11 +428,20 @@ class BaseModel(object, metaclass=ABCMeta):
         estimator, hooks = self.get_estimator(force_build_lm=force_build_lm)
         train_hooks = hooks.copy()
 
-        steps_per_epoch = self._n_steps(
-            n_examples=self.input_pipeline.dataset_size,
-            batch_size=self.config.batch_size,
-            n_gpus=max(1, len(self.resolved_gpus)),
-        )
+        n_gpus = max(1, len(self.resolved_gpus))
+        if self.input_pipeline.train_batches_per_epoch is not None:
+            # Length bucketed batches are not a fixed size, the pipeline counts them for us.
+            steps_per_epoch = int(
+                math.ceil(self.input_pipeline.train_batches_per_epoch / n_gpus)
+            )
+            val_steps = self.input_pipeline.val_batches
+        else:
+            steps_per_epoch = self._n_steps(
+                n_examples=self.input_pipeline.dataset_size,
+                batch_size=self.config.batch_size,
+                n_gpus=n_gpus,
+            )
+            val_steps = math.ceil(self.config.val_size / self.config.batch_size)
         num_steps = steps_per_epoch * self.config.n_epochs
         if self.config.val_size > 0:
             # Validation with all other tasks.
@@ -287,7 +450,7 @@ class BaseModel(object, metaclass=ABCMeta):
                     estimator,
                     datasets["val_dataset"],
                     every_n_iter=self.config.val_interval,
-                    steps=math.ceil(self.config.val_size / self.config.batch_size),
+                    steps=val_steps,
                 )
             )
             early_stopping_interval = self.config.val_interval
@@ -385,37 +548,44 @@ class BaseModel(object, metaclass=ABCMeta):
         )
         return config
 
+    def _get_model_fn(self, force_build_lm=False, build_explain=False):
+        build_lm = force_build_lm or self.config.lm_loss_coef > 0.0
+        return get_model_fn(
+            target_model_fn=self._target_model,
+            pre_target_model_hook=self._pre_target_model_hook,
+            predict_op=self._predict_op,
+            predict_proba_op=self._predict_proba_op,
+            build_target_model=self.input_pipeline.target_dim is not None,
+            lm_type=self.config.lm_type if build_lm else None,
+            encoder=self.input_pipeline.text_encoder,
+            target_dim=self.input_pipeline.target_dim,
+            label_encoder=self.input_pipeline.label_encoder,
+            build_explain=build_explain,
+            n_replicas=max(1, len(self.resolved_gpus)),
+            fp16_predict=self.config.float_16_predict,
+            mixed_precision=self.config.mixed_precision,
+            int8_predict=self.config.int8_predict,
+        )
+
+    def _build_estimator(self, force_build_lm=False, build_explain=False):
+        config = self._get_estimator_config()
+        model_fn = self._get_model_fn(force_build_lm=force_build_lm, build_explain=build_explain)
+        est = IndicoEstimator(
+            model_dir=self.estimator_dir,
+            model_fn=model_fn,
+            config=config,
+            params=self.config,
+        )
+        return est, [InitializeHook(self.saver)]
+
     def get_estimator(self, force_build_lm=False, build_explain=False, cache=False):
         if self._cached_estimator is not None:
             est = self._cached_estimator
             hooks = []
         else:
-            build_lm = force_build_lm or self.config.lm_loss_coef > 0.0
-            config = self._get_estimator_config()
-
-            model_fn = get_model_fn(
-                target_model_fn=self._target_model,
-                pre_target_model_hook=self._pre_target_model_hook,
-                predict_op=self._predict_op,
-                predict_proba_op=self._predict_proba_op,
-                build_target_model=self.input_pipeline.target_dim is not None,
-                lm_type=self.config.lm_type if build_lm else None,
-                encoder=self.input_pipeline.text_encoder,
-                target_dim=self.input_pipeline.target_dim,
-                label_encoder=self.input_pipeline.label_encoder,
-                build_explain=build_explain,
-                n_replicas=max(1, len(self.resolved_gpus)),
-                fp16_predict=self.config.float_16_predict,
-                mixed_precision=self.config.mixed_precision,
+            est, hooks = self._build_estimator(
+                force_build_lm=force_build_lm, build_explain=build_explain
             )
-            est = IndicoEstimator(
-                model_dir=self.estimator_dir,
-                model_fn=model_fn,
-                config=config,
-                params=self.config,
-            )
-
-            hooks = [InitializeHook(self.saver)]
 
         if cache:
             self._cached_estimator = est
@@ -427,11 +597,17 @@ class BaseModel(object, metaclass=ABCMeta):
             self._cached_estimator.close_predict()
             self._cached_estimator = None
             gc.collect()
+        if getattr(self, "_generation_graphs", None):
+            for session, _, _ in self._generation_graphs.values():
+                session.close()
+            self._generation_graphs = {}
+            gc.collect()
 
     @contextmanager
     def cached_predict(self):
         """
         Context manager that prevents the recreation of the tensorflow graph on every call to BaseModel.predict().
+        Generation graphs built by BaseModel.generate_texts() are also kept until the context exits.
         """
         self._cached_predict = True
         yield self
@@ -460,6 +636,105 @@ class BaseModel(object, metaclass=ABCMeta):
         invert_idxs[sorted_idxs] = np.arange(sorted_idxs.shape[0])
         return sorted_text, invert_idxs
 
+    def _probe_predict_throughput(self, max_batch_size, max_cpu_batch_size, n_batches=4):
+        """
+        Yields (batch_size, tokens per second) for batches of full length sequences, doubling the batch
+        size from 1 up to max_batch_size, or max_cpu_batch_size when no GPU is available. Every size runs
+        through one estimator so the graph is built and the weights are loaded only once. The first batch
+        of each size is not timed.
+        """
+        types, shapes = self.input_pipeline.feed_shape_type_def()
+        types, shapes = types[0], shapes[0]
+        example = {
+            k: np.zeros(
+                [self.config.max_length if d is None else d for d in shapes[k].as_list()],
+                dtype=types[k].as_numpy_dtype,
+            )
+            for k in types
+        }
+        # Always a fresh estimator, a cached one has already been initialized and comes without hooks.
+        estimator, hooks = self._build_estimator()
+        if not self.resolved_gpus:
+            max_batch_size = min(max_batch_size, max_cpu_batch_size)
+        batch_sizes = [2 ** i for i in range(int(math.log2(max_batch_size)) + 1)]
+
+        def batches():
+            for batch_size in batch_sizes:
+                batch = pad_batch([example] * batch_size, types)
+                for _ in range(n_batches):
+                    yield batch
+
+        try:
+            predictions = estimator.cached_predict(
+                features=batches(),
+                feature_spec=self.input_pipeline.predict_feature_spec(),
+                hooks=hooks,
+                yield_single_examples=False,
+            )
+            for batch_size in batch_sizes:
+                next(predictions)
+                start = time.time()
+                for _ in range(n_batches - 1):
+                    next(predictions)
+                tokens = batch_size * self.config.max_length * (n_batches - 1)
+                yield batch_size, tokens / (time.time() - start)
+        finally:
+            estimator.close_predict()
+
+    def _calibrate_predict_max_tokens(
+        self, max_probe_batch_size=256, max_cpu_probe_batch_size=8, min_speedup=1.1
+    ):
+        """
+        Resolves predict_max_tokens="auto" by doubling the batch size of full length sequences until
+        the model runs out of memory or throughput stops improving. The result is stored in the
+        config so the probe only ever runs once per model, including after save and load.
+        """
+        best_batch_size = 1
+        best_throughput = None
+        probe = self._probe_predict_throughput(max_probe_batch_size, max_cpu_probe_batch_size)
+        try:
+            for batch_size, throughput in probe:
+                LOGGER.info(
+                    "Predict batch size {} ran at {:.0f} tokens / second".format(batch_size, throughput)
+                )
+                if best_throughput is not None and throughput < best_throughput * min_speedup:
+                    break
+                best_batch_size, best_throughput = batch_size, throughput
+        except tf.errors.ResourceExhaustedError:
+            pass
+        finally:
+            probe.close()
+
+        self.config.predict_max_tokens = best_batch_size * self.config.max_length
+        LOGGER.info("Setting predict_max_tokens to {}".format(self.config.predict_max_tokens))
+
+    @contextmanager
+    def inference_override(self, inference_fn):
+        """
+        Context manager that routes inference run by the current thread through inference_fn, a callable with the
+        signature of BaseModel._inference, eg. to serve several models from one graph. Other threads using the
+        model are not affected. Overrides nest, the innermost one is used.
+        """
+        overrides = getattr(self._inference_overrides, "stack", None)
+        if overrides is None:
+            overrides = self._inference_overrides.stack = []
+        overrides.append(inference_fn)
+        try:
+            yield self
+        finally:
+            overrides.pop()
+
+    def _current_inference(self):
+        """
+        The function that _inference currently dispatches to for this thread.
+        """
+        overrides = getattr(self._inference_overrides, "stack", None)
+        if overrides:
+            return overrides[-1]
+        if self._inference_backend is not None:
+            return self._inference_backend
+        return self._estimator_inference
+
     def _inference(
         self,
         zipped_data,
@@ -469,13 +744,30 @@ class BaseModel(object, metaclass=ABCMeta):
         chunked_length=None,
         list_output=True,
     ):
+        return self._current_inference()(
+            zipped_data,
+            predict_keys=predict_keys,
+            context=context,
+            update_hook=update_hook,
+            chunked_length=chunked_length,
+            list_output=list_output,
+        )
+
+    def _estimator_inference(
+        self,
+        zipped_data,
+        predict_keys=None,
+        context=None,
+        update_hook=None,
+        chunked_length=None,
+        list_output=True,
+    ):
+        if self.config.predict_max_tokens == "auto":
+            self._calibrate_predict_max_tokens()
+
         def get_zipped_data():
             return iter(zipped_data)
 
-        input_fn = self.input_pipeline.get_dataset_from_generator(
-            get_zipped_data, input_mode=InputMode.PREDICT, update_hook=update_hook
-        )["predict_dataset"]
-
         estimator, hooks = self.get_estimator(
             build_explain=PredictMode.EXPLAIN in predict_keys,
             cache=self._cached_predict,
@@ -493,10 +785,17 @@ class BaseModel(object, metaclass=ABCMeta):
                 }
                 | set(predict_keys or {})
             )
+            # Numpy batches are fed straight into the cached graph, skipping tf.data entirely.
             prediction_iterator = estimator.cached_predict(
-                input_fn=input_fn, predict_keys=required_predict_keys, hooks=hooks
+                features=self.input_pipeline.get_predict_batches(get_zipped_data),
+                feature_spec=self.input_pipeline.predict_feature_spec(),
+                predict_keys=required_predict_keys,
+                hooks=hooks,
             )
         else:
+            input_fn = self.input_pipeline.get_dataset_from_generator(
+                get_zipped_data, input_mode=InputMode.PREDICT, update_hook=update_hook
+            )["predict_dataset"]
             prediction_iterator = estimator.predict(
                 input_fn=input_fn, predict_keys=predict_keys, hooks=hooks
             )
@@ -538,6 +837,77 @@ class BaseModel(object, metaclass=ABCMeta):
 
         return outputs
 
+    def predict_iter(self, Xs, context=None, window_size=1000, **kwargs):
+        """
+        Streaming version of predict. Consumes a (possibly lazy) iterable of documents and yields
+        one prediction per document, in order, without ever holding more than window_size
+        documents in memory. Documents are only sorted by length within a window, and each
+        prediction is yielded as soon as it and every document before it have been decoded.
+
+        The graph is cached for the duration of the stream as in :meth:`cached_predict`.
+
+        :param Xs: An iterable of documents in the format accepted by predict.
+        :param context: An optional iterable of context, one per document.
+        :param window_size: Maximum number of documents read from Xs at a time.
+        :param kwargs: Passed through to predict.
+        """
+        Xs = iter(Xs)
+        context = iter(context) if context is not None else None
+        already_cached = self._cached_predict
+        self._cached_predict = True
+        try:
+            while True:
+                window = list(itertools.islice(Xs, window_size))
+                if not window:
+                    break
+                window_context = None
+                if context is not None:
+                    window_context = list(itertools.islice(context, len(window)))
+                yield from self._predict_window_iter(window, window_context, **kwargs)
+        finally:
+            # Runs when the stream is exhausted or the consumer stops iterating early.
+            if not already_cached:
+                self._cached_predict = False
+                self.close()
+
+    def _predict_window_iter(self, Xs, context=None, **kwargs):
+        """
+        Yields the predictions for one window of predict_iter in input order. For models with _streaming_predict,
+        inference runs lazily over the whole window while documents are decoded one at a time as their last chunk
+        comes out of process_long_sequence, and a reorder buffer undoes the sort by length. Other models predict
+        the window in a single call.
+        """
+        if not self._streaming_predict:
+            yield from self.predict(Xs, context=context, **kwargs)
+            return
+
+        zipped_data = self.input_pipeline.zip_list_to_dict(X=Xs, context=context)
+        order = np.arange(len(zipped_data))
+        if self.config.sort_by_length:
+            zipped_data, invert_idxs = self._sort_by_length(zipped_data)
+            order = np.argsort(invert_idxs)
+
+        window_chunks = self.process_long_sequence(zipped_data)
+        pending = {}
+        next_idx = 0
+        for i, data in enumerate(zipped_data):
+            (pending[order[i]],) = self._predict(
+                [data], chunks=self._doc_chunks(window_chunks), **kwargs
+            )
+            while next_idx in pending:
+                yield pending.pop(next_idx)
+                next_idx += 1
+
+    @staticmethod
+    def _doc_chunks(chunks):
+        """
+        Takes the chunks of the next document from a process_long_sequence generator.
+        """
+        for chunk in chunks:
+            yield chunk
+            if chunk[3]:
+                return
+
     def _predict_proba(self, zipped_data, **kwargs):
         """
         Produce raw numeric outputs for proba predictions
@@ -657,16 +1027,111 @@ class BaseModel(object, metaclass=ABCMeta):
             if class_name != self.config.pad_token
         ]
 
-    def generate_text(self, seed_text="", max_length=None, use_extra_toks=None):
+    def generate_text(
+        self,
+        seed_text="",
+        max_length=None,
+        use_extra_toks=None,
+        temperature=None,
+        top_k=0,
+        beam_size=1,
+        beam_alpha=0.0,
+    ):
         """
         Performs a prediction on the Language modeling objective given some seed text. It uses a noisy greedy decoding.
-        Temperature parameter for decoding is set in the config.
+        For base models with an incremental featurizer (GPT2), attention keys and values are cached between
+        decoding steps so that each step only runs the featurizer over the newest token.
         :param max_length: The maximum length to decode to.
         :param seed_text: Defaults to the empty string. This will form the starting point to begin modelling
+        :param temperature: Sampling temperature, 0.0 for greedy decoding. Defaults to config.lm_temp.
+        :param top_k: If > 0, only sample from the top_k most likely tokens.
+        :param beam_size: If > 1, decode with beam search rather than sampling.
+        :param beam_alpha: Length penalty of beam search.
         :return: A string containing the generated text.
         """
+        return self.generate_texts(
+            [seed_text],
+            max_length=max_length,
+            use_extra_toks=use_extra_toks,
+            temperature=temperature,
+            top_k=top_k,
+            beam_size=beam_size,
+            beam_alpha=beam_alpha,
+        )[0]
+
+    def generate_texts(
+        self,
+        prompts,
+        max_length=None,
+        use_extra_toks=None,
+        temperature=None,
+        top_k=0,
+        beam_size=1,
+        beam_alpha=0.0,
+        batch_size=None,
+    ):
+        """
+        Continues each of a list of prompts on the Language modeling objective. Prompts are sorted by length and
+        generated for in padded batches, each row stopping at its own end token. Within `cached_predict()` the
+        generation graph is kept between calls.
+        :param prompts: A list of seed texts, see `generate_text`.
+        :param max_length: The maximum length to decode each prompt to.
+        :param batch_size: Number of prompts to generate for at once. Defaults to config.predict_batch_size.
+        :return: A list containing the generated text for each prompt, in order.
+        See `generate_text` for the other parameters.
+        """
         if use_extra_toks is None:
             use_extra_toks = self._trained
+        text_encoder = self.input_pipeline.text_encoder
+        start = [text_encoder.start_token] if use_extra_toks else []
+        prompt_ids = []
+        for prompt in prompts:
+            encoded = text_encoder._encode([prompt])
+            token_ids = list(start)
+            if encoded.token_ids is not None and len(encoded.token_ids):
+                token_ids += encoded.token_ids[0]
+            if not token_ids:
+                raise ValueError(
+                    "If you are not using the extra tokens, you must provide some non-empty seed text"
+                )
+            prompt_ids.append(token_ids)
+
+        max_length = min(max_length or self.config.max_length, self.config.max_length)
+        if self.config.base_model.incremental_featurizer is None:
+            if top_k or beam_size > 1:
+                raise FinetuneError(
+                    "top_k and beam_size are not supported by {}".format(self.config.base_model.__name__)
+                )
+            return [
+                text_encoder.decode(self._generate_text_full_recompute(token_ids, max_length, use_extra_toks))
+                for token_ids in prompt_ids
+            ]
+
+        options = dict(
+            temperature=self.config.lm_temp if temperature is None else temperature,
+            top_k=top_k,
+            beam_size=beam_size,
+            beam_alpha=beam_alpha,
+            use_extra_toks=use_extra_toks,
+        )
+        batch_size = batch_size or self.config.predict_batch_size
+        # Batching prompts of similar lengths together keeps padding to a minimum.
+        order = sorted(range(len(prompt_ids)), key=lambda i: len(prompt_ids[i]))
+        texts = [None] * len(prompt_ids)
+        for batch_start in range(0, len(order), batch_size):
+            batch_idxs = order[batch_start : batch_start + batch_size]
+            batch = [prompt_ids[i] for i in batch_idxs]
+            budgets = [max_length - 1 - len(token_ids) for token_ids in batch]
+            generated = self._generate_tokens(batch, max_new_tokens=max(budgets), **options)
+            for i, token_ids, budget, new_ids in zip(batch_idxs, batch, budgets, generated):
+                texts[i] = text_encoder.decode(token_ids + new_ids[: max(budget, 0)])
+        return texts
+
+    def _generate_text_full_recompute(self, token_ids, max_length, use_extra_toks):
+        """
+        Generates by re-running the whole sequence through the estimator for every new token. Used for base models
+        without an incremental featurizer.
+        """
 
         def dataset_encoded():
             while not dataset_encoded.finished:
@@ -682,16 +1147,7 @@ class BaseModel(object, metaclass=ABCMeta):
             return tf_dataset.batch(1)
 
         self.config.use_extra_toks = use_extra_toks
-        encoded = self.input_pipeline.text_encoder._encode([seed_text])
-        if encoded.token_ids == [] and not use_extra_toks:
-            raise ValueError(
-                "If you are not using the extra tokens, you must provide some non-empty seed text"
-            )
-        start = [self.input_pipeline.text_encoder.start_token] if use_extra_toks else []
-        token_ids = start
-        if encoded.token_ids is not None and len(encoded.token_ids):
-            token_ids += encoded.token_ids[0]
-        encoded = EncodedOutput(token_ids=token_ids)
+        encoded = EncodedOutput(token_ids=list(token_ids))
 
         estimator, hooks = self.get_estimator(force_build_lm=True)
 
@@ -702,9 +1158,7 @@ class BaseModel(object, metaclass=ABCMeta):
         EOS = self.input_pipeline.text_encoder.end_token
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore")
-            for i in range(
-                len(encoded.token_ids) - 1, (max_length or self.config.max_length) - 2
-            ):
+            for i in range(len(encoded.token_ids) - 1, max_length - 2):
                 class_idx = next(predict)[PredictMode.GENERATE_TEXT]
                 encoded.token_ids.append(class_idx[-1])
                 if encoded.token_ids[-1] == EOS:
@@ -712,8 +1166,88 @@ class BaseModel(object, metaclass=ABCMeta):
             dataset_encoded.finished = True
 
         del self.config["use_extra_toks"]
+        return encoded.token_ids
+
+    def _build_generation_graph(self, temperature, top_k, beam_size, beam_alpha, use_extra_toks):
+        """
+        Builds the kv-cached generation graph for one set of decoding options and loads the model weights into it.
+
+        :return: (session, (tokens, lengths, max_new_tokens) placeholders, generated tokens tensor)
+        """
+        graph = tf.Graph()
+        with graph.as_default():
+            tokens = tf.compat.v1.placeholder(tf.int32, [None, None], name="tokens")
+            lengths = tf.compat.v1.placeholder(tf.int32, [None], name="lengths")
+            max_new_tokens = tf.compat.v1.placeholder(tf.int32, [], name="max_new_tokens")
+            generated = kv_cached_generate(
+                self.config.base_model.incremental_featurizer,
+                tokens,
+                lengths,
+                max_new_tokens,
+                encoder=self.input_pipeline.text_encoder,
+                config=self.config,
+                temperature=temperature,
+                top_k=top_k,
+                beam_size=beam_size,
+                beam_alpha=beam_alpha,
+                use_extra_toks=use_extra_toks,
+            )
+            session = tf.compat.v1.Session(
+                graph=graph, config=self._get_estimator_config().session_config
+            )
+            session.run(tf.compat.v1.global_variables_initializer())
+            self.saver.get_scaffold_init_fn()(None, session)
+        return session, (tokens, lengths, max_new_tokens), generated
+
+    @contextmanager
+    def _generation_graph(self, **options):
+        key = tuple(sorted(options.items()))
+        if key in self._generation_graphs:
+            yield self._generation_graphs[key]
+            return
+        graph = self._build_generation_graph(**options)
+        if self._cached_predict:
+            self._generation_graphs[key] = graph
+            yield graph
+            return
+        try:
+            yield graph
+        finally:
+            graph[0].close()
+
+    def _generate_tokens(self, prompts, max_new_tokens, **options):
+        """
+        Continues a batch of token id prompts with the kv-cached generation graph.
 
-        return self.input_pipeline.text_encoder.decode(encoded.token_ids)
+        :param prompts: A list of non-empty lists of token ids.
+        :param max_new_tokens: Upper bound on the number of tokens generated for each prompt.
+        :param options: Decoding options, see _build_generation_graph.
+        :return: A list of generated token ids for each prompt, ending with the end token if one was generated.
+        """
+        if max_new_tokens <= 0:
+            return [[] for _ in prompts]
+        prompt_length = max(len(prompt) for prompt in prompts)
+        # Prompts are left padded so that the newest token of every row is in the last column.
+        padded = np.zeros([len(prompts), prompt_length], dtype=np.int32)
+        for i, prompt in enumerate(prompts):
+            padded[i, prompt_length - len(prompt) :] = prompt
+        with self._generation_graph(**options) as (session, (tokens, lengths, max_new), generated):
+            output = session.run(
+                generated,
+                feed_dict={
+                    tokens: padded,
+                    lengths: [len(prompt) for prompt in prompts],
+                    max_new: max_new_tokens,
+                },
+            )
+        return [self._trim_generated(row) for row in output]
+
+    def _trim_generated(self, generated):
+        EOS = self.input_pipeline.text_encoder.end_token
+        generated = [int(token) for token in generated]
+        if EOS in generated:
+            generated = generated[: generated.index(EOS) + 1]
+        return generated
 
     def __getstate__(self):
         """
@@ -725,6 +1259,19 @@ class BaseModel(object, metaclass=ABCMeta):
         }
         return serialized_state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # models loaded without BaseModel.load, eg. by finetune.serving.ExportedModel, never run _initialize
+        self._inference_backend = None
+        self._inference_overrides = threading.local()
+
+    def set_inference_backend(self, inference_fn):
+        """
+        Runs all inference through inference_fn, a callable with the signature of BaseModel._inference, in place of
+        the tensorflow estimator. Pass None to go back to the estimator.
+        """
+        self._inference_backend = inference_fn
+
     def save(self, path):
         """
         Saves the state of the model to disk to the folder specific by `path`.  If `path` does not exist, it will be auto-created.
@@ -744,6 +1291,51 @@ class BaseModel(object, metaclass=ABCMeta):
             path = os.path.abspath(path)
         self.saver.save(self, path)
 
+    def export(self, path):
+        """
+        Exports the model for serving to the directory `path`, which is created if it does not exist.
+
+        The export holds a SavedModel of the prediction graph, with the featurizer, target model and all weights
+        folded in and a "serving_default" signature over the batched `tokens` and `length` features (and `context`
+        for models that use it), along with the pickled model object used to tokenize inputs and decode outputs.
+        Load it with `finetune.serving.ExportedModel.load(path)`, which skips config resolution, base model
+        downloads, graph construction and weight merging.
+        """
+        path = os.path.abspath(path)
+        saved_model_dir = os.path.join(path, SAVED_MODEL_DIR)
+        if os.path.exists(saved_model_dir):
+            raise FinetuneError("{} already contains an exported model.".format(path))
+        os.makedirs(path, exist_ok=True)
+
+        session_config = self._get_estimator_config().session_config
+        types, shapes = self.input_pipeline.predict_feature_spec()
+        graph = tf.Graph()
+        with graph.as_default():
+            features = {
+                name: tf.compat.v1.placeholder(types[name], shapes[name], name=name)
+                for name in types
+            }
+            tf.compat.v1.train.get_or_create_global_step()
+            spec = self._get_model_fn()(
+                features, None, tf.estimator.ModeKeys.PREDICT, self.config
+            )
+            with tf.compat.v1.Session(graph=graph, config=session_config) as session:
+                session.run(tf.compat.v1.global_variables_initializer())
+                self.saver.get_scaffold_init_fn()(None, session)
+                builder = tf.compat.v1.saved_model.Builder(saved_model_dir)
+                builder.add_meta_graph_and_variables(
+                    session,
+                    [tf.saved_model.SERVING],
+                    signature_def_map={
+                        SERVING_SIGNATURE: tf.compat.v1.saved_model.predict_signature_def(
+                            inputs=features, outputs=spec.predictions
+                        )
+                    },
+                    strip_default_attrs=True,
+                )
+                builder.save()
+        joblib.dump(self, os.path.join(path, EXPORTED_MODEL_FILE))
+
     def create_base_model(self, filename, exists_ok=False):
         """
         Saves the current weights into the correct file format to be used as a base model.
@@ -765,11 +1357,14 @@ class BaseModel(object, metaclass=ABCMeta):
                 "Cannot save a base model with no weights changed. Call fit before creating a base model."
             )
         weights_stripped = {
-            k: v
+            k: self.saver.materialize(k, v)
             for k, v in self.saver.variables.items()
             if "featurizer" in k and "Adam" not in k
         }
-        joblib.dump(weights_stripped, base_model_path)
+        if self.config.save_format == "mmap":
+            write_weight_file(base_model_path, weights_stripped)
+        else:
+            joblib.dump(weights_stripped, base_model_path)
 
     def load(path, *args, **kwargs):
         """
@@ -822,55 +1417,64 @@ class BaseModel(object, metaclass=ABCMeta):
 
     @classmethod
     def finetune_grid_search(
-        cls, Xs, Y, *, test_size, eval_fn=None, probs=False, return_all=False, **kwargs
+        cls,
+        Xs,
+        Y,
+        *,
+        test_size,
+        eval_fn=None,
+        probs=False,
+        return_all=False,
+        n_workers=1,
+        devices=None,
+        halving_rounds=0,
+        halving_eta=3,
+        **kwargs
     ):
         """
         Performs grid search over config items defined using "GridSearchable" objects and returns either full results or
         the config object that relates to the best results. The default config contains grid searchable objects for the
         most important parameters to search over.
 
+        The data is tokenized once and shared by every trial through `tokenize_cache_dir` (a temporary directory
+        unless one is configured).
+
         :param Xs: Input text. Either [num_samples] or [sequence, num_samples] for single or multi input models respectively.
         :param Y: Targets, A list of targets, [num_samples] that correspond to each sample in Xs.
         :param test_size: Int or float. If an int is given this number of samples is used to validate, if a float is
          given then that fraction of samples is used.
         :param eval_fn: An eval function that takes 2 inputs (prediction, truth) and returns a float, with a max value being desired.
+            Must be picklable, ie. not a lambda, when n_workers > 1.
         :param probs: If true, eval_fn is passed probability outputs from predict_proba, otherwise the output of predict is used.
         :param return_all: If True, all results are returned, if False, only the best config is returned.
+        :param n_workers: Number of trials to run in parallel, each in its own process pinned to one device. Workers
+            are spawned, so scripts must guard their entry point with `if __name__ == "__main__":`.
+        :param devices: GPU ids to spread the workers across. Defaults to all available gpus.
+        :param halving_rounds: Rounds of successive halving. Each round trains the surviving configs for a fraction of
+            their epochs and keeps the best 1 / halving_eta of them, ranked on validation loss when `val_size` is set
+            and on eval_fn otherwise. Defaults to 0, which trains every config fully.
+        :param halving_eta: Factor by which configs are cut and budgets grow between halving rounds.
         :param kwargs: Keyword arguments to pass to get_config()
         :return: default is to return the best config object. If return_all is true, it returns a list of tuples of the
-            form [(config, eval_fn output), ... ]
+            form [(config, eval_fn output), ... ], where the output is None for configs that were pruned.
         """
-        if isinstance(Xs[0], str):
-            Xs = [Xs]
-        config = get_config(**kwargs)
-        config.val_size = 0.0
-        eval_fn = eval_fn or cls.get_eval_fn()
-
-        trainXs, testXs, trainY, testY = train_test_split(
-            list_transpose(Xs), Y, test_size=test_size, shuffle=True
+        results = cls._grid_search(
+            Xs,
+            Y,
+            n_splits=1,
+            test_size=test_size,
+            eval_fn=eval_fn,
+            probs=probs,
+            n_workers=n_workers,
+            devices=devices,
+            halving_rounds=halving_rounds,
+            halving_eta=halving_eta,
+            **kwargs
         )
-        trainXs = list_transpose(trainXs)
-        testXs = list_transpose(testXs)
-        gs = config.get_grid_searchable()
-        ranged_keys = gs.keys()
-        ranged_iterators = gs.values()
-        grid_gen = itertools.product(*ranged_iterators)
-        results = []
-        for grid_item in grid_gen:
-            config_ = deepcopy(config)
-            config_.update(dict(zip(ranged_keys, grid_item)))
-            instance = cls(config=config_)
-            instance.finetune(*trainXs, Y=trainY)
-            if probs:
-                res = instance.predict_proba(*testXs)
-            else:
-                res = instance.predict(*testXs)
-            results.append((config_, eval_fn(res, testY)))
-            del instance
-
+        results = [(config, scores[0]) for config, scores in results]
         if return_all:
             return results
-        return max(results, key=lambda x: x[1])[0]
+        return _best_config(results)
 
     @classmethod
     def finetune_grid_search_cv(
@@ -883,6 +1487,10 @@ class BaseModel(object, metaclass=ABCMeta):
         eval_fn=None,
         probs=False,
         return_all=False,
+        n_workers=1,
+        devices=None,
+        halving_rounds=0,
+        halving_eta=3,
         **kwargs
     ):
         """
@@ -901,41 +1509,65 @@ class BaseModel(object, metaclass=ABCMeta):
             desired. An arithmetic mean must make sense for this metric.
         :param probs: If true, eval_fn is passed probability outputs from predict_proba, otherwise the output of predict is used.
         :param return_all: If True, all results are returned, if False, only the best config is returned.
+        :param n_workers: See `finetune_grid_search`.
+        :param devices: See `finetune_grid_search`.
+        :param halving_rounds: See `finetune_grid_search`, configs are pruned independently for each split.
+        :param halving_eta: See `finetune_grid_search`.
         :param kwargs: Keyword arguments to pass to get_config()
         :return: default is to return the best config object. If return_all is true, it returns a list of tuples of the
-            form [(config, eval_fn output), ... ]
-        """
-        results = []
-        for _ in range(n_splits):
-            res = cls.finetune_grid_search(
-                Xs,
-                Y,
-                test_size=test_size,
-                probs=probs,
-                eval_fn=eval_fn,
-                return_all=True,
-                **kwargs
-            )
-            results.append(res)
-        results = list(zip(*results))
+            form [(config, eval_fn output), ... ], where the output is averaged over the splits, or None for configs that
+            were pruned in any split.
+        """
+        results = cls._grid_search(
+            Xs,
+            Y,
+            n_splits=n_splits,
+            test_size=test_size,
+            eval_fn=eval_fn,
+            probs=probs,
+            n_workers=n_workers,
+            devices=devices,
+            halving_rounds=halving_rounds,
+            halving_eta=halving_eta,
+            **kwargs
+        )
         aggregated_results = []
-        for configuration in results:
-            config_common = None
-            sum_res = 0
-            n_res = 0
-            for config, result in configuration:
-                config_common = config_common or config
-                assert config == config_common
-                n_res += 1
-                sum_res += result
-            aggregated_results.append((config_common, sum_res / n_res))
+        for config, scores in results:
+            # Averages over different subsets of splits are not comparable, so configs must be scored on every split.
+            if any(score is None for score in scores):
+                aggregated_results.append((config, None))
+            else:
+                aggregated_results.append((config, sum(scores) / len(scores)))
 
         if return_all:
             return aggregated_results
 
-        return max(aggregated_results, key=lambda x: x[1])[0]
+        return _best_config(aggregated_results)
+
+    @classmethod
+    def _grid_search(cls, Xs, Y, *, halving_rounds, **kwargs):
+        if isinstance(Xs[0], str):
+            Xs = [Xs]
+        search_kwargs = {
+            key: kwargs.pop(key)
+            for key in ["n_splits", "test_size", "eval_fn", "probs", "n_workers", "devices", "halving_eta"]
+        }
+        config = get_config(**kwargs)
+        if not halving_rounds and "val_size" not in kwargs:
+            # Validation is only useful for ranking configs while pruning, unless it was asked for.
+            config.val_size = 0.0
+        return grid_search(cls, Xs, Y, config, halving_rounds=halving_rounds, **search_kwargs)
+
+    def process_long_sequence(self, zipped_data, chunks=None):
+        """
+        Yields (token_start_idx, token_end_idx, start_of_doc, end_of_doc, label_seq, proba_seq, useful_start,
+        useful_end) for each chunk of each document. If chunks is given, inference has already been run, eg. by
+        predict_iter, and those chunks are yielded instead.
+        """
+        if chunks is not None:
+            yield from chunks
+            return
 
-    def process_long_sequence(self, zipped_data):
         labels, batch_probas = [], []
 
         # outputs predictions for each chunk of each document.
@@ -979,5 +1611,7 @@ class BaseModel(object, metaclass=ABCMeta):
 
     def __del__(self):
         self.close()
+        if getattr(self, "input_pipeline", None) is not None:
+            self.input_pipeline.close()
         if hasattr(self, "_tmp_dir") and self._tmp_dir is not None:
             self._tmp_dir.cleanup()
@@ -14,6 +14,8 @@ COMMON_SETTINGS = {
 
 class SourceModel(metaclass=ABCMeta):
     is_bidirectional = True
+    # Featurizer that runs over new positions given cached keys and values, used for text generation.
+    incremental_featurizer = None
 
     @classmethod
     def get_optimal_params(cls, config):
@@ -23,6 +23,7 @@ import functools
 
 from finetune.optimizers.recompute_grads import recompute_grad
 from finetune.nn.auxiliary import embed_position
+from finetune.util.quantization import dense
 
 class BertConfig(object):
     """Configuration for `BertModel`."""
@@ -262,7 +263,7 @@ class _BertModel(object):
                 first_token_tensor.set_shape([None, config.hidden_size])
                 # first_token_tensor = tf.squeeze(self.sequence_output[:, 0:1, :], axis=1)
                 if use_pooler:
-                    self.pooled_output = tf.compat.v1.layers.dense(
+                    self.pooled_output = dense(
                         first_token_tensor,
                         config.hidden_size,
                         activation=tf.tanh,
@@ -479,7 +480,7 @@ def docrep_pos_embed(input_context, positional_channels, batch_size, seq_length,
     """ Embed 2D position DocRep-style, i.e. separate sinusoidal embeddings for each dim """
     init = tf.compat.v1.variance_scaling_initializer(scale=0.02, mode="fan_avg", distribution="truncated_normal")
     embedded_input_context = embed_position(input_context, positional_channels, batch_size, seq_length)
-    return tf.compat.v1.layers.dense(embedded_input_context, width, use_bias=False, kernel_initializer=init)
+    return dense(embedded_input_context, width, use_bias=False, kernel_initializer=init)
 
 
 def layoutlm_pos_embed(input_context, positional_channels, batch_size, seq_length, width):
@@ -809,7 +810,7 @@ def attention_layer(
     to_tensor_2d = reshape_to_matrix(to_tensor)
 
     # `query_layer` = [B*F, N*H]
-    query_layer = tf.compat.v1.layers.dense(
+    query_layer = dense(
         from_tensor_2d,
         num_attention_heads * size_per_head,
         activation=query_act,
@@ -818,7 +819,7 @@ def attention_layer(
     )
 
     # `key_layer` = [B*T, N*H]
-    key_layer = tf.compat.v1.layers.dense(
+    key_layer = dense(
         to_tensor_2d,
         num_attention_heads * size_per_head,
         activation=key_act,
@@ -827,7 +828,7 @@ def attention_layer(
     )
 
     # `value_layer` = [B*T, N*H]
-    value_layer = tf.compat.v1.layers.dense(
+    value_layer = dense(
         to_tensor_2d,
         num_attention_heads * size_per_head,
         activation=value_act,
@@ -947,7 +948,7 @@ def full_block(
         # Run a linear projection of `hidden_size` then add a residual
         # with `layer_input`.
         with tf.compat.v1.variable_scope("output"):
-            attention_output = tf.compat.v1.layers.dense(
+            attention_output = dense(
                 attention_output,
                 hidden_size,
                 kernel_initializer=create_initializer(initializer_range))
@@ -956,7 +957,7 @@ def full_block(
 
     # The activation is only applied to the "intermediate" hidden layer.
     with tf.compat.v1.variable_scope("intermediate"):
-        intermediate_output = tf.compat.v1.layers.dense(
+        intermediate_output = dense(
             attention_output,
             intermediate_size,
             activation=intermediate_act_fn,
@@ -964,7 +965,7 @@ def full_block(
 
     # Down-project back to `hidden_size` then add the residual.
     with tf.compat.v1.variable_scope("output"):
-        layer_output = tf.compat.v1.layers.dense(
+        layer_output = dense(
             intermediate_output,
             hidden_size,
             kernel_initializer=create_initializer(initializer_range))
@@ -3,6 +3,7 @@ import functools
 import tensorflow as tf
 
 from finetune.util.shapes import shape_list, lengths_from_eos_idx
+from finetune.util.quantization import int8_inference_enabled, int8_matmul, quantized_kernel
 from finetune.optimizers.recompute_grads import recompute_grad
 from finetune.nn.activations import gelu
 from finetune.base_models.gpt.featurizer import norm, dropout, get_pos_values
@@ -29,6 +30,13 @@ def merge_states(x):
 def conv1d(x, scope, nf, *, w_init_stdev=0.02):
     with tf.compat.v1.variable_scope(scope):
         *start, nx = shape_list(x)
+        if int8_inference_enabled():
+            w, w_range = quantized_kernel("w", [1, nx, nf])
+            b = tf.compat.v1.get_variable("b", [nf], initializer=tf.compat.v1.constant_initializer(0))
+            return tf.reshape(
+                int8_matmul(tf.reshape(x, [-1, nx]), tf.reshape(w, [-1, nf]), w_range) + b,
+                start + [nf],
+            )
         w = tf.compat.v1.get_variable(
             "w",
             [1, nx, nf],
@@ -52,7 +60,12 @@ def attention_mask(nd, ns, *, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, *, past, hparams, train=False):
+def attn(x, scope, n_state, *, past, hparams, train=False, key_mask=None, return_present=False):
+    """
+    :param past: Optional [batch, 2, heads, past_sequence, features] keys and values of previous positions.
+    :param key_mask: Optional [batch, past_sequence + sequence] float mask, 0 for positions that must not be attended to (eg. padding).
+    :param return_present: If True, also returns the [batch, 2, heads, sequence, features] keys and values of x.
+    """
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_heads == 0
     if past is not None:
@@ -73,6 +86,8 @@ def attn(x, scope, n_state, *, past, hparams, train=False):
         _, _, nd, ns = shape_list(w)
         b = attention_mask(nd, ns, dtype=w.dtype)
         b = tf.reshape(b, [1, 1, nd, ns])
+        if key_mask is not None:
+            b = b * tf.cast(key_mask, w.dtype)[:, None, None, :]
         w = w * b - tf.cast(1e10, w.dtype) * (1 - b)
         return w
 
@@ -90,14 +105,17 @@ def attn(x, scope, n_state, *, past, hparams, train=False):
     with tf.compat.v1.variable_scope(scope):
         c = conv1d(x, "c_attn", n_state * 3)
         q, k, v = map(split_heads, tf.split(c, 3, axis=2))
+        present = tf.stack([k, v], axis=1)
         if past is not None:
-            pk, pv = tf.unstack(past, axis=1)
+            pk, pv = tf.unstack(past, num=2, axis=1)
             k = tf.concat([pk, k], axis=-2)
             v = tf.concat([pv, v], axis=-2)
         a = multihead_attn(q, k, v, hparams.attn_p_drop, train=train)
         a = merge_heads(a)
         a = conv1d(a, "c_proj", n_state)
         a = dropout(a, hparams.resid_p_drop, train=train)
+        if return_present:
+            return a, present
         return a
 
 
@@ -110,12 +128,25 @@ def mlp(x, scope, n_state, *, hparams, train=False):
         return h2
 
 
-def block(x, *, past, hparams, train=False):
+def block(x, *, past, hparams, train=False, key_mask=None, return_present=False):
     nx = x.shape[-1]
-    a = attn(norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams, train=train)
+    a = attn(
+        norm(x, "ln_1"),
+        "attn",
+        nx,
+        past=past,
+        hparams=hparams,
+        train=train,
+        key_mask=key_mask,
+        return_present=return_present,
+    )
+    if return_present:
+        a, present = a
     x = x + a
     m = mlp(norm(x, "ln_2"), "mlp", nx * 4, hparams=hparams, train=train)
     x = x + m
+    if return_present:
+        return x, present
     return x
 
 
@@ -225,3 +256,44 @@ def gpt2_featurizer(
             "eos_idx": pool_idx,
             "length": lengths
         }
+
+
+def gpt2_incremental_featurizer(tokens, positions, past, key_mask, *, encoder, config):
+    """
+    Runs the GPT2 featurizer over new positions only, attending to the cached keys and values of earlier ones.
+
+    :param tokens: [batch, sequence] token ids of the new positions.
+    :param positions: [batch, sequence] position of each new token, which differ between rows for left padded batches.
+    :param past: None or [batch, n_layer, 2, heads, past_sequence, features] keys and values of earlier positions,
+        as returned by a previous call.
+    :param key_mask: [batch, past_sequence + sequence] float mask, 0 for padding.
+    :return: A dict containing;
+        embed_weights: the word embedding matrix.
+        sequence_features: [batch, sequence, n_embed] output of the featurizer at the new positions.
+        present: [batch, n_layer, 2, heads, sequence, features] keys and values of the new positions.
+    """
+    X = tf.stack([tokens, encoder.vocab_size + positions], 2)
+    with tf.compat.v1.variable_scope("model/featurizer", reuse=tf.compat.v1.AUTO_REUSE):
+        embed_weights = tf.compat.v1.get_variable(
+            name="we",
+            shape=[encoder.vocab_size + config.max_length, config.n_embed],
+            initializer=tf.compat.v1.random_normal_initializer(stddev=config.weight_stddev),
+        )
+        h = embed(X, embed_weights)
+        if past is None:
+            pasts = [None] * config.n_layer
+        else:
+            pasts = tf.unstack(past, num=config.n_layer, axis=1)
+        presents = []
+        for layer, layer_past in enumerate(pasts):
+            with tf.compat.v1.variable_scope("h%d" % layer):
+                h, present = block(
+                    h, past=layer_past, hparams=config, key_mask=key_mask, return_present=True
+                )
+                presents.append(present)
+        h = norm(h, "ln_f")
+    return {
+        "embed_weights": embed_weights,
+        "sequence_features": h,
+        "present": tf.stack(presents, axis=1),
+    }
@@ -3,7 +3,7 @@ from urllib.parse import urljoin
 
 from finetune.base_models import SourceModel
 from finetune.base_models.gpt2.encoder import GPT2Encoder
-from finetune.base_models.gpt2.featurizer import gpt2_featurizer
+from finetune.base_models.gpt2.featurizer import gpt2_featurizer, gpt2_incremental_featurizer
 from finetune.util.download import GPT2_BASE_URL, FINETUNE_BASE_FOLDER
 
 
@@ -11,6 +11,7 @@ class GPT2Model(SourceModel):
     is_bidirectional = False
     encoder = GPT2Encoder
     featurizer = gpt2_featurizer
+    incremental_featurizer = gpt2_incremental_featurizer
     settings = {
         'max_length': 1024,
         'n_embed': 768,
@@ -33,6 +34,7 @@ class GPT2Model345(SourceModel):
     is_bidirectional = False
     encoder = GPT2Encoder
     featurizer = gpt2_featurizer
+    incremental_featurizer = gpt2_incremental_featurizer
     settings = {
         'max_length': 1024,
         'n_embed': 1024,
@@ -56,6 +58,7 @@ class GPT2Model762(SourceModel):
     is_bidirectional = False
     encoder = GPT2Encoder
     featurizer = gpt2_featurizer
+    incremental_featurizer = gpt2_incremental_featurizer
     settings = {
         'max_length': 1024,
         'n_embed': 1280,
@@ -80,6 +83,7 @@ class GPT2Model1558(SourceModel):
     is_bidirectional = False
     encoder = GPT2Encoder
     featurizer = gpt2_featurizer
+    incremental_featurizer = gpt2_incremental_featurizer
 
     settings = {
         'max_length': 1024,
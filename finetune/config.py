@@ -69,9 +69,16 @@ class Settings(dict):
         examples that are longer than max length.  The progress bar will display the number of chunks processed rather than the number of examples. Defaults to `True`.
     :param chunk_context: How much context to include arround chunked text.
     :param chunk_alignment: Alignment of the active section of the chunks "left", "right", "center".
+    :param predict_recompute_factor: If set, overrides `chunk_context` at predict time with the context width at which
+        each token of a long document is run through the model at most this many times on average, eg. `1.5`. The
+        default context of 2/3 of `max_length` runs each token through about 3 times. Training is unaffected.
+        Must be at least `1`. Defaults to `None`.
     :param low_memory_mode: When True, only store partial gradients on forward pass
         and recompute remaining gradients incrementally in order to save memory.  Defaults to `False`.
     :param float_16_predict: Whether to run prediction in float 16 mode, this is only available for bert based models and will likely only yield performance improvements on GPUs with native float16 support such as Volta and Tesla.
+    :param int8_predict: Whether to run the featurizer's dense layers with int8 weights and dynamically quantized activations at predict time,
+        for faster CPU inference. Weights are quantized as they are loaded, models are still trained and saved in float32.
+        Only available for bert based and GPT2 models, takes precedence over `float_16_predict`. Defaults to `False`.
     :param optimize_for: Optimize auto parameters for either `accuracy`, `speed`, or `predict_speed` Defaults to `accuracy`
     :param embed_p_drop: Embedding dropout probability.  Defaults to `0.1`.
     :param attn_p_drop: Attention dropout probability.  Defaults to `0.1`.
@@ -115,9 +122,18 @@ class Settings(dict):
     :param save_adam_vars: Save adam parameters when calling `model.save()`.  Defaults to `True`.
     :param num_layers_trained: How many layers to finetune.  Specifying a value less than model's number of layers will train layers starting from model output. Defaults to `12`.
     :param train_embeddings: Should embedding layer be finetuned? Defaults to `True`.
+    :param cache_featurizer_outputs: When the featurizer is frozen (`num_layers_trained=0` and `train_embeddings=False`),
+        run it once over the training data, cache its outputs to memory mapped files and train the target model from the
+        cache for every epoch. The cached features are computed without featurizer dropout. Defaults to `False`.
     :param class_weights: One of 'log', 'linear', or 'sqrt'. Auto-scales gradient updates based on class frequency.  Can also be a dictionary that maps from true class name to loss coefficient. Defaults to `None`.
     :param eval_acc: if True, calculates accuracy and writes it to the tensorboard summary files for valudation runs.
     :param save_dtype: specifies what precision to save model weights with.  Defaults to `np.float32`.
+    :param save_format: File format used by `model.save()` and `model.create_base_model()`. One of `joblib` or `mmap`.
+        `mmap` files store raw aligned tensors that are memory mapped on load rather than unpickled, which reduces load time
+        and memory use when loading many models. Both formats are detected automatically on load. Defaults to `joblib`.
+    :param save_sparse_deltas: When saving, store variables where only a few rows differ from the base model (eg. embeddings)
+        as the changed rows rather than the full tensor. Reduces file size and save time. Loading these models requires a
+        version of finetune that supports this option. Defaults to `False`.
     :param regression_loss: the loss to use for regression models. One of `L1` or `L2`, defaults to `L2`.
     :param debugging_logs: if True, output tensorflow logs and turn off TQDM logging. Defaults to `False`.
     :param val_set: Where it is neccessary to use an explicit validation set, provide it here as a tuple (text, labels)
@@ -128,6 +144,22 @@ class Settings(dict):
     :param max_document_chars: Maximum number of characters in a document before splitting into
         len(document) / max_document_chars "sub documents" for prediction to avoid memory issues
         during creation of the input pipeline. Defaults to None (no splitting)
+    :param tokenize_cache_dir: Directory for a persistent, content addressed cache of tokenized and chunked documents.
+        Repeated calls to fit / predict / featurize over the same text skip tokenization entirely. Defaults to None (no caching).
+    :param tokenize_cache_max_bytes: Size cap for `tokenize_cache_dir`, least recently used entries are evicted once exceeded.
+        Defaults to None (unbounded).
+    :param tokenize_workers: Number of worker processes used to tokenize and chunk documents. Output order (and therefore shuffling)
+        is identical to single process tokenization. Workers are spawned once per model and kept until it is deleted, so scripts
+        that set this must guard their entry point with `if __name__ == "__main__":`. Defaults to None (tokenize in the main process).
+    :param tokenize_shard_size: Number of documents sent to a tokenization worker at a time. Defaults to `16`.
+    :param bucket_by_length: Group training and validation examples of similar tokenized length into the same batch
+        to reduce the compute spent on padding. Defaults to False.
+    :param max_tokens_per_batch: Size batches by a budget of padded tokens rather than a fixed number of examples.
+        Implies `bucket_by_length` for training. Predict batches keep their input order, so this works best with `sort_by_length`.
+        Defaults to None (use `batch_size` and `predict_batch_size`).
+    :param predict_max_tokens: Token budget for prediction batches, overrides `max_tokens_per_batch` at predict time.
+        If "auto" the budget is calibrated with a short throughput probe on the first call to predict and saved with the model.
+        Defaults to None.
     """
 
     def get_grid_searchable(self):
@@ -159,6 +191,11 @@ class Settings(dict):
     def __setattr__(self, k, v):
         return self.__setitem__(k, v)
 
+    def update(self, *args, **kwargs):
+        # Route through __setitem__ so that GridSearchable values passed to get_config are registered.
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
     __delattr__ = dict.__delitem__
 
 
@@ -193,6 +230,7 @@ def get_default_config():
         # General Settings
         low_memory_mode=False,
         float_16_predict="auto",
+        int8_predict=False,
         mixed_precision="auto",
 
         save_adam_vars=False,
@@ -206,13 +244,22 @@ def get_default_config():
         max_length="auto",
         weight_stddev=0.02,
         save_dtype=None,
+        save_format="joblib",
+        save_sparse_deltas=False,
         val_set=None,
         per_process_gpu_memory_fraction=None,
         distribution_strategy="central_storage",
         xla=False,
         optimize_for="accuracy",
         sort_by_length=True,
+        bucket_by_length=False,
+        max_tokens_per_batch=None,
+        predict_max_tokens=None,
         collapse_whitespace=False,
+        tokenize_cache_dir=None,
+        tokenize_cache_max_bytes=None,
+        tokenize_workers=None,
+        tokenize_shard_size=16,
         permit_uninitialized=None,
         max_training_hours=None,
         #
@@ -243,6 +290,7 @@ def get_default_config():
         # Partial Fitting
         num_layers_trained=12,
         train_embeddings=True,
+        cache_featurizer_outputs=False,
         #
         # Class Imbalance
         class_weights=None,
@@ -277,6 +325,7 @@ def get_default_config():
         chunk_long_sequences=True,
         chunk_context="auto",
         chunk_alignment="center",
+        predict_recompute_factor=None,
         add_eos_bos_to_chunk=True,
         filter_empty_examples=False,
         crf_sequence_labeling=True,
@@ -284,49 +284,77 @@ class BaseEncoder(metaclass=SingletonMeta):
         )
 
 
+PreparedContext = namedtuple(
+    "PreparedContext",
+    [
+        "ends",  # character end of each context span, sorted
+        "values",  # [n_spans + 1, n_context_keys] context values in the order of ends, followed by the default context
+        "texts",  # text of each context span, "" where not given
+    ],
+)
+
+
+def prepare_context(context, config):
+    """
+    Sorts the context of a document by character end once, so that every chunk of the document can be aligned to
+    it with tokenize_context without re-sorting.
+    """
+    if isinstance(context, PreparedContext):
+        return context
+    context_keys = [k for k in sorted(context[0].keys()) if k not in INFO_KEYS]
+    ordered = sorted(context, key=lambda c: c["end"])
+    return PreparedContext(
+        ends=np.array([c["end"] for c in ordered]),
+        values=np.array(
+            [[c[k] for k in context_keys] for c in ordered]
+            # default context is set by user in config
+            + [[config.default_context[k] for k in context_keys]]
+        ),
+        texts=np.array([c.get("text") or "" for c in ordered], dtype=str),
+    )
+
+
 def tokenize_context(context, encoded_output, config):
-    """ Tokenize the context corresponding to a single sequence of text """
-    # in the edge case where the chunk is just a single end token, we don't need to alter our context chunk
+    """
+    Tokenize the context corresponding to a single sequence of text.
+
+    :param context: A list of context dicts, or the output of prepare_context for the document.
+    """
+    context = prepare_context(context, config)
     seq_len = len(encoded_output.token_ids)
-    context_keys = list(k for k in sorted(context[0].keys()) if k not in INFO_KEYS)
-    context_by_char_loc = sorted(
-        [(c["end"], [c[k] for k in context_keys], c.get("text")) for c in context],
-        key=lambda c: c[0],
-    )
-    # default context is set by user in config
-    default_context = [config.default_context[k] for k in context_keys]
-    current_char_loc = 0
-    tokenized_context = []
     assert len(encoded_output.tokens) == len(encoded_output.token_ends)
     assert encoded_output.token_starts[1] <= encoded_output.token_ends[-2]
-    for i, (token, char_loc) in enumerate(
-        zip(encoded_output.tokens, encoded_output.token_ends)
-    ):
-        # Note: this assumes that the tokenization will never lump multiple tokens into one
-        # (this would not be the case if multiple context spans make up the same token)
-        if char_loc == -1:
-            tokenized_context.append(default_context)
-        else:
-            while token.strip() and char_loc > context_by_char_loc[current_char_loc][0]:
-                current_char_loc += 1
-                if current_char_loc >= len(context_by_char_loc):
-                    raise ValueError(
-                        "Context cannot be fully matched as it appears to not cover the end of the sequence for token {}".format(
-                            token
-                        )
-                    )
-            if (
-                context_by_char_loc[current_char_loc][2]
-                and token.strip() not in context_by_char_loc[current_char_loc][2]
-            ):
-                warnings.warn(
-                    "subtoken: {} has matched up with the context for token: {}".format(
-                        repr(token), repr(context_by_char_loc[current_char_loc][2])
-                    )
+    token_ends = np.asarray(encoded_output.token_ends)
+    tokens = np.char.strip(np.asarray(encoded_output.tokens).astype(str))
+    is_special = token_ends == -1
+    # Whitespace tokens take the context of the token before them.
+    # Note: this assumes that the tokenization will never lump multiple tokens into one
+    # (this would not be the case if multiple context spans make up the same token)
+    advances = ~is_special & (tokens != "")
+    span_idx = np.searchsorted(context.ends, token_ends, side="left")
+    unmatched = advances & (span_idx >= len(context.ends))
+    if unmatched.any():
+        raise ValueError(
+            "Context cannot be fully matched as it appears to not cover the end of the sequence for token {}".format(
+                encoded_output.tokens[np.argmax(unmatched)]
+            )
+        )
+    # Spans are matched in order, a token never matches a span before that of an earlier token.
+    span_idx = np.maximum.accumulate(np.where(advances, span_idx, 0))
+
+    if len(context.texts):
+        matched_texts = context.texts[np.minimum(span_idx, len(context.texts) - 1)]
+        mismatched = (
+            ~is_special & (matched_texts != "") & (np.char.find(matched_texts, tokens) == -1)
+        )
+        for i in np.flatnonzero(mismatched):
+            warnings.warn(
+                "subtoken: {} has matched up with the context for token: {}".format(
+                    repr(encoded_output.tokens[i]), repr(str(matched_texts[i]))
                 )
-            tokenized_context.append(context_by_char_loc[current_char_loc][1])
+            )
 
-    assert len(tokenized_context) == len(encoded_output.token_ends)
+    tokenized_context = context.values[np.where(is_special, len(context.ends), span_idx)]
     # padded value doesn't matter since it will be masked out
     expanded_context = np.pad(
         tokenized_context, ((0, seq_len - len(tokenized_context)), (0, 0)), "constant"
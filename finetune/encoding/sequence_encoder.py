@@ -32,6 +32,12 @@ def _merge_confidences(annotation):
         return
 
     labels = annotation["confidence"][0].keys()
+    if len(annotation["confidence"]) == 1:
+        # Skip np.mean in the common case of a single set of confidences.
+        confidences = annotation["confidence"][0]
+        annotation["confidence"] = {label: float(confidences[label]) for label in labels}
+        return
+
     annotation["confidence"] = {
         label: np.mean(
             [confidences[label] for confidences in annotation["confidence"]]
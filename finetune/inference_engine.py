@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from finetune.errors import FinetuneError
+
+LOGGER = logging.getLogger("finetune")
+
+_SHUTDOWN = object()
+
+
+class _Request:
+    def __init__(self, X, context, kwargs, n_tokens):
+        self.X = X
+        self.context = context
+        self.kwargs = kwargs
+        self.batch_key = repr(sorted(kwargs.items()))
+        self.n_tokens = n_tokens
+        self.future = Future()
+
+
+class InferenceEngine:
+    """
+    Long lived prediction server for a single model.
+
+    Requests from any number of threads are placed on a queue and a single worker thread, which
+    owns the model's cached graph, groups them into micro-batches. A batch is run as soon as it
+    reaches max_batch_tokens or max_batch_size, or max_wait_ms after its first request arrived.
+
+    Usage:
+        with InferenceEngine(model, max_wait_ms=10) as engine:
+            future = engine.submit("some text")
+            prediction = future.result()
+
+    :param model: A fit or loaded finetune model.
+    :param max_wait_ms: Maximum time to wait for more requests before running a batch.
+    :param max_batch_tokens: Estimated token budget of a batch, estimated from character counts.
+    :param max_batch_size: Maximum number of documents in a batch.
+    :param chars_per_token: Characters per token used to estimate the size of a request.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_wait_ms=5,
+        max_batch_tokens=None,
+        max_batch_size=None,
+        chars_per_token=4,
+    ):
+        self.model = model
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size or model.config.predict_batch_size * 8
+        self.chars_per_token = chars_per_token
+        self.n_requests = 0
+        self.n_batches = 0
+        self._queue = queue.Queue()
+        # Requests that could not join the last batch as they were submitted with different kwargs.
+        self._deferred = deque()
+        self._closed = False
+        self._worker = threading.Thread(
+            target=self._run, name="finetune-inference-engine", daemon=True
+        )
+        self._worker.start()
+
+    def _estimate_tokens(self, X):
+        if isinstance(X, str):
+            return max(1, len(X) // self.chars_per_token)
+        try:
+            return sum(self._estimate_tokens(x) for x in X)
+        except TypeError:
+            return 1
+
+    def submit(self, X, context=None, **kwargs):
+        """
+        Queues a single document for prediction. Thread safe.
+
+        :param X: A single document, in the format of one element of the input to predict.
+        :param context: Optional context for the document.
+        :param kwargs: Passed through to predict, only requests with equal kwargs share a batch.
+        :returns: A concurrent.futures.Future that resolves to the prediction for X.
+        """
+        if self._closed:
+            raise FinetuneError("Cannot submit to an InferenceEngine that has been closed.")
+        request = _Request(X, context, kwargs, self._estimate_tokens(X))
+        self._queue.put(request)
+        return request.future
+
+    async def predict_async(self, X, context=None, **kwargs):
+        """
+        Asyncio friendly version of submit, awaits the prediction for X.
+        """
+        return await asyncio.wrap_future(self.submit(X, context=context, **kwargs))
+
+    def _next_request(self, timeout=None):
+        if self._deferred:
+            return self._deferred.popleft()
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _collect_batch(self, first):
+        batch = [first]
+        n_tokens = first.n_tokens
+        deadline = time.monotonic() + self.max_wait
+        skipped = []
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and not self._deferred:
+                break
+            request = self._next_request(timeout=max(remaining, 0))
+            if request is None:
+                break
+            if request is _SHUTDOWN:
+                skipped.append(request)
+                break
+            if request.batch_key != first.batch_key:
+                skipped.append(request)
+                continue
+            if (
+                self.max_batch_tokens is not None
+                and n_tokens + request.n_tokens > self.max_batch_tokens
+            ):
+                skipped.append(request)
+                break
+            batch.append(request)
+            n_tokens += request.n_tokens
+        # Keep arrival order for requests that did not make it into this batch.
+        self._deferred.extendleft(reversed(skipped))
+        return batch
+
+    def _run_batch(self, batch):
+        batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        context = None
+        if any(r.context is not None for r in batch):
+            context = [r.context for r in batch]
+        try:
+            predictions = self.model.predict(
+                [r.X for r in batch], context=context, **batch[0].kwargs
+            )
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for request, prediction in zip(batch, predictions):
+            request.future.set_result(prediction)
+        self.n_requests += len(batch)
+        self.n_batches += 1
+
+    def _run(self):
+        self.model._cached_predict = True
+        try:
+            while True:
+                request = self._next_request()
+                if request is _SHUTDOWN:
+                    break
+                self._run_batch(self._collect_batch(request))
+        finally:
+            self.model._cached_predict = False
+            self.model.close()
+            # Fail anything still waiting so that callers are not blocked forever.
+            while True:
+                request = self._next_request(timeout=0)
+                if request is None:
+                    break
+                if request is not _SHUTDOWN and request.future.set_running_or_notify_cancel():
+                    request.future.set_exception(
+                        FinetuneError("InferenceEngine was closed before the request ran.")
+                    )
+
+    def close(self):
+        """
+        Runs any requests that are already queued, then stops the worker and releases the model's graph.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_SHUTDOWN)
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
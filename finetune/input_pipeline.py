@@ -1,13 +1,18 @@
+import hashlib
 import itertools
 import logging
+import multiprocessing
+import pickle
 import sys
 import math
 import os
 import warnings
 from collections.abc import Iterable
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 
 import tqdm
 import numpy as np
@@ -19,19 +24,41 @@ from sklearn.preprocessing import LabelBinarizer
 from sklearn.utils import shuffle as dataset_shuffle
 import finetune
 from finetune.errors import FinetuneError
-from finetune.encoding.input_encoder import EncodedOutput, tokenize_context
+from finetune.encoding.input_encoder import EncodedOutput, prepare_context, tokenize_context
 from finetune.util.imbalance import compute_class_weights
+from finetune.util.token_cache import TokenCache
 from finetune.util.input_utils import (
     InputMode,
     validation_settings,
     wrap_tqdm,
     Chunker,
+    chunk_windows,
+    context_width_for_recompute_factor,
     has_targets,
     batch_dataset,
+    bucket_settings,
+    n_bucketed_batches,
+    example_length,
+    token_budget_batches,
+    pad_batch,
 )
 
 LOGGER = logging.getLogger("finetune")
 
+# State for tokenization worker processes, see BasePipeline._tokenized_examples
+_WORKER_PIPELINE = {"key": None, "pipeline": None}
+
+
+def _tokenize_docs_in_worker(key, pipeline_bytes, docs):
+    # Workers outlive a single call, the pipeline is only sent and unpickled again when its state has changed.
+    # Returns (pid, None) when this worker does not have the pipeline for key yet and it was not sent.
+    if _WORKER_PIPELINE["key"] != key:
+        if pipeline_bytes is None:
+            return os.getpid(), None
+        _WORKER_PIPELINE["pipeline"] = pickle.loads(pipeline_bytes)
+        _WORKER_PIPELINE["key"] = key
+    return os.getpid(), [_WORKER_PIPELINE["pipeline"]._worker_tokenize(d) for d in docs]
+
 
 class BasePipeline(metaclass=ABCMeta):
     def __init__(self, config):
@@ -42,6 +69,10 @@ class BasePipeline(metaclass=ABCMeta):
         self.pad_idx_ = None
         self.rebuild = False
         self._chunker = None
+        self._training_chunks = False
+        self._token_cache = None
+        self.train_batches_per_epoch = None
+        self.val_batches = None
         self.current_epoch_offset = 0
         self.total_epoch_offset = 0
 
@@ -60,19 +91,70 @@ class BasePipeline(metaclass=ABCMeta):
         # Overridden by subclass to produce the right target encoding for a given target model.
         raise NotImplementedError
 
+    def _chunk_context(self):
+        recompute_factor = self.config.predict_recompute_factor
+        if getattr(self, "_training_chunks", False) or recompute_factor is None:
+            return self.config.chunk_context
+        if recompute_factor < 1:
+            raise FinetuneError(
+                "predict_recompute_factor must be at least 1, got {}".format(recompute_factor)
+            )
+        return context_width_for_recompute_factor(self.config.max_length, recompute_factor)
+
+    @contextmanager
+    def training_chunks(self):
+        """
+        Chunks long documents with config.chunk_context, regardless of predict_recompute_factor, within this context.
+        """
+        previous = getattr(self, "_training_chunks", False)
+        self._training_chunks = True
+        try:
+            yield
+        finally:
+            self._training_chunks = previous
+
     @property
     def chunker(self):
+        chunker_settings = (self.config.max_length, self._chunk_context())
         if (
             getattr(self, "_chunker", None) is None
-            or self.config.max_length != self._chunker.max_length
+            or getattr(self, "_chunker_settings", None) != chunker_settings
         ):
+            max_length, chunk_context = chunker_settings
             self._chunker = Chunker(
-                max_length=self.config.max_length,
-                total_context_width=self.config.chunk_context,
+                max_length=max_length,
+                total_context_width=chunk_context,
                 justify=self.config.chunk_alignment,
             )
+            self._chunker_settings = chunker_settings
         return self._chunker
 
+    @property
+    def token_cache(self):
+        cache_dir = self.config.tokenize_cache_dir
+        if cache_dir is None:
+            return None
+        if (
+            getattr(self, "_token_cache", None) is None
+            or self._token_cache.cache_dir != os.path.abspath(cache_dir)
+        ):
+            self._token_cache = TokenCache(
+                cache_dir, max_bytes=self.config.tokenize_cache_max_bytes
+            )
+        return self._token_cache
+
+    def _encoding_settings(self):
+        # Everything other than the text and the encoder that changes the output of _text_to_ids
+        return {
+            "max_length": self.config.max_length,
+            "chunk_long_sequences": self.config.chunk_long_sequences,
+            "chunk_context": self.chunker.total_context_width,
+            "chunk_alignment": self.chunker.justify,
+            "add_eos_bos_to_chunk": self.config.add_eos_bos_to_chunk,
+            "collapse_whitespace": self.config.collapse_whitespace,
+            "include_bos_eos": self.config.include_bos_eos,
+        }
+
     def _add_context_info_if_present(self, types, shapes):
         if self.config.use_auxiliary_info:
             TS = tf.TensorShape
@@ -117,6 +199,9 @@ class BasePipeline(metaclass=ABCMeta):
 
     def text_to_tokens_mask(self, X, Y=None, context=None):
         out_gen = self._text_to_ids(X, pad_token=self.config.pad_token)
+        if context is not None:
+            # Sorted once per document rather than once per chunk.
+            context = prepare_context(context, self.config)
         for i, out in enumerate(out_gen):
             if context is None:
                 feats = {"tokens": out.token_ids}
@@ -128,6 +213,92 @@ class BasePipeline(metaclass=ABCMeta):
             else:
                 yield feats, self.label_encoder.transform([Y])[0]
 
+    def _worker_tokenize(self, d):
+        """
+        Tokenizes a single document, runs inside tokenization worker processes.
+        """
+        return list(self.text_to_tokens_mask(**d))
+
+    def _merge_worker_output(self, examples):
+        """
+        Runs in the main process on the output of _worker_tokenize for each document, in order.
+        Overridden by pipelines that need to keep state across documents.
+        """
+        return examples
+
+    def _tokenized_examples(self, docs):
+        """
+        Yields the output of text_to_tokens_mask for each document in docs, in order.
+
+        If config.tokenize_workers > 1, documents are sharded across a pool of worker processes.
+        At most a bounded number of shards are in flight at once so that lazy iterators are
+        consumed as a stream.
+        """
+        n_workers = self.config.tokenize_workers or 1
+        if n_workers <= 1:
+            for d in docs:
+                yield from self.text_to_tokens_mask(**d)
+            return
+
+        executor = self._tokenize_executor(n_workers)
+        # Workers tokenize with the current state of the pipeline, identified by key. The pickled pipeline is only
+        # sent along with shards until every worker has reported back with that key, later shards carry the key alone.
+        pipeline_bytes = pickle.dumps(self)
+        key = hashlib.sha1(pipeline_bytes).hexdigest()
+        if self._executor_key != key:
+            self._executor_key = key
+            self._executor_pids = set()
+        shard_size = self.config.tokenize_shard_size
+        docs = iter(docs)
+        in_flight = deque()
+        try:
+            while True:
+                while len(in_flight) < 2 * n_workers:
+                    shard = list(itertools.islice(docs, shard_size))
+                    if not shard:
+                        break
+                    shard_bytes = pipeline_bytes if len(self._executor_pids) < n_workers else None
+                    in_flight.append(
+                        (shard, executor.submit(_tokenize_docs_in_worker, key, shard_bytes, shard))
+                    )
+                if not in_flight:
+                    break
+                shard, future = in_flight.popleft()
+                pid, shard_examples = future.result()
+                if shard_examples is None:
+                    pid, shard_examples = executor.submit(
+                        _tokenize_docs_in_worker, key, pipeline_bytes, shard
+                    ).result()
+                self._executor_pids.add(pid)
+                for doc_examples in shard_examples:
+                    yield from self._merge_worker_output(doc_examples)
+        finally:
+            for _, future in in_flight:
+                future.cancel()
+
+    def _tokenize_executor(self, n_workers):
+        """
+        The pool of tokenization worker processes, kept for the lifetime of the pipeline so that workers are not
+        restarted on every epoch and every call to predict. Workers are spawned rather than forked, as this can
+        run inside tf.data's generator thread in a multithreaded process.
+        """
+        executor = getattr(self, "_executor", None)
+        if executor is None or self._executor_workers != n_workers:
+            self.close()
+            ctx = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx)
+            self._executor_workers = n_workers
+            self._executor_key = None
+        return self._executor
+
+    def close(self):
+        """
+        Shuts down the tokenization worker processes, if any.
+        """
+        if getattr(self, "_executor", None) is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
     def _post_data_initialization(self, dataset=None):
         if "Y" in dataset[0]:
             ys = [data["Y"] for data in dataset]
@@ -183,10 +354,68 @@ class BasePipeline(metaclass=ABCMeta):
 
         return dataset_fn
 
+    def _bucket_settings(self):
+        """
+        Returns (bucket_boundaries, bucket_batch_sizes) for length bucketed batching or (None, None)
+        when batches are a fixed size.
+        """
+        if not self.config.bucket_by_length and self.config.max_tokens_per_batch is None:
+            return None, None
+        return bucket_settings(
+            max_length=self.config.max_length,
+            batch_size=self.config.batch_size,
+            max_tokens_per_batch=self.config.max_tokens_per_batch,
+        )
+
+    def _predict_max_tokens(self):
+        if isinstance(self.config.predict_max_tokens, int):
+            return self.config.predict_max_tokens
+        return self.config.max_tokens_per_batch
+
+    def predict_feature_spec(self):
+        """
+        Types and shapes of the batched features yielded by get_predict_batches.
+        """
+        types, shapes = self.feed_shape_type_def()
+        types, shapes = types[0], shapes[0]
+        batched_types = {**types, "length": tf.int32}
+        batched_shapes = {
+            k: tf.TensorShape([None]).concatenate(v) for k, v in shapes.items()
+        }
+        batched_shapes["length"] = tf.TensorShape([None])
+        return batched_types, batched_shapes
+
+    def get_predict_batches(self, generator_fn):
+        """
+        Lazily yields padded numpy batches of predict features, in the same order and with the
+        same padding as the predict dataset, without building a tf.data pipeline.
+        """
+        types, _ = self.feed_shape_type_def()
+        examples = self._tokenized_examples(generator_fn())
+        max_tokens = self._predict_max_tokens()
+        if max_tokens is not None:
+            batches = token_budget_batches(examples, max_tokens_per_batch=max_tokens)
+        else:
+            batches = iter(
+                lambda: list(itertools.islice(examples, self.config.predict_batch_size)),
+                [],
+            )
+        for batch in batches:
+            yield pad_batch(batch, types[0])
+
+    def _token_budget_dataset(self, generator_fn):
+        """
+        Batches predict inputs to a budget of padded tokens without reordering them,
+        so that predictions can be zipped back up with their inputs.
+        """
+        batched_types, batched_shapes = self.predict_feature_spec()
+        return lambda: Dataset.from_generator(
+            lambda: self.get_predict_batches(generator_fn), batched_types, batched_shapes
+        ).prefetch(tf.data.experimental.AUTOTUNE)
+
     def get_dataset_from_generator(self, generator_fn, input_mode, update_hook=None):
         def chunked_and_tokenized_dataset():
-            for d in generator_fn():
-                yield from self.text_to_tokens_mask(**d)
+            yield from self._tokenized_examples(generator_fn())
 
         types, shapes = self.feed_shape_type_def()
 
@@ -208,6 +437,8 @@ class BasePipeline(metaclass=ABCMeta):
             skip_val=input_mode == InputMode.TRAIN,
         )
         if input_mode == InputMode.PREDICT:
+            if self._predict_max_tokens() is not None:
+                return {"predict_dataset": self._token_budget_dataset(generator_fn)}
             return {
                 "predict_dataset": batch_dataset(
                     raw_dataset,
@@ -221,6 +452,14 @@ class BasePipeline(metaclass=ABCMeta):
                 "The dataset size is not adjusted for chunk long sequences when training from a generator"
             )
 
+        self.train_batches_per_epoch = None
+        self.val_batches = None
+        bucket_boundaries, bucket_batch_sizes = self._bucket_settings()
+        if bucket_boundaries is not None:
+            LOGGER.warning(
+                "The number of steps per epoch is estimated from batch_size when bucketing by length while training from a generator"
+            )
+
         if self.config.dataset_size is None:
             raise FinetuneError(
                 "If you are using a callable as input you must provide config.dataset_size"
@@ -266,13 +505,33 @@ class BasePipeline(metaclass=ABCMeta):
                 batch_size=self.config.batch_size,
                 shapes=shapes,
                 n_epochs=self.config.n_epochs,
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=bucket_batch_sizes,
             ),
             "val_dataset": batch_dataset(
-                val_dataset, batch_size=self.config.batch_size, shapes=shapes
+                val_dataset,
+                batch_size=self.config.batch_size,
+                shapes=shapes,
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=bucket_batch_sizes,
             ),
         }
 
-    def get_dataset_from_list(self, data_list, input_mode, update_hook=None):
+    def _add_cached_feature_info(self, types, shapes, examples):
+        TS = tf.TensorShape
+        features = examples[0][0] if isinstance(examples[0], tuple) else examples[0]
+        if "cached_features" in features:
+            types["cached_features"] = tf.float32
+            shapes["cached_features"] = TS([self.config.n_embed])
+        if "cached_sequence_features" in features:
+            types["cached_sequence_features"] = tf.float32
+            shapes["cached_sequence_features"] = TS([None, self.config.n_embed])
+        return types, shapes
+
+    def get_dataset_from_list(self, data_list, input_mode, update_hook=None, featurize_fn=None):
+        """
+        :param featurize_fn: Optional function that adds cached featurizer outputs to a list of tokenized examples.
+        """
         assert input_mode == InputMode.TRAIN, "use the generator path for prediction"
 
         data_list = list(data_list)
@@ -294,19 +553,11 @@ class BasePipeline(metaclass=ABCMeta):
             train_split = dataset_shuffle(data_list, random_state=self.config.seed)
             val_split = self.config.val_set or []
 
-        tokenized_train_split = list(
-            itertools.chain.from_iterable(
-                self.text_to_tokens_mask(**d) for d in train_split
-            )
-        )
+        tokenized_train_split = list(self._tokenized_examples(train_split))
 
         self.config.dataset_size = len(tokenized_train_split)
 
-        tokenized_val_split = list(
-            itertools.chain.from_iterable(
-                self.text_to_tokens_mask(**d) for d in val_split
-            )
-        )
+        tokenized_val_split = list(self._tokenized_examples(val_split))
         if self.config.val_size != len(tokenized_val_split):
             LOGGER.warning(
                 "Updating validation size from {} to {} this is possibly due to chunking but may cause issues with val frequency.".format(
@@ -321,7 +572,29 @@ class BasePipeline(metaclass=ABCMeta):
                 class_weights=self.config.class_weights, class_counts=class_counts
             )
 
+        if featurize_fn is not None:
+            tokenized_train_split = featurize_fn(tokenized_train_split)
+            tokenized_val_split = featurize_fn(tokenized_val_split)
+
+        bucket_boundaries, bucket_batch_sizes = self._bucket_settings()
+        if bucket_boundaries is not None:
+            self.train_batches_per_epoch = n_bucketed_batches(
+                [example_length(ex) for ex in tokenized_train_split],
+                bucket_boundaries,
+                bucket_batch_sizes,
+            )
+            self.val_batches = n_bucketed_batches(
+                [example_length(ex) for ex in tokenized_val_split],
+                bucket_boundaries,
+                bucket_batch_sizes,
+            )
+        else:
+            self.train_batches_per_epoch = None
+            self.val_batches = None
+
         types, shapes = self.feed_shape_type_def()
+        if featurize_fn is not None:
+            self._add_cached_feature_info(types[0], shapes[0], tokenized_train_split)
         if not has_targets(lambda: tokenized_train_split):
             types = types[0]
             shapes = shapes[0]
@@ -346,9 +619,15 @@ class BasePipeline(metaclass=ABCMeta):
                 batch_size=self.config.batch_size,
                 shapes=shapes,
                 n_epochs=self.config.n_epochs,
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=bucket_batch_sizes,
             ),
             "val_dataset": batch_dataset(
-                val_dataset_unbatched, batch_size=self.config.batch_size, shapes=shapes
+                val_dataset_unbatched,
+                batch_size=self.config.batch_size,
+                shapes=shapes,
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=bucket_batch_sizes,
             ),
         }
 
@@ -380,6 +659,20 @@ class BasePipeline(metaclass=ABCMeta):
 
     def _text_to_ids(self, Xs, pad_token=None):
         Xs = self._format_for_encoding(Xs)
+        token_cache = self.token_cache
+        if token_cache is None:
+            yield from self._encode_and_chunk(Xs)
+            return
+
+        key = token_cache.key(Xs, self.text_encoder, self._encoding_settings())
+        encoded_chunks = token_cache.get(key)
+        if encoded_chunks is None:
+            encoded_chunks = list(self._encode_and_chunk(Xs))
+            token_cache.put(key, encoded_chunks)
+        for chunk in encoded_chunks:
+            yield chunk._replace(input_text=Xs)
+
+    def _encode_and_chunk(self, Xs):
         if self.config.chunk_long_sequences and len(Xs) == 1:
             # can only chunk single sequence inputs
             encoded = self.text_encoder.encode_multi_input(
@@ -388,34 +681,29 @@ class BasePipeline(metaclass=ABCMeta):
                 remove_repeated_whitespace=self.config.collapse_whitespace,
                 include_bos_eos=self.config.include_bos_eos,
             )
-            length = len(encoded.token_ids)
-            field_starts_and_ends = dict()
-            for field in EncodedOutput._fields:
-                field_value = getattr(encoded, field)
-                if field_value is not None:
-                    field_starts_and_ends[field] = (field_value[0], field_value[-1])
             if self.config.chunk_context == 0 and self.config.add_eos_bos_to_chunk:
                 warnings.warn("""Chunk context of 0 will not capture the start
                               and end tokens added by add_eos_bos_to_chunk""")
-            for start, end, (useful_start, useful_end) in self.chunker.generate_chunks(length):
-                d = dict()
-                for field in EncodedOutput._fields:
-                    field_value = getattr(encoded, field)
-                    if field_value is not None:
-                        fv = field_value[start:end]
-                        if self.config.add_eos_bos_to_chunk:
-                            start_token, end_token = field_starts_and_ends[field]
-                            if fv[0] != start_token:
-                                fv = np.concatenate(([start_token], fv))
-                                # Update start and end only once
-                                if field == EncodedOutput._fields[0]:
-                                    useful_start += 1
-                                    useful_end += 1
-                            if fv[-1] != end_token:
-                                fv = np.concatenate((fv, [end_token]))
-                        d[field] = fv
+            starts, ends, useful_starts, useful_ends = self.chunker.chunk_bounds(
+                len(encoded.token_ids)
+            )
+            chunks = dict()
+            for field in EncodedOutput._fields:
+                field_value = getattr(encoded, field)
+                if field_value is not None:
+                    chunks[field], prefixed = chunk_windows(
+                        field_value, starts, ends, add_eos_bos=self.config.add_eos_bos_to_chunk
+                    )
+                    if field == EncodedOutput._fields[0]:
+                        # Useful sections move along with a start token added to the first field.
+                        useful_starts = useful_starts + prefixed
+                        useful_ends = useful_ends + prefixed
+            for i in range(len(starts)):
                 yield EncodedOutput(
-                    useful_start=useful_start, useful_end=useful_end, input_text=Xs, **d
+                    useful_start=int(useful_starts[i]),
+                    useful_end=int(useful_ends[i]),
+                    input_text=Xs,
+                    **{field: field_chunks[i] for field, field_chunks in chunks.items()}
                 )
         else:
             encoder_out = self.text_encoder.encode_multi_input(
@@ -436,5 +724,10 @@ class BasePipeline(metaclass=ABCMeta):
         state = self.__dict__.copy()
         if "_text_encoder" in state:
             del state["_text_encoder"]
+        state.pop("_token_cache", None)
+        state.pop("_executor", None)
+        state.pop("_executor_workers", None)
+        state.pop("_executor_key", None)
+        state.pop("_executor_pids", None)
         return state
 
@@ -10,6 +10,7 @@ from finetune.util.text_generation import sample_with_temperature
 from finetune.util.optimize_loss import optimize_loss
 
 from finetune.util.imbalance import class_weight_tensor
+from finetune.util.quantization import int8_inference
 from finetune.errors import FinetuneError
 from finetune.base_models import GPTModel, GPTModelSmall
 
@@ -147,21 +148,19 @@ def get_variable_getter(estimator_mode, features, fp16_predict, mixed_precision)
     return custom_getter, features
 
 
-def get_model_fn(
-    target_model_fn,
-    pre_target_model_hook,
-    predict_op,
-    predict_proba_op,
-    build_target_model,
-    lm_type,
-    encoder,
-    target_dim,
-    label_encoder,
-    build_explain,
-    n_replicas,
-    fp16_predict,
-    mixed_precision,
-):
+def cached_featurizer_state(features):
+    """
+    Featurizer state built from featurizer outputs that were computed ahead of time and fed in as features.
+    """
+    featurizer_state = {"lengths": features["length"]}
+    if "cached_features" in features:
+        featurizer_state["features"] = features["cached_features"]
+    if "cached_sequence_features" in features:
+        featurizer_state["sequence_features"] = features["cached_sequence_features"]
+    return featurizer_state
+
+
+def get_target_model_op(target_model_fn, pre_target_model_hook, target_dim, label_encoder):
     def target_model_op(featurizer_state, Y, params, mode, **kwargs):
         weighted_tensor = None
         if params.class_weights is not None:
@@ -186,6 +185,62 @@ def get_model_fn(
 
         return target_model_state
 
+    return target_model_op
+
+
+def target_predict_ops(target_model_state, params, predict_op, predict_proba_op, build_explain=False):
+    """
+    Builds the prediction ops of a target model.
+
+    :returns: (pred_op, predictions) where predictions is a dict of PredictMode key -> tensor.
+    """
+    predictions = dict()
+    logits = target_model_state["logits"]
+    predict_params = target_model_state.get("predict_params", {})
+    if "_threshold" in params:
+        predict_params["threshold"] = params._threshold
+    pred_op = predict_op(logits, **predict_params)
+
+    if type(pred_op) == tuple:
+        pred_op, pred_proba_op = pred_op
+    else:
+        pred_proba_op = predict_proba_op(logits, **predict_params)
+
+    if type(pred_op) == dict:
+        predictions.update(pred_op)
+        predictions.update(pred_proba_op)
+    else:
+        predictions[PredictMode.NORMAL] = pred_op
+        predictions[PredictMode.PROBAS] = pred_proba_op
+
+    if build_explain:
+        predictions[PredictMode.EXPLAIN] = target_model_state["explanation"]
+    return pred_op, predictions
+
+
+def get_model_fn(
+    target_model_fn,
+    pre_target_model_hook,
+    predict_op,
+    predict_proba_op,
+    build_target_model,
+    lm_type,
+    encoder,
+    target_dim,
+    label_encoder,
+    build_explain,
+    n_replicas,
+    fp16_predict,
+    mixed_precision,
+    int8_predict=False,
+):
+    target_model_op = get_target_model_op(
+        target_model_fn=target_model_fn,
+        pre_target_model_hook=pre_target_model_hook,
+        target_dim=target_dim,
+        label_encoder=label_encoder,
+    )
+
     def _model_fn(features, labels, mode, params):
         var_getter, features = get_variable_getter(
             mode, features, fp16_predict, mixed_precision
@@ -215,22 +270,31 @@ def get_model_fn(
             tf.compat.v1.get_variable_scope(), custom_getter=var_getter
         ):
             train_loss = 0.0
-            featurizer_state = params.base_model.get_featurizer(
-                X,
-                encoder=encoder,
-                config=params,
-                train=train,
-                explain=build_explain,
-                context=context,
-                total_num_steps=total_num_steps,
-                lengths=features.get("length"),
-            )
+            if "cached_features" in features or "cached_sequence_features" in features:
+                featurizer_state = cached_featurizer_state(features)
+            else:
+                with int8_inference(int8_predict and estimator_mode == tf.estimator.ModeKeys.PREDICT):
+                    featurizer_state = params.base_model.get_featurizer(
+                        X,
+                        encoder=encoder,
+                        config=params,
+                        train=train,
+                        explain=build_explain,
+                        context=context,
+                        total_num_steps=total_num_steps,
+                        lengths=features.get("length"),
+                    )
             predictions = {
-                PredictMode.FEATURIZE: featurizer_state["features"],
-                PredictMode.SEQUENCE: featurizer_state["sequence_features"],
+                key: featurizer_state[state_key]
+                for key, state_key in [
+                    (PredictMode.FEATURIZE, "features"),
+                    (PredictMode.SEQUENCE, "sequence_features"),
+                ]
+                if state_key in featurizer_state
             }
 
-            if params.base_model in [GPTModel, GPTModelSmall]:
+            # Cached featurizer outputs do not include attention weights.
+            if params.base_model in [GPTModel, GPTModelSmall] and "attention_weights" in featurizer_state:
                 predictions[PredictMode.ATTENTION] = featurizer_state[
                     "attention_weights"
                 ]
@@ -253,28 +317,14 @@ def get_model_fn(
                     train_loss += (1 - lm_loss_coef) * target_loss
                     tf.compat.v1.summary.scalar("TargetModelLoss", target_loss)
                 if mode == tf.estimator.ModeKeys.PREDICT or tf.estimator.ModeKeys.EVAL:
-                    logits = target_model_state["logits"]
-                    predict_params = target_model_state.get("predict_params", {})
-                    if "_threshold" in params:
-                        predict_params["threshold"] = params._threshold
-                    pred_op = predict_op(logits, **predict_params)
-
-                    if type(pred_op) == tuple:
-                        pred_op, pred_proba_op = pred_op
-                    else:
-                        pred_proba_op = predict_proba_op(logits, **predict_params)
-
-                    if type(pred_op) == dict:
-                        predictions.update(pred_op)
-                        predictions.update(pred_proba_op)
-                    else:
-                        predictions[PredictMode.NORMAL] = pred_op
-                        predictions[PredictMode.PROBAS] = pred_proba_op
-
-                    if build_explain:
-                        predictions[PredictMode.EXPLAIN] = target_model_state[
-                            "explanation"
-                        ]
+                    pred_op, target_predictions = target_predict_ops(
+                        target_model_state,
+                        params=params,
+                        predict_op=predict_op,
+                        predict_proba_op=predict_proba_op,
+                        build_explain=build_explain,
+                    )
+                    predictions.update(target_predictions)
 
             if lm_type is not None:
                 if lm_type.lower() == "lm":
@@ -380,3 +430,61 @@ def get_model_fn(
         )
 
     return _model_fn
+
+
+def head_scope(head_idx):
+    return "head_{}".format(head_idx)
+
+
+def get_multi_head_model_fn(heads, encoder, fp16_predict, int8_predict=False):
+    """
+    Predict only model fn that runs the featurizer once and feeds its output to the target model of several heads.
+    The variables of the i'th head's target model are created under head_scope(i), and its predictions are
+    returned under "<head_scope(i)>/<PredictMode key>".
+
+    :param heads: list of dicts with keys params, target_model_op, predict_op and predict_proba_op.
+    """
+
+    def _model_fn(features, labels, mode, params):
+        var_getter, features = get_variable_getter(mode, features, fp16_predict, False)
+        X = features["tokens"]
+        with tf.compat.v1.variable_scope(
+            tf.compat.v1.get_variable_scope(), custom_getter=var_getter
+        ):
+            with int8_inference(int8_predict):
+                featurizer_state = params.base_model.get_featurizer(
+                    X,
+                    encoder=encoder,
+                    config=params,
+                    train=False,
+                    context=features.get("context", None),
+                    lengths=features.get("length"),
+                )
+            predictions = {
+                PredictMode.FEATURIZE: featurizer_state["features"],
+                PredictMode.SEQUENCE: featurizer_state["sequence_features"],
+            }
+            for head_idx, head in enumerate(heads):
+                with tf.compat.v1.variable_scope(head_scope(head_idx)):
+                    # Copied as pre target model hooks modify the featurizer state in place.
+                    target_model_state = head["target_model_op"](
+                        featurizer_state=dict(featurizer_state),
+                        Y=None,
+                        params=head["params"],
+                        mode=mode,
+                    )
+                    _, head_predictions = target_predict_ops(
+                        target_model_state,
+                        params=head["params"],
+                        predict_op=head["predict_op"],
+                        predict_proba_op=head["predict_proba_op"],
+                    )
+                for key, value in head_predictions.items():
+                    predictions["{}/{}".format(head_scope(head_idx), key)] = value
+
+        for k, v in predictions.items():
+            if v.dtype == tf.float16:
+                predictions[k] = tf.cast(v, tf.float32)
+        return tf.estimator.EstimatorSpec(mode=mode, predictions=predictions)
+
+    return _model_fn
@@ -0,0 +1,259 @@
+import contextlib
+import hashlib
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from finetune.base import BaseModel
+from finetune.errors import FinetuneError
+from finetune.model import PredictMode, get_multi_head_model_fn, get_target_model_op, head_scope
+from finetune.saver import Saver, InitializeHook
+from finetune.util.indico_estimator import IndicoEstimator
+
+LOGGER = logging.getLogger("finetune")
+
+# Config values that change the featurizer graph or its inputs, the encoding and chunking settings of each
+# input pipeline are compared as well.
+FEATURIZER_CONFIG_KEYS = [
+    "base_model",
+    "max_length",
+    "float_16_predict",
+    "int8_predict",
+    "sort_by_length",
+    "max_document_chars",
+]
+SHARED_PREDICT_KEYS = {PredictMode.FEATURIZE, PredictMode.SEQUENCE}
+# Outputs that get_multi_head_model_fn never builds.
+UNSHARED_PREDICT_KEYS = {
+    PredictMode.EXPLAIN,
+    PredictMode.ATTENTION,
+    PredictMode.GENERATE_TEXT,
+    PredictMode.LM_PERPLEXITY,
+}
+
+
+def _featurizer_deltas(model):
+    saver = model.saver
+    if saver.variables is None:
+        raise FinetuneError(
+            "Model weights have already been released, MultiHeadPredictor needs freshly loaded models."
+        )
+    return {
+        name: saver.materialize(name, value)
+        for name, value in saver.variables.items()
+        if name.startswith("model/featurizer")
+    }
+
+
+def check_shared_featurizer(models):
+    """
+    Raises a FinetuneError unless all models have identical featurizers, ie. the same base model, the same
+    featurizer config and identical featurizer weights. Featurizer weights are compared through each model's
+    saved deltas from its base model, so models that never updated the featurizer compare cheaply.
+    """
+    primary = models[0]
+    primary_fallback = os.path.abspath(primary.saver.fallback_filename)
+    primary_deltas = _featurizer_deltas(primary)
+    for model in models[1:]:
+        for key in FEATURIZER_CONFIG_KEYS:
+            if model.config[key] != primary.config[key]:
+                raise FinetuneError(
+                    "Models have different values of {}: {} and {}".format(
+                        key, primary.config[key], model.config[key]
+                    )
+                )
+        encoding_settings = model.input_pipeline._encoding_settings()
+        primary_encoding_settings = primary.input_pipeline._encoding_settings()
+        for key, value in encoding_settings.items():
+            if value != primary_encoding_settings[key]:
+                raise FinetuneError(
+                    "Models have different values of {}: {} and {}".format(
+                        key, primary_encoding_settings[key], value
+                    )
+                )
+        if os.path.abspath(model.saver.fallback_filename) != primary_fallback:
+            raise FinetuneError("Models were fine-tuned from different base model files.")
+        if model.input_pipeline.predict_feature_spec() != primary.input_pipeline.predict_feature_spec():
+            raise FinetuneError("Models do not take the same input features.")
+        deltas = _featurizer_deltas(model)
+        if deltas.keys() != primary_deltas.keys() or not all(
+            np.array_equal(deltas[name], primary_deltas[name]) for name in deltas
+        ):
+            raise FinetuneError(
+                "Featurizer weights differ between models, only models with identical featurizers can share one."
+            )
+
+
+class MultiHeadPredictor:
+    """
+    Serves several fine-tuned models that share an identical featurizer, eg. heads trained with
+    `num_layers_trained=0` and `train_embeddings=False` over the same base model, from a single graph.
+    The featurizer runs once per batch and its output is fed to every model's target model, so predicting
+    with N models costs roughly one featurizer pass rather than N. Each model decodes its own outputs, so
+    predictions match calling predict on each model separately.
+
+    Usage:
+        with MultiHeadPredictor([model_a, model_b]) as predictor:
+            preds_a, preds_b = predictor.predict(texts)
+
+    :param models: List of loaded models, or paths to saved models.
+    """
+
+    def __init__(self, models):
+        if not models:
+            raise FinetuneError("MultiHeadPredictor requires at least one model.")
+        self.models = [BaseModel.load(m) if isinstance(m, str) else m for m in models]
+        check_shared_featurizer(self.models)
+        self.primary = self.models[0]
+        self._estimator = None
+        self._hooks = None
+        self._call_outputs = None
+
+    def _merged_saver(self):
+        primary = self.primary
+        saver = Saver(
+            fallback_filename=primary.saver.fallback_filename,
+            permit_uninitialized=primary.config.permit_uninitialized,
+            add_tokens=getattr(primary.config.base_model, "_add_tokens", None),
+        )
+        variables = _featurizer_deltas(primary)
+        for head_idx, model in enumerate(self.models):
+            for name, value in model.saver.variables.items():
+                if name.startswith("model/featurizer") or "OptimizeLoss" in name or "global_step" in name:
+                    continue
+                variables["{}/{}".format(head_scope(head_idx), name)] = model.saver.materialize(name, value)
+        saver.variables = variables
+        return saver
+
+    def _get_estimator(self):
+        if self._estimator is None:
+            heads = [
+                {
+                    "params": model.config,
+                    "target_model_op": get_target_model_op(
+                        target_model_fn=model._target_model,
+                        pre_target_model_hook=model._pre_target_model_hook,
+                        target_dim=model.input_pipeline.target_dim,
+                        label_encoder=model.input_pipeline.label_encoder,
+                    ),
+                    "predict_op": model._predict_op,
+                    "predict_proba_op": model._predict_proba_op,
+                }
+                for model in self.models
+            ]
+            model_fn = get_multi_head_model_fn(
+                heads,
+                encoder=self.primary.input_pipeline.text_encoder,
+                fp16_predict=self.primary.config.float_16_predict,
+                int8_predict=self.primary.config.int8_predict,
+            )
+            self._estimator = IndicoEstimator(
+                model_dir=self.primary.estimator_dir,
+                model_fn=model_fn,
+                config=self.primary._get_estimator_config(),
+                params=self.primary.config,
+            )
+            # Hooks are only run when the cached session is first created.
+            self._hooks = [InitializeHook(self._merged_saver())]
+        return self._estimator, self._hooks
+
+    def _output_names(self):
+        # Only known once the merged graph is built, until then SHARED_PREDICT_KEYS and the head keys are assumed.
+        if self._estimator is None or self._estimator.predictions is None:
+            return None
+        return set(self._estimator.predictions)
+
+    def _shared_outputs(self, zipped_data):
+        # Models share their featurizer and input pipeline settings, so every model predicting on the same inputs
+        # within one _call_each reuses a single forward pass. Inputs are matched by content rather than by call
+        # order, so models whose predict splits or reorders the data differently still get their own outputs.
+        inputs_key = hashlib.sha1(
+            pickle.dumps([(item.get("X"), item.get("context")) for item in zipped_data])
+        ).hexdigest()
+        if inputs_key not in self._call_outputs:
+            estimator, hooks = self._get_estimator()
+            pipeline = self.primary.input_pipeline
+            self._call_outputs[inputs_key] = list(
+                estimator.cached_predict(
+                    features=pipeline.get_predict_batches(lambda: iter(zipped_data)),
+                    feature_spec=pipeline.predict_feature_spec(),
+                    hooks=hooks,
+                )
+            )
+        return self._call_outputs[inputs_key]
+
+    def _head_inference(self, head_idx, fallback):
+        scope = head_scope(head_idx)
+
+        def _inference(
+            zipped_data,
+            predict_keys=None,
+            context=None,
+            update_hook=None,
+            chunked_length=None,
+            list_output=True,
+        ):
+            keys = {
+                key: key if key in SHARED_PREDICT_KEYS else "{}/{}".format(scope, key)
+                for key in predict_keys or []
+            }
+            output_names = self._output_names()
+            if (
+                not keys
+                or any(key in UNSHARED_PREDICT_KEYS for key in keys)
+                or (output_names is not None and any(name not in output_names for name in keys.values()))
+            ):
+                # Outputs that the shared graph does not build, eg. explanations, come from the model's own graph.
+                return fallback(
+                    zipped_data,
+                    predict_keys=predict_keys,
+                    context=context,
+                    update_hook=update_hook,
+                    chunked_length=chunked_length,
+                    list_output=list_output,
+                )
+            outputs = self._shared_outputs(zipped_data)
+            if len(predict_keys) == 1:
+                head_outputs = (output[keys[predict_keys[0]]] for output in outputs)
+            else:
+                head_outputs = ({key: output[name] for key, name in keys.items()} for output in outputs)
+            return list(head_outputs) if list_output else head_outputs
+
+        return _inference
+
+    def _call_each(self, method, *args, **kwargs):
+        self._call_outputs = {}
+        try:
+            with contextlib.ExitStack() as stack:
+                for head_idx, model in enumerate(self.models):
+                    # Falls back to whatever the model would otherwise run, eg. the graph of an ExportedModel.
+                    inference = self._head_inference(head_idx, model._current_inference())
+                    stack.enter_context(model.inference_override(inference))
+                return [getattr(model, method)(*args, **kwargs) for model in self.models]
+        finally:
+            self._call_outputs = None
+
+    def predict(self, X, *args, **kwargs):
+        """
+        :returns: A list with the predictions of each model, in the order the models were given.
+        """
+        return self._call_each("predict", X, *args, **kwargs)
+
+    def predict_proba(self, X, *args, **kwargs):
+        """
+        :returns: A list with the class probabilities of each model, in the order the models were given.
+        """
+        return self._call_each("predict_proba", X, *args, **kwargs)
+
+    def close(self):
+        if self._estimator is not None:
+            self._estimator.close_predict()
+            self._estimator = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
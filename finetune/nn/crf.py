@@ -37,6 +37,52 @@ def viterbi_decode(score, transition_params):
     return viterbi, np_softmax(trellis, axis=-1)
 
 
+def viterbi_decode_batch(scores, transition_params, sequence_lengths=None):
+    """Decode the highest scoring sequence of tags for a whole batch outside of TensorFlow.
+    Equivalent to calling viterbi_decode on each sequence truncated to its length, but vectorized
+    over the batch and tag dimensions so only the timestep recursion runs in python.
+    Args:
+        scores: A [batch, seq_len, num_tags] array of unary potentials.
+        transition_params: A [num_tags, num_tags] matrix of binary potentials.
+        sequence_lengths: A [batch] array of sequence lengths, defaults to seq_len for every sequence.
+    Returns:
+        viterbi: A [batch, seq_len] int32 array of the highest scoring tag indices. Padding
+            positions repeat the final tag of each sequence.
+        trellis: A [batch, seq_len, num_tags] array of the softmaxed trellis, padding positions
+            repeat the final value of each sequence.
+    """
+    batch_size, seq_len, num_tags = scores.shape
+    if sequence_lengths is None:
+        sequence_lengths = np.full([batch_size], seq_len)
+    sequence_lengths = np.asarray(sequence_lengths)
+
+    trellis = np.zeros_like(scores)
+    backpointers = np.zeros(scores.shape, dtype=np.int32)
+    viterbi = np.zeros([batch_size, seq_len], dtype=np.int32)
+    if seq_len == 0:
+        return viterbi, trellis
+
+    trellis[:, 0] = scores[:, 0]
+    no_op_pointers = np.arange(num_tags, dtype=np.int32)
+    min_length = np.min(sequence_lengths)
+    for t in range(1, seq_len):
+        v = np.expand_dims(trellis[:, t - 1], 2) + transition_params
+        trellis[:, t] = scores[:, t] + np.max(v, 1)
+        backpointers[:, t] = np.argmax(v, 1)
+        if t >= min_length:
+            # Past the end of a sequence carry the trellis forward and point each tag at itself.
+            finished = t >= sequence_lengths
+            trellis[finished, t] = trellis[finished, t - 1]
+            backpointers[finished, t] = no_op_pointers
+
+    batch_idxs = np.arange(batch_size)
+    viterbi[:, -1] = np.argmax(trellis[:, -1], -1)
+    for t in range(seq_len - 1, 0, -1):
+        viterbi[:, t - 1] = backpointers[batch_idxs, t, viterbi[:, t]]
+
+    return viterbi, np_softmax(trellis, axis=-1)
+
+
 def sequence_decode(logits, transition_matrix, sequence_length, use_gpu_op, use_crf):
     """ A simple py_func wrapper around the Viterbi decode allowing it to be included in the tensorflow graph. """
     if not use_crf:
@@ -51,13 +97,18 @@ def sequence_decode(logits, transition_matrix, sequence_length, use_gpu_op, use_
         probs = tf.nn.softmax(logits, -1)
         return tags, probs
     else:
-        def _sequence_decode(logits, transition_matrix):
-            all_predictions = []
-            all_logits = []
-            for logit in logits:
-                viterbi_sequence, viterbi_logits = viterbi_decode(logit, transition_matrix)
-                all_predictions.append(viterbi_sequence)
-                all_logits.append(viterbi_logits)
-            return np.array(all_predictions, dtype=np.int32), np.array(all_logits, dtype=np.float32)
-        
-        return tf.compat.v1.py_func(_sequence_decode, [logits, transition_matrix], [tf.int32, tf.float32])
+        def _sequence_decode(logits, transition_matrix, sequence_length):
+            viterbi_sequences, viterbi_logits = viterbi_decode_batch(
+                logits, transition_matrix, sequence_length
+            )
+            return viterbi_sequences, viterbi_logits.astype(np.float32)
+
+        if sequence_length is None:
+            logits_shape = tf.shape(input=logits)
+            sequence_length = tf.fill([logits_shape[0]], logits_shape[1])
+
+        return tf.compat.v1.py_func(
+            _sequence_decode,
+            [logits, transition_matrix, sequence_length],
+            [tf.int32, tf.float32],
+        )
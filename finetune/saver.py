@@ -1,8 +1,10 @@
 import os
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 import sys
+import threading
 import warnings
+import weakref
 import re
 
 import joblib
@@ -14,10 +16,141 @@ from tensorflow_estimator.python.estimator.early_stopping import _StopOnPredicat
 from finetune.errors import FinetuneError
 from finetune.config import get_config
 from finetune.util.metrics import read_eval_metrics
+from finetune.util.weight_file import is_weight_file, read_weight_file, write_weight_file
+from finetune.util.quantization import is_quant_range, quant_range_name, quantize_uint8
 
 LOGGER = logging.getLogger("finetune")
 
 
+def load_weights(path):
+    """
+    Loads a model or base model file saved either with joblib or in the memory mapped format.
+    """
+    if is_weight_file(path):
+        variables, obj = read_weight_file(path)
+        return variables if obj is None else (variables, obj)
+    return joblib.load(path)
+
+
+class RowSparseDelta:
+    """
+    A saved variable stored as the rows that differ from the corresponding base model variable.
+    """
+
+    INDICES_SUFFIX = "/row_delta_indices"
+    ROWS_SUFFIX = "/row_delta_rows"
+
+    def __init__(self, indices, rows):
+        self.indices = indices
+        self.rows = rows
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.rows.nbytes
+
+    def copy(self):
+        return RowSparseDelta(self.indices.copy(), self.rows.copy())
+
+    def apply(self, base):
+        dense = np.array(base, dtype=np.result_type(base, self.rows))
+        dense[self.indices] = self.rows
+        return dense
+
+
+def encode_sparse_deltas(variables):
+    """
+    Flattens RowSparseDelta values into pairs of plain arrays so that they can be written in any file format.
+    """
+    encoded = dict()
+    for name, value in variables.items():
+        if isinstance(value, RowSparseDelta):
+            encoded[name + RowSparseDelta.INDICES_SUFFIX] = value.indices
+            encoded[name + RowSparseDelta.ROWS_SUFFIX] = value.rows
+        else:
+            encoded[name] = value
+    return encoded
+
+
+def decode_sparse_deltas(variables):
+    """
+    Inverse of encode_sparse_deltas.
+    """
+    decoded = dict()
+    for name, value in variables.items():
+        if name.endswith(RowSparseDelta.INDICES_SUFFIX):
+            base_name = name[: -len(RowSparseDelta.INDICES_SUFFIX)]
+            decoded[base_name] = RowSparseDelta(value, variables[base_name + RowSparseDelta.ROWS_SUFFIX])
+        elif not name.endswith(RowSparseDelta.ROWS_SUFFIX):
+            decoded[name] = value
+    return decoded
+
+
+class SharedWeights(dict):
+    """
+    Read-only name -> array mapping of base model weights. A dict subclass so that it can be weakly referenced.
+    """
+
+
+class FallbackRegistry:
+    """
+    Process wide cache of base model weights.
+
+    Every Saver that falls back to the same file shares a single read-only copy of its weights. Entries are
+    weakly referenced, so a file's weights are freed as soon as the last Saver using them is released or
+    garbage collected. Files are keyed on their path, modification time and size, so a base model that is
+    overwritten on disk is reloaded rather than served stale.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = weakref.WeakValueDictionary()
+        self._loading = dict()
+        self._executor = None
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def _load(self, key, path):
+        try:
+            weights = SharedWeights(load_weights(path))
+            for value in weights.values():
+                if isinstance(value, np.ndarray):
+                    value.setflags(write=False)
+            with self._lock:
+                self._loaded[key] = weights
+            return weights
+        finally:
+            with self._lock:
+                del self._loading[key]
+
+    def get(self, path):
+        """
+        :returns: a Future resolving to the SharedWeights of path, loading them in the background if they are not already resident.
+        """
+        key = self._key(path)
+        with self._lock:
+            weights = self._loaded.get(key)
+            if weights is not None:
+                future = Future()
+                future.set_result(weights)
+                return future
+            future = self._loading.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(thread_name_prefix="finetune-fallback")
+                future = self._executor.submit(self._load, key, path)
+                self._loading[key] = future
+            return future
+
+    def __len__(self):
+        return len(self._loaded)
+
+
+FALLBACK_REGISTRY = FallbackRegistry()
+
+
 def should_be_randomly_initialized(name):
     return "OptimizeLoss" in name or "global_step" in name
 
@@ -163,11 +296,22 @@ class Saver:
         restart_global_step=True,
         permit_uninitialized=None,
         add_tokens=None,
+        save_format="joblib",
+        save_sparse_deltas=False,
+        sparse_delta_max_fraction=0.5,
     ):
+        if save_format not in ("joblib", "mmap"):
+            raise FinetuneError("Unknown save_format {}, expected one of 'joblib' or 'mmap'".format(save_format))
+        self.save_format = save_format
+        self.save_sparse_deltas = save_sparse_deltas
+        self.sparse_delta_max_fraction = sparse_delta_max_fraction
         self.variable_transforms = variable_transforms or []
         self.exclude_matches = exclude_matches
         self.variables = None
         self.save_dtype = save_dtype
+        self.fallback_filename = None
+        self.fallback_future = None
+        self.fallback_ = None
         if fallback_filename is not None:
             self.set_fallback(fallback_filename)
         self.restart_global_step = restart_global_step
@@ -175,21 +319,31 @@ class Saver:
         self.add_tokens = add_tokens
 
     def set_fallback(self, fallback_filename):
-        self.tpe = ThreadPoolExecutor()
         if not os.path.exists(fallback_filename):
             raise FileNotFoundError("Error loading base model {} - file not found.".format(fallback_filename))
         self.fallback_filename = fallback_filename
-        self.fallback_future = self.tpe.submit(joblib.load, fallback_filename)
+        self.fallback_future = FALLBACK_REGISTRY.get(fallback_filename)
         self.fallback_ = None
 
     @property
     def fallback(self):
         if self.fallback_ is None:
+            if self.fallback_future is None:
+                # Weights were released, fetch them from the registry again.
+                self.fallback_future = FALLBACK_REGISTRY.get(self.fallback_filename)
             self.fallback_ = self.fallback_future.result()
             self.fallback_future = None
-            self.tpe.shutdown()
         return self.fallback_
 
+    def release(self):
+        """
+        Drops this saver's references to model and base model weights once they have been loaded into a session.
+        Base model weights stay resident for as long as any other saver holds them.
+        """
+        self.variables = None
+        self.fallback_ = None
+        self.fallback_future = None
+
     def get_saver_hook(
         self,
         estimator,
@@ -224,7 +378,8 @@ class Saver:
         else:
             variables = self.variables
 
-        names, values = variables.keys(), variables.values()
+        names = list(variables.keys())
+        values = [self.materialize(name, value) for name, value in variables.items()]
         if isinstance(path, str):
             folder = os.path.dirname(path)
             os.makedirs(folder, exist_ok=True)
@@ -237,10 +392,15 @@ class Saver:
         )
         var_dict = dict(zip(var_names_reduced, vals_reduced))
         assert len(vals_reduced) == len(var_names_reduced) == len(var_dict)
-        joblib.dump((var_dict, finetune_obj), path)
+        var_dict = encode_sparse_deltas(var_dict)
+        if self.save_format == "mmap" and isinstance(path, (str, os.PathLike)):
+            write_weight_file(path, var_dict, finetune_obj)
+        else:
+            joblib.dump((var_dict, finetune_obj), path)
 
     def load(self, path):
-        self.variables, finetune_obj = joblib.load(path)
+        variables, finetune_obj = load_weights(path)
+        self.variables = decode_sparse_deltas(variables)
         finetune_obj.config = get_config(
             error_on_invalid_keywords=False, 
             **dict(finetune_obj.config)
@@ -258,6 +418,7 @@ class Saver:
             else:
                 variables_sv = dict()
             all_vars = tf.compat.v1.global_variables()
+            vars_by_name = {var.name: var for var in all_vars}
 
             global_step_var = tf.compat.v1.train.get_global_step()
 
@@ -265,9 +426,12 @@ class Saver:
                 if self.restart_global_step and global_step_var is not None and global_step_var.name == var.name:
                     continue
                 name = var.name
+                if is_quant_range(name):
+                    # Loaded along with the kernel it belongs to.
+                    continue
                 saved_var = None
                 if name in variables_sv.keys():
-                    saved_var = variables_sv[name]
+                    saved_var = self.materialize(name, variables_sv[name])
                 elif name in self.fallback.keys():
                     saved_var = self.fallback[name]
                 if saved_var is not None:
@@ -278,6 +442,10 @@ class Saver:
                             saved_var = np.concatenate((saved_var, new_rows), axis=0)
                     for func in self.variable_transforms:
                         saved_var = func(name, saved_var)
+                    if var.dtype.base_dtype == tf.uint8 and saved_var.dtype != np.uint8:
+                        # Kernel of a layer built for int8_predict, quantize the float weights as they are loaded.
+                        saved_var, value_range = quantize_uint8(saved_var)
+                        var_loader.add(vars_by_name[quant_range_name(name)], value_range)
                     var_loader.add(var, saved_var)
                 else:
                     if name.startswith("model/featurizer"):
@@ -288,20 +456,49 @@ class Saver:
             var_loader.run(session)
         return init_fn
 
+    def materialize(self, name, value):
+        """
+        Returns the dense value of a saved variable, applying it to the base model weights if it is a RowSparseDelta.
+        """
+        if isinstance(value, RowSparseDelta):
+            return value.apply(self.fallback[name])
+        return value
+
+    def _reduce_variable(self, name, value, fallback_vars):
+        """
+        :returns: None if value matches the base model, a RowSparseDelta if few enough rows differ, otherwise value.
+        """
+        fb_var = fallback_vars.get(name)
+        if fb_var is None:
+            return value
+        for func in self.variable_transforms:
+            fb_var = func(name, fb_var)
+        if fb_var.shape != value.shape:
+            return value
+        close = np.isclose(fb_var, value)
+        if close.all():
+            return None
+        if self.save_sparse_deltas and value.ndim > 0 and not self.variable_transforms:
+            changed_rows = np.flatnonzero(~close.reshape(len(close), -1).all(axis=1))
+            if len(changed_rows) <= self.sparse_delta_max_fraction * len(value):
+                return RowSparseDelta(changed_rows, np.ascontiguousarray(value[changed_rows]))
+        return value
+
     def remove_unchanged(self, variable_names, variable_values, fallback_vars):
-        skips = []
-        for var_val, var_name in zip(variable_values, variable_names):
-            skip = False
-            for fb_var_name, fb_var in fallback_vars.items():
-                if fb_var_name == var_name:
-                    for func in self.variable_transforms:
-                        fb_var = func(var_name, fb_var)
-                    if fb_var.shape == var_val.shape and np.allclose(fb_var, var_val):
-                        skip = True
-                        break
-            skips.append(skip)
+        """
+        Drops variables that are unchanged from the base model, and if save_sparse_deltas is set replaces
+        variables with only a few changed rows (eg. embeddings) with a RowSparseDelta.
+        """
+        variable_names = list(variable_names)
+        # Comparisons are dominated by numpy calls which release the GIL, so threads parallelise them well.
+        with ThreadPoolExecutor() as tpe:
+            reduced = list(
+                tpe.map(
+                    lambda name_value: self._reduce_variable(*name_value, fallback_vars),
+                    zip(variable_names, variable_values),
+                )
+            )
         return (
-            [var for skip, var in zip(skips, variable_names) if not skip],
-            [var_val for skip, var_val in zip(skips, variable_values) if not skip],
+            [name for name, value in zip(variable_names, reduced) if value is not None],
+            [value for value in reduced if value is not None],
         )
-
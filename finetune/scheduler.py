@@ -1,6 +1,9 @@
 import gc
 import logging
 import functools
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import psutil
 
@@ -19,51 +22,119 @@ def bytes_to_meg(x):
 def scheduled(fn):
     @functools.wraps(fn)
     def scheduled_predict(self, model_file, x, *args, config_overrides=None, **kwargs):
-        model = self._rotate_in_model(model_file, config_overrides=config_overrides)
-        try:
-            preds = fn(self, model_file=model_file, x=x, *args, model=model, **kwargs)
-        except Exception as orig_except:
-            LOGGER.warning(
-                "Exception '{}' raised. Closing all models and retrying".format(
-                    orig_except
-                )
-            )
-            # Close everything to make sure we have available memory
-            self.close_all()
+        self._wait_for_prefetch(model_file)
+        with self._lock:
+            model = self._rotate_in_model(model_file, config_overrides=config_overrides)
             try:
-                # Reload in preparation for prediction
-                model = self._rotate_in_model(model_file, config_overrides=config_overrides)
-                preds = fn(
-                    self, model_file=model_file, x=x, *args, model=model, **kwargs
-                )
-            except Exception as e:
-                raise FinetuneSchedulerError(
-                    "Original Error: {}, Retry Error: {}".format(
-                        str(orig_except), str(e)
+                preds = fn(self, model_file=model_file, x=x, *args, model=model, **kwargs)
+            except Exception as orig_except:
+                LOGGER.warning(
+                    "Exception '{}' raised. Closing all models and retrying".format(
+                        orig_except
                     )
                 )
-        self._update_memory_limit(model)
-        return preds
+                # Close everything to make sure we have available memory
+                self.close_all()
+                try:
+                    # Reload in preparation for prediction
+                    model = self._rotate_in_model(model_file, config_overrides=config_overrides)
+                    preds = fn(
+                        self, model_file=model_file, x=x, *args, model=model, **kwargs
+                    )
+                except Exception as e:
+                    raise FinetuneSchedulerError(
+                        "Original Error: {}, Retry Error: {}".format(
+                            str(orig_except), str(e)
+                        )
+                    )
+            self._update_memory_limit(model, model_file)
+            return preds
 
     return scheduled_predict
 
 
+def weights_nbytes(variables):
+    return sum(getattr(v, "nbytes", 0) for v in (variables or {}).values())
+
+
+class _CpuEntry:
+    """
+    A model evicted from the GPU tier along with the weights needed to rebuild its session.
+    """
+
+    def __init__(self, model, variables, fallback):
+        self.model = model
+        self.variables = variables
+        self.fallback = fallback
+        self.nbytes = weights_nbytes(variables)
+
+
 class Scheduler:
+    """
+    Serves predictions from many saved models, keeping as many loaded as memory allows.
+
+    Models are cached in two tiers. The GPU tier holds models with a built graph and session. When a model
+    is evicted from it, the deserialized model and its weights move to a CPU tier, so re-activating it only
+    costs session creation rather than reading and unpickling the model file. Eviction from either tier is
+    least recently used ("lru") or least frequently used ("lfu") first. GPU tier admission uses the measured
+    footprint of each model.
+
+    :param max_models: Maximum number of models in the GPU tier, defaults to as many as fit in memory.
+    :param config: Config overrides applied to every model loaded.
+    :param reserved: Bytes of GPU memory to keep free.
+    :param ram_max_frac: Fraction of system RAM above which no more models are loaded and the CPU tier is shrunk,
+        followed by the weights kept for models in the GPU tier.
+    :param eviction_policy: One of "lru" or "lfu".
+    :param max_cpu_models: Maximum number of models in the CPU tier. 0 disables it, defaults to as many as fit in RAM.
+    :param max_cpu_bytes: Maximum bytes of model specific weights held in host RAM, counting both the CPU tier
+        and the weights kept for models in the GPU tier.
+    """
+
     def __init__(
-        self, max_models=None, config=None, reserved=750000000, ram_max_frac=0.8
+        self,
+        max_models=None,
+        config=None,
+        reserved=750000000,
+        ram_max_frac=0.8,
+        eviction_policy="lru",
+        max_cpu_models=None,
+        max_cpu_bytes=None,
     ):
+        if eviction_policy not in ("lru", "lfu"):
+            raise FinetuneSchedulerError(
+                "Unknown eviction_policy {}, expected one of 'lru' or 'lfu'".format(eviction_policy)
+            )
         self.loaded_models = list()
         self.max_models = max_models
         self.gpu_memory_limit = None
         self.model_cache = dict()
+        self.cpu_cache = OrderedDict()
         self.max_above_resting = None
-        self.previous_in_use = 0
         self.max_model_size = None
+        self.footprints = dict()
+        self.use_counts = Counter()
+        self.metrics = Counter()
         self.config = config or {}
         self.reserved = reserved
         self.ram_max_frac = ram_max_frac
+        self.eviction_policy = eviction_policy
+        self.max_cpu_models = max_cpu_models
+        self.max_cpu_bytes = max_cpu_bytes
+        # Weights of models in the GPU tier, kept so that they can move to the CPU tier on eviction.
+        self._resident_weights = dict()
+        self._in_use_before_load = dict()
+        self._lock = threading.RLock()
+        self._prefetch_executor = None
+        self._prefetching = dict()
+        # Models being warmed up by a prefetch outside of the lock, these are never evicted.
+        self._pinned = set()
 
-    def _memory_for_one_more(self):
+    def _expected_footprint(self, model_file=None):
+        if model_file in self.footprints:
+            return self.footprints[model_file]
+        return self.max_model_size or 0
+
+    def _memory_for_one_more(self, model_file=None):
         if self.gpu_memory_limit is None:
             return True # first run
 
@@ -72,23 +143,17 @@ class Scheduler:
         if self.max_above_resting is None or (peak - in_use) > self.max_above_resting:
             self.max_above_resting = peak - in_use
 
-        if (
-            self.max_model_size is None
-            or (in_use - self.previous_in_use) > self.max_model_size
-        ):
-            self.max_model_size = in_use - self.previous_in_use
-
-        self.previous_in_use = in_use
+        model_size = self._expected_footprint(model_file)
         cpu_percent = psutil.virtual_memory().percent
         LOGGER.info(
             (
                 "models loaded: {num_models}, in_use: {in_use}, max_above_resting: {mar},"
-                " max_model_size: {mms}, gpu_memory_limit: {mem_limit}, cpu percent used: {cpu_percent}"
+                " expected_model_size: {mms}, gpu_memory_limit: {mem_limit}, cpu percent used: {cpu_percent}"
             ).format(
                 num_models=len(self.loaded_models),
                 in_use=bytes_to_meg(in_use),
                 mar=bytes_to_meg(self.max_above_resting),
-                mms=bytes_to_meg(self.max_model_size),
+                mms=bytes_to_meg(model_size),
                 mem_limit=bytes_to_meg(self.gpu_memory_limit),
                 cpu_percent=cpu_percent,
             )
@@ -96,49 +161,215 @@ class Scheduler:
         if cpu_percent > self.ram_max_frac * 100:
             return False
         return (
-            in_use + self.max_above_resting + self.max_model_size + self.reserved
+            in_use + self.max_above_resting + model_size + self.reserved
         ) < self.gpu_memory_limit
 
+    def _eviction_order(self, names):
+        # names are ordered least to most recently used.
+        if self.eviction_policy == "lfu":
+            return sorted(names, key=lambda name: self.use_counts[name])
+        return list(names)
+
+    def _evictable_models(self):
+        return [name for name in self.loaded_models if name not in self._pinned]
+
     def _close_oldest_model(self):
-        if len(self.loaded_models):
-            name = self.loaded_models.pop(0)
-            self.model_cache[name].close()
-            del self.model_cache[name]
+        """
+        Evicts one model from the GPU tier into the CPU tier.
+        """
+        evictable = self._evictable_models()
+        if evictable:
+            name = self._eviction_order(evictable)[0]
+            self.loaded_models.remove(name)
+            model = self.model_cache.pop(name)
+            model.close()
+            weights = self._resident_weights.pop(name, None)
+            if weights is not None:
+                self.cpu_cache[name] = _CpuEntry(model, *weights)
+            self.metrics["gpu_evictions"] += 1
+            self._trim_cpu_cache()
             gc.collect()
         else:
             LOGGER.info("No models cached -- cannot remove oldest model.")
 
-    def _rotate_in_model(self, model, config_overrides=None):
+    def _over_ram_budget(self):
+        return (
+            self.max_cpu_bytes is not None
+            and self.cpu_bytes + self.resident_bytes > self.max_cpu_bytes
+        ) or psutil.virtual_memory().percent > self.ram_max_frac * 100
+
+    def _trim_cpu_cache(self):
+        while self.cpu_cache and (
+            (self.max_cpu_models is not None and len(self.cpu_cache) > self.max_cpu_models)
+            or self._over_ram_budget()
+        ):
+            name = self._eviction_order(self.cpu_cache)[0]
+            del self.cpu_cache[name]
+            self.metrics["cpu_evictions"] += 1
+
+        # Once the CPU tier is empty, stop keeping the weights of models in the GPU tier,
+        # those models are then read from disk again if they are evicted and requested later.
+        while self._resident_weights and self._over_ram_budget():
+            resident = [name for name in self.loaded_models if name in self._resident_weights]
+            name = self._eviction_order(resident or list(self._resident_weights))[0]
+            del self._resident_weights[name]
+            self.metrics["resident_weights_dropped"] += 1
+
+    @property
+    def cpu_bytes(self):
+        return sum(entry.nbytes for entry in self.cpu_cache.values())
+
+    @property
+    def resident_bytes(self):
+        return sum(weights_nbytes(variables) for variables, _ in self._resident_weights.values())
+
+    def _has_room(self, model_file):
+        return (
+            self.max_models is None or len(self.loaded_models) < self.max_models
+        ) and self._memory_for_one_more(model_file)
+
+    def _make_room(self, model_file):
+        while self._evictable_models() and not self._has_room(model_file):
+            self._close_oldest_model()
+
+    def _load_model(self, model_file, config_overrides=None):
+        config_overrides = config_overrides or {}
+        merged_config = {**self.config, **config_overrides}
+        return BaseModel.load(model_file, **merged_config)
+
+    def _rotate_in_model(self, model, config_overrides=None, count_use=True):
+        if count_use:
+            self.use_counts[model] += 1
         if model not in self.loaded_models:
-            if (
-                (
-                    self.max_models is not None
-                    and len(self.loaded_models) + 1 > self.max_models
+            self._make_room(model)
+            if model in self.cpu_cache:
+                entry = self.cpu_cache.pop(model)
+                out_model = entry.model
+                out_model.saver.variables = entry.variables
+                out_model.saver.fallback_ = entry.fallback
+                self._resident_weights[model] = (entry.variables, entry.fallback)
+                self.metrics["cpu_hits"] += 1
+            else:
+                self._in_use_before_load[model] = (
+                    BytesInUse() if self.gpu_memory_limit is not None else 0
                 )
-                or not self._memory_for_one_more()
-            ):
-                self._close_oldest_model()
-            config_overrides = config_overrides or {}
-            merged_config = {**self.config, **config_overrides}
-            out_model = BaseModel.load(model, **merged_config)
+                out_model = self._load_model(model, config_overrides=config_overrides)
+                self.metrics["misses"] += 1
             self.model_cache[model] = out_model
         else:
             out_model = self.model_cache[model]
             self.loaded_models.remove(model)  # put it back at the end of the queue
+            self.metrics["gpu_hits"] += 1
 
         self.loaded_models.append(model)
         out_model._cached_predict = True
 
         return out_model
 
-    def _update_memory_limit(self, model):
-        if hasattr(model.saver, "variables"):
-            del model.saver.variables
-            del model.saver.fallback_
+    def _update_memory_limit(self, model, model_file=None):
+        if (
+            self.max_cpu_models != 0
+            and model_file is not None
+            and model_file not in self._resident_weights
+            and model.saver.variables is not None
+        ):
+            self._resident_weights[model_file] = (model.saver.variables, model.saver.fallback)
+        model.saver.release()
+        self._trim_cpu_cache()
         self.gpu_memory_limit = BytesLimit() # delay this so that any options get applied from finetune.
+        if model_file in self._in_use_before_load:
+            footprint = max(BytesInUse() - self._in_use_before_load.pop(model_file), 0)
+            self.footprints[model_file] = footprint
+            self.max_model_size = max(self.footprints.values())
+
+    def prefetch(self, model_files, config_overrides=None, warm_up_input=("warm up",)):
+        """
+        Loads and warms up models on a background thread so that later predictions on them skip loading, graph
+        building and session creation. Models are only prefetched while there is room for them under max_models
+        and the memory budget, loaded models are never evicted to make room for a prefetch.
+
+        :param model_files: A model file or list of model files that are expected to be requested soon.
+        :param config_overrides: Config overrides to load the models with.
+        :param warm_up_input: Input passed to predict to build each model's cached graph.
+        :returns: A list of futures, one per model file, resolving to True if the model was prefetched.
+        """
+        if isinstance(model_files, str):
+            model_files = [model_files]
+        with self._lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="finetune-prefetch"
+                )
+            futures = []
+            for model_file in model_files:
+                future = self._prefetching.get(model_file)
+                if future is None:
+                    future = self._prefetch_executor.submit(
+                        self._prefetch_one, model_file, config_overrides, list(warm_up_input)
+                    )
+                    self._prefetching[model_file] = future
+                    future.add_done_callback(
+                        functools.partial(self._prefetch_done, model_file)
+                    )
+                futures.append(future)
+            return futures
+
+    def _prefetch_done(self, model_file, future):
+        with self._lock:
+            if self._prefetching.get(model_file) is future:
+                del self._prefetching[model_file]
+
+    def _wait_for_prefetch(self, model_file):
+        with self._lock:
+            future = self._prefetching.get(model_file)
+        if future is not None:
+            # Errors are logged by the prefetch itself, the foreground request will retry the load.
+            future.exception()
+
+    def _prefetch_one(self, model_file, config_overrides, warm_up_input):
+        try:
+            with self._lock:
+                if model_file in self.model_cache or not self._has_room(model_file):
+                    return False
+                cached = model_file in self.cpu_cache
+            # Read the model from disk without holding the lock so that foreground predictions can continue.
+            model = None if cached else self._load_model(model_file, config_overrides=config_overrides)
+            with self._lock:
+                if model_file in self.model_cache or not self._has_room(model_file):
+                    return False
+                if cached:
+                    if model_file not in self.cpu_cache:
+                        return False
+                    model = self._rotate_in_model(
+                        model_file, config_overrides=config_overrides, count_use=False
+                    )
+                else:
+                    self._in_use_before_load[model_file] = (
+                        BytesInUse() if self.gpu_memory_limit is not None else 0
+                    )
+                    self.model_cache[model_file] = model
+                    self.loaded_models.append(model_file)
+                    model._cached_predict = True
+                self._pinned.add(model_file)
+                self.metrics["prefetches"] += 1
+            # Build the graph and session without holding the lock, foreground predictions on this model
+            # wait for the prefetch to finish in _wait_for_prefetch.
+            try:
+                model.predict(warm_up_input)
+            except Exception as e:
+                LOGGER.warning("Warm up of prefetched model {} failed: {}".format(model_file, e))
+            finally:
+                with self._lock:
+                    self._pinned.discard(model_file)
+                    self._update_memory_limit(model, model_file)
+            return True
+        except Exception as e:
+            LOGGER.warning("Prefetching model {} failed: {}".format(model_file, e))
+            raise
 
     def close_all(self):
-        while self.loaded_models:
+        # Models pinned by an in progress prefetch are left loaded.
+        while self._evictable_models():
             self._close_oldest_model()
 
     @scheduled
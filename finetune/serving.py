@@ -0,0 +1,114 @@
+"""
+Loader for models exported with BaseModel.export.
+
+The exported model object is only used to tokenize inputs and decode outputs, so that outputs match
+BaseModel.predict exactly. The graph is loaded ready built from the SavedModel: no config is resolved, no
+estimator or training graph is built and no base model weights are downloaded, loaded or merged.
+"""
+import os
+
+import joblib
+import tensorflow as tf
+
+from finetune.errors import FinetuneError
+
+SAVED_MODEL_DIR = "saved_model"
+EXPORTED_MODEL_FILE = "model.jl"
+SERVING_SIGNATURE = "serving_default"
+
+
+class ExportedModel:
+    """
+    Runs predictions with a model exported by `BaseModel.export`.
+
+    Usage:
+        model = ExportedModel.load("exported-model")
+        predictions = model.predict(texts)
+
+    :param model: The unpickled model object, used to tokenize inputs and decode outputs. Its predict methods run
+        through the exported graph, so it can also be passed on to eg. an InferenceEngine.
+    :param session: A tf.compat.v1.Session holding the loaded SavedModel.
+    :param inputs: Dict of feature name -> input tensor of the serving signature.
+    :param outputs: Dict of PredictMode key -> output tensor of the serving signature.
+    """
+
+    def __init__(self, model, session, inputs, outputs):
+        self.model = model
+        self.session = session
+        self.inputs = inputs
+        self.outputs = outputs
+        # The model's own predict methods run through the exported graph rather than an estimator.
+        self.model.set_inference_backend(self._inference)
+
+    @classmethod
+    def load(cls, path, session_config=None):
+        """
+        :param path: Directory written by `BaseModel.export`.
+        :param session_config: Optional tf.compat.v1.ConfigProto for the session, eg. to limit threads.
+        """
+        model = joblib.load(os.path.join(path, EXPORTED_MODEL_FILE))
+        graph = tf.Graph()
+        session = tf.compat.v1.Session(graph=graph, config=session_config)
+        meta_graph = tf.compat.v1.saved_model.loader.load(
+            session, [tf.saved_model.SERVING], os.path.join(path, SAVED_MODEL_DIR)
+        )
+        signature = meta_graph.signature_def[SERVING_SIGNATURE]
+        inputs = {
+            name: graph.get_tensor_by_name(info.name) for name, info in signature.inputs.items()
+        }
+        outputs = {
+            name: graph.get_tensor_by_name(info.name) for name, info in signature.outputs.items()
+        }
+        return cls(model, session, inputs, outputs)
+
+    def _inference(
+        self,
+        zipped_data,
+        predict_keys=None,
+        context=None,
+        update_hook=None,
+        chunked_length=None,
+        list_output=True,
+    ):
+        predict_keys = predict_keys or list(self.outputs)
+        missing = [key for key in predict_keys if key not in self.outputs]
+        if missing:
+            raise FinetuneError("Outputs {} were not exported with this model.".format(missing))
+        fetches = {key: self.outputs[key] for key in predict_keys}
+
+        def predictions():
+            batches = self.model.input_pipeline.get_predict_batches(lambda: iter(zipped_data))
+            for batch in batches:
+                results = self.session.run(
+                    fetches, feed_dict={self.inputs[name]: batch[name] for name in self.inputs}
+                )
+                for i in range(len(batch["length"])):
+                    if len(predict_keys) == 1:
+                        yield results[predict_keys[0]][i]
+                    else:
+                        yield {key: value[i] for key, value in results.items()}
+
+        if list_output:
+            return list(predictions())
+        return predictions()
+
+    def predict(self, *args, **kwargs):
+        return self.model.predict(*args, **kwargs)
+
+    def predict_proba(self, *args, **kwargs):
+        return self.model.predict_proba(*args, **kwargs)
+
+    def featurize(self, *args, **kwargs):
+        return self.model.featurize(*args, **kwargs)
+
+    def featurize_sequence(self, *args, **kwargs):
+        return self.model.featurize_sequence(*args, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -31,6 +31,9 @@ class Classifier(BaseModel):
     :param \**kwargs: key-value pairs of config items to override.
     """
 
+    _cached_featurizer_keys = ("features",)
+    _streaming_predict = True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
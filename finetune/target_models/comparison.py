@@ -83,6 +83,7 @@ class Comparison(Classifier):
     """
 
     defaults = {"chunk_long_sequences": False}
+    _cached_featurizer_keys = None
 
     def __init__(self, **kwargs):
         d = copy.deepcopy(Comparison.defaults)
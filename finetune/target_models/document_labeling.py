@@ -93,6 +93,9 @@ class DocumentPipeline(SequencePipeline):
     def text_to_tokens_mask(self, raw_text=None, **kwargs):
         return super().text_to_tokens_mask(**kwargs)
 
+    def _tokenize_chunks(self, raw_text=None, **kwargs):
+        return super()._tokenize_chunks(**kwargs)
+
     def zip_list_to_dict(self, X, Y=None, context=None):
         assert context is None
         if Y is not None:
@@ -7,7 +7,7 @@ import tensorflow as tf
 
 from finetune.model import PredictMode
 from finetune.nn.crf import sequence_decode
-from finetune.encoding.input_encoder import tokenize_context
+from finetune.encoding.input_encoder import prepare_context, tokenize_context
 from finetune.util.imbalance import compute_class_weights
 from finetune.target_models.sequence_labeling import (
     SequencePipeline,
@@ -49,19 +49,22 @@ class GroupingPipeline(SequencePipeline):
     def __init__(self, config):
         super().__init__(config, multi_label=False)
 
-    def text_to_tokens_mask(self, X, Y=None, context=None):
+    def _tokenize_chunks(self, X, Y=None, context=None):
         pad_token = self.config.pad_token
         out_gen = self._text_to_ids(X, pad_token=pad_token)
+        if context is not None:
+            context = prepare_context(context, self.config)
 
         for out in out_gen:
             feats = {"tokens": out.token_ids}
             if context is not None:
                 tokenized_context = tokenize_context(context, out, self.config)
                 feats["context"] = tokenized_context
+            # empty is always None so that chunks are never filtered.
             if Y is None:
-                yield feats
+                yield feats, None
             if Y is not None:
-                yield feats, self.label_encoder.transform(out, Y)
+                yield (feats, self.label_encoder.transform(out, Y)), None
 
 class JointGroupingPipeline(GroupingPipeline):
     """
@@ -620,7 +623,7 @@ class BROSLabeler(SequenceLabeler):
         raise NotImplementedError
 
     def _predict(self, zipped_data, **kwargs):
-        predictions = list(self.process_long_sequence(zipped_data))
+        predictions = list(self.process_long_sequence(zipped_data, **kwargs))
         return self._predict_decode(zipped_data, predictions, **kwargs)
 
     def _predict_decode(self, zipped_data, predictions, **kwargs):
@@ -769,7 +772,7 @@ class JointBROSLabeler(BROSLabeler, SequenceLabeler):
     def _predict(self, zipped_data, **kwargs):
         # Seperate out predictions for each model
         # This is somewhat horrifying
-        predictions = list(self.process_long_sequence(zipped_data))
+        predictions = list(self.process_long_sequence(zipped_data, **kwargs))
         (token_start_idx, token_end_idx, start_of_doc, end_of_doc, label_seq,
          proba_seq, start, end) = list(zip(*predictions))
         ner_labels, start_token_labels, next_token_labels = list(zip(*label_seq))
@@ -845,7 +848,7 @@ class GroupRelationLabeler(SequenceLabeler):
         raise NotImplementedError
 
     def _predict(self, zipped_data, **kwargs):
-        predictions = list(self.process_long_sequence(zipped_data))
+        predictions = list(self.process_long_sequence(zipped_data, **kwargs))
         return self._predict_decode(zipped_data, predictions, **kwargs)
 
     def _predict_decode(self, zipped_data, predictions, **kwargs):
@@ -968,7 +971,7 @@ class JointGroupRelationLabeler(GroupRelationLabeler, SequenceLabeler):
 
     def _predict(self, zipped_data, **kwargs):
         # Seperate out predictions for each model
-        predictions = list(self.process_long_sequence(zipped_data))
+        predictions = list(self.process_long_sequence(zipped_data, **kwargs))
         (token_start_idx, token_end_idx, start_of_doc, end_of_doc, label_seq,
          proba_seq, start, end) = list(zip(*predictions))
         ner_labels, group_labels = list(zip(*label_seq))
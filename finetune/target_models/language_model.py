@@ -10,6 +10,9 @@ class LanguageModel(Classifier):
     :param \**kwargs: key-value pairs of config items to override.
     """
 
+    _cached_featurizer_keys = None
+    _streaming_predict = False
+
     def predict(self, X, context=None, **kwargs):
         """
         Produces a list of most likely class labels as determined by the fine-tuned model.
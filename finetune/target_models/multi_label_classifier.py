@@ -32,6 +32,9 @@ class MultiLabelClassifier(BaseModel):
     :param \**kwargs: key-value pairs of config items to override.
     """
 
+    _cached_featurizer_keys = ("features",)
+    _streaming_predict = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.threshold_placeholder = None
@@ -25,6 +25,7 @@ class MultiFieldClassifier(Classifier):
     """
 
     defaults = {"chunk_long_sequences": False}
+    _cached_featurizer_keys = None
 
     def __init__(self, **kwargs):
         d = copy.deepcopy(MultiFieldClassifier.defaults)
@@ -83,6 +84,8 @@ class MultiFieldRegressor(Regressor):
     :param \**kwargs: key-value pairs of config items to override.
     """
 
+    _cached_featurizer_keys = None
+
     def _get_input_pipeline(self):
         return MultiFieldRegressionPipeline(self.config)
 
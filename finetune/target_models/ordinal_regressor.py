@@ -30,6 +30,8 @@ class OrdinalRegressor(BaseModel):
     :param \**kwargs: key-value pairs of config items to override.
     """
 
+    _streaming_predict = True
+
     def __init__(self, shared_threshold_weights=True, **kwargs):
         super().__init__(**kwargs)
         self.config.shared_threshold_weights = shared_threshold_weights
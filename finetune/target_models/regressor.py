@@ -21,6 +21,9 @@ class Regressor(BaseModel):
     :param \**kwargs: key-value pairs of config items to override.
     """
 
+    _cached_featurizer_keys = ("features",)
+    _streaming_predict = True
+
     def _get_input_pipeline(self):
         return RegressionPipeline(self.config)
 
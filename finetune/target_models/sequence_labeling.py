@@ -19,7 +19,7 @@ from finetune.encoding.sequence_encoder import finetune_to_indico_sequence
 from finetune.encoding.input_encoder import get_spacy
 from finetune.input_pipeline import BasePipeline
 from finetune.util.metrics import sequences_overlap
-from finetune.encoding.input_encoder import tokenize_context
+from finetune.encoding.input_encoder import prepare_context, tokenize_context
 
 
 class SequencePipeline(BasePipeline):
@@ -48,10 +48,21 @@ class SequencePipeline(BasePipeline):
         If Y is provided, filter out chunks that do not contain any positive
         examples (labels) at a ratio determined by self.config.max_empty_chunk_ratio
         """
+        yield from self._filter_empty_chunks(
+            self._tokenize_chunks(X, Y=Y, context=context)
+        )
+
+    def _tokenize_chunks(self, X, Y=None, context=None):
+        """
+        Yields (example, empty) for every chunk of the document, where empty is None
+        when no labels are provided.
+        """
         pad_token = (
             [self.config.pad_token] if self.multi_label else self.config.pad_token
         )
         out_gen = self._text_to_ids(X, pad_token=pad_token)
+        if context is not None:
+            context = prepare_context(context, self.config)
 
         for out in out_gen:
             feats = {"tokens": out.token_ids}
@@ -59,7 +70,7 @@ class SequencePipeline(BasePipeline):
                 tokenized_context = tokenize_context(context, out, self.config)
                 feats["context"] = tokenized_context
             if Y is None:
-                yield feats
+                yield feats, None
             if Y is not None:
                 min_starts = min(out.token_starts)
                 max_ends = max(out.token_ends)
@@ -69,13 +80,27 @@ class SequencePipeline(BasePipeline):
                     if lab["end"] >= min_starts and lab["start"] <= max_ends
                 ]
                 empty = len(filtered_labels) == 0
-                if (
-                    self.config.filter_empty_examples
-                    or self.empty_ratio > self.config.max_empty_chunk_ratio
-                ) and empty:
-                    continue
-                self._update_empty_ratio(empty)
-                yield feats, self.label_encoder.transform(out, filtered_labels)
+                yield (feats, self.label_encoder.transform(out, filtered_labels)), empty
+
+    def _filter_empty_chunks(self, examples):
+        for example, empty in examples:
+            if empty is None:
+                yield example
+                continue
+            if (
+                self.config.filter_empty_examples
+                or self.empty_ratio > self.config.max_empty_chunk_ratio
+            ) and empty:
+                continue
+            self._update_empty_ratio(empty)
+            yield example
+
+    def _worker_tokenize(self, d):
+        # The empty chunk ratio is tracked across documents so filtering happens in the main process.
+        return list(self._tokenize_chunks(**d))
+
+    def _merge_worker_output(self, examples):
+        return self._filter_empty_chunks(examples)
 
     def _compute_class_counts(self, encoded_dataset):
         counter = Counter()
@@ -210,6 +235,8 @@ class SequenceLabeler(BaseModel):
     """
 
     defaults = {"add_eos_bos_to_chunk": False}
+    _cached_featurizer_keys = ("sequence_features",)
+    _streaming_predict = True
 
     def __init__(self, **kwargs):
         """
@@ -465,6 +492,14 @@ class SequenceLabeler(BaseModel):
 
         return preds
 
+    def _predict_window_iter(self, Xs, context=None, **kwargs):
+        if self.config.max_document_chars:
+            # Documents are split into sub documents before prediction and merged back after,
+            # so these are predicted a window at a time.
+            yield from self.predict(Xs, context=context, **kwargs)
+        else:
+            yield from super()._predict_window_iter(Xs, context=context, **kwargs)
+
     def _predict(
         self, zipped_data, per_token=False, return_negative_confidence=False, **kwargs
     ):
@@ -492,6 +527,164 @@ class SequenceLabeler(BaseModel):
         :param per_token: If True, return raw probabilities and labels on a per token basis
         :returns: list of class labels.
         """
+        if (
+            per_token
+            or self.multi_label
+            or self.config.bio_tagging
+            or self.config.group_bio_tagging
+        ):
+            return self._predict_decode_tokenwise(
+                zipped_data,
+                predictions,
+                per_token=per_token,
+                return_negative_confidence=return_negative_confidence,
+            )
+        return self._predict_decode_vectorized(
+            zipped_data,
+            predictions,
+            return_negative_confidence=return_negative_confidence,
+        )
+
+    def _predict_decode_vectorized(
+        self, zipped_data, predictions, return_negative_confidence=False
+    ):
+        """
+        Equivalent to _predict_decode_tokenwise for single label predictions without BIO tagging,
+        where subtokens with the same label are merged into spans with numpy rather than a python loop.
+        """
+        classes = list(self.input_pipeline.label_encoder.classes_)
+        class_idxs = {label: i for i, label in enumerate(classes)}
+        doc_idx = -1
+        doc_annotations = []
+        raw_text = [data.get("raw_text", data["X"]) for data in zipped_data]
+        for (
+            token_start_idx,
+            token_end_idx,
+            start_of_doc,
+            end_of_doc,
+            label_seq,
+            proba_seq,
+            start,
+            end,
+        ) in predictions:
+            if start_of_doc:
+                doc_label_ids = []
+                doc_starts = []
+                doc_ends = []
+                doc_probs = []
+                doc_level_probas = []
+                doc_idx += 1
+
+            unique_labels, label_ids = np.unique(
+                np.asarray(label_seq[start:end]), return_inverse=True
+            )
+            label_ids = np.asarray(
+                [class_idxs.get(label, -1) for label in unique_labels], dtype=np.int64
+            )[label_ids]
+            proba_seq = np.asarray(proba_seq[start:end])
+            token_ends = np.asarray(token_end_idx[start:end])
+
+            if return_negative_confidence:
+                # Max probability of each class before that class is first predicted in the chunk.
+                n_tokens = len(label_ids)
+                first_predicted = np.full(len(classes), n_tokens)
+                known = label_ids != -1
+                np.minimum.at(
+                    first_predicted, label_ids[known], np.arange(n_tokens)[known]
+                )
+                before_first = np.arange(n_tokens)[:, None] < first_predicted[None, :]
+                doc_level_probas.append(
+                    np.max(
+                        np.where(before_first, proba_seq, np.zeros_like(proba_seq)),
+                        axis=0,
+                    )
+                )
+
+            # token_ends of -1 indicates padding / special tokens
+            not_special = token_ends != -1
+            doc_label_ids.append(label_ids[not_special])
+            doc_starts.append(np.asarray(token_start_idx[start:end])[not_special])
+            doc_ends.append(token_ends[not_special])
+            doc_probs.append(proba_seq[not_special])
+
+            if end_of_doc:
+                doc_subseqs, doc_labels, prob_dicts = self._merge_token_spans(
+                    raw_text[doc_idx],
+                    classes,
+                    np.concatenate(doc_label_ids),
+                    np.concatenate(doc_starts),
+                    np.concatenate(doc_ends),
+                    np.concatenate(doc_probs),
+                )
+                _, doc_annotations_sample = finetune_to_indico_sequence(
+                    raw_texts=[raw_text[doc_idx]],
+                    subseqs=[doc_subseqs],
+                    labels=[doc_labels],
+                    probs=[prob_dicts],
+                    none_value=self.config.pad_token,
+                    subtoken_predictions=self.config.subtoken_predictions,
+                    bio_tagging=False,
+                )
+                if return_negative_confidence:
+                    doc_annotations.append(
+                        {
+                            "prediction": doc_annotations_sample[0],
+                            "negative_confidence": dict(
+                                zip(classes, np.max(doc_level_probas, axis=0))
+                            ),
+                        }
+                    )
+                else:
+                    doc_annotations.append(doc_annotations_sample[0])
+        return doc_annotations
+
+    def _merge_token_spans(self, raw_text, classes, label_ids, starts, ends, probas):
+        """
+        Merges consecutive tokens with the same label into spans, returning the text,
+        label and mean probabilities of each span.
+        """
+        n_tokens = len(label_ids)
+        if n_tokens == 0:
+            return [], [], []
+
+        last_ends = np.concatenate([[0], ends[:-1]])
+        assert np.all(starts >= last_ends), "Start idxs: {}, last_ends: {}".format(
+            starts[starts < last_ends], last_ends[starts < last_ends]
+        )
+        assert np.all(starts <= ends), "Starts: {}, Ends: {}".format(
+            starts[starts > ends], ends[starts > ends]
+        )
+
+        span_starts = np.flatnonzero(
+            np.concatenate([[True], label_ids[1:] != label_ids[:-1]])
+        )
+        span_ends = np.append(span_starts[1:], n_tokens)
+
+        subseqs = [
+            raw_text[span_start:span_end]
+            for span_start, span_end in zip(starts[span_starts], ends[span_ends - 1])
+        ]
+        labels = [classes[label_idx] for label_idx in label_ids[span_starts]]
+        # np.mean per span rather than np.add.reduceat so that probabilities are bit for bit
+        # identical to the tokenwise implementation.
+        prob_dicts = [
+            dict(
+                zip(
+                    self.input_pipeline.label_encoder.classes_,
+                    np.mean(probas[span_start:span_end], axis=0),
+                )
+            )
+            for span_start, span_end in zip(span_starts, span_ends)
+        ]
+        return subseqs, labels, prob_dicts
+
+    def _predict_decode_tokenwise(
+        self,
+        zipped_data,
+        predictions,
+        per_token=False,
+        return_negative_confidence=False,
+    ):
         classes = list(self.input_pipeline.label_encoder.classes_)
         doc_idx = -1
         doc_annotations = []
@@ -0,0 +1,282 @@
+"""
+Engine behind BaseModel.finetune_grid_search and BaseModel.finetune_grid_search_cv.
+
+Trials share tokenization through a TokenCache directory that is filled once before the first trial, so every
+config and every cv split reads the same encoded documents instead of re-tokenizing them. Trials can run in
+parallel worker processes that each own one device, and bad configs can be pruned by successive halving.
+"""
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
+
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+from finetune.config import all_gpus
+from finetune.errors import FinetuneError
+from finetune.util.metrics import read_eval_metrics
+
+LOGGER = logging.getLogger("finetune")
+
+# Populated in each worker process by _init_worker.
+_WORKER_STATE = {}
+
+
+def grid_configs(config):
+    """
+    Expands the GridSearchable items of config into one config per point of the grid.
+    """
+    grid_searchable = config.get_grid_searchable()
+    keys = list(grid_searchable.keys())
+    configs = []
+    for grid_item in itertools.product(*grid_searchable.values()):
+        config_ = deepcopy(config)
+        config_.update(dict(zip(keys, grid_item)))
+        configs.append(config_)
+    return configs
+
+
+def worker_devices(n_workers, devices=None):
+    """
+    Assigns visible gpus to each of n_workers, round robin over devices. Workers get no gpus (CPU only mode)
+    when there are none available.
+    """
+    if devices is None:
+        devices = all_gpus()
+    if not devices:
+        return [[] for _ in range(n_workers)]
+    return [[devices[i % len(devices)]] for i in range(n_workers)]
+
+
+def _split_data(data, idxs):
+    Xs, Y = data
+    return [[x[i] for i in idxs] for x in Xs], [Y[i] for i in idxs]
+
+
+def _final_val_loss(model):
+    # Validation loss logged during training by the estimator's evaluation, as read by SaverHook.
+    eval_results = read_eval_metrics(os.path.join(model.estimator_dir, "eval"))
+    losses = [metrics["loss"] for metrics in eval_results.values() if "loss" in metrics]
+    return min(losses) if losses else None
+
+
+def warm_token_cache(cls, config, data):
+    """
+    Tokenizes every document once so that trials read their encoded documents from config.tokenize_cache_dir.
+    """
+    Xs, _ = data
+    model = cls(**config)
+    pipeline = model.input_pipeline
+    docs = Xs[0] if len(Xs) == 1 else list(zip(*Xs))
+    for item in pipeline.zip_list_to_dict(X=docs):
+        for _ in pipeline._text_to_ids(item["X"]):
+            pass
+    return pipeline.token_cache.stats()
+
+
+def run_trial(cls, config, data, split, eval_fn=None, probs=False):
+    """
+    Trains a model with config on the train half of split and evaluates it on the test half.
+
+    :returns: (eval_fn output, lowest logged validation loss or None if validation was not run)
+    """
+    train_idxs, test_idxs = split
+    trainXs, trainY = _split_data(data, train_idxs)
+    testXs, testY = _split_data(data, test_idxs)
+    eval_fn = eval_fn or cls.get_eval_fn()
+
+    model = cls(**config)
+    model.finetune(*trainXs, Y=trainY)
+    val_loss = _final_val_loss(model)
+    if probs:
+        res = model.predict_proba(*testXs)
+    else:
+        res = model.predict(*testXs)
+    score = eval_fn(res, testY)
+    del model
+    return score, val_loss
+
+
+def _init_worker(device_queue, data):
+    _WORKER_STATE["visible_gpus"] = device_queue.get()
+    _WORKER_STATE["data"] = data
+
+
+def _worker_warm_token_cache(cls, config):
+    config = dict(config, visible_gpus=_WORKER_STATE["visible_gpus"])
+    return warm_token_cache(cls, config, _WORKER_STATE["data"])
+
+
+def _worker_run_trial(cls, config, split, eval_fn, probs):
+    config = dict(config, visible_gpus=_WORKER_STATE["visible_gpus"])
+    return run_trial(cls, config, _WORKER_STATE["data"], split, eval_fn=eval_fn, probs=probs)
+
+
+class TrialRunner:
+    """
+    Runs grid search trials either in process, or in a pool of n_workers spawned processes. The data is sent
+    to each worker once when it starts, trials only send their config and the indices of their split.
+
+    :param cls: The model class to search over.
+    :param data: (Xs, Y), where Xs is [sequence, num_samples].
+    :param eval_fn: Must be picklable when n_workers > 1. None uses cls.get_eval_fn().
+    :param n_workers: Number of trials to run at once.
+    :param devices: GPU ids to spread workers across, defaults to all available gpus.
+    """
+
+    def __init__(self, cls, data, eval_fn=None, probs=False, n_workers=1, devices=None):
+        self.cls = cls
+        self.data = data
+        self.eval_fn = eval_fn
+        self.probs = probs
+        self.executor = None
+        if n_workers > 1:
+            ctx = multiprocessing.get_context("spawn")
+            device_queue = ctx.Queue()
+            for visible_gpus in worker_devices(n_workers, devices):
+                device_queue.put(visible_gpus)
+            self.executor = ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=ctx,
+                initializer=_init_worker,
+                initargs=(device_queue, data),
+            )
+
+    def warm_token_cache(self, config):
+        if self.executor is None:
+            return warm_token_cache(self.cls, config, self.data)
+        return self.executor.submit(_worker_warm_token_cache, self.cls, config).result()
+
+    def run(self, configs, split):
+        """
+        :returns: A list of (score, val_loss) for each config, in order.
+        """
+        if self.executor is None:
+            return [
+                run_trial(self.cls, config, self.data, split, eval_fn=self.eval_fn, probs=self.probs)
+                for config in configs
+            ]
+        futures = [
+            self.executor.submit(_worker_run_trial, self.cls, config, split, self.eval_fn, self.probs)
+            for config in configs
+        ]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def _reduced_budget(config, fraction):
+    n_epochs = config["n_epochs"]
+    if isinstance(n_epochs, int):
+        n_epochs = max(1, int(round(n_epochs * fraction)))
+    else:
+        # "auto" is resolved from the dataset size inside the model, fall back to the smallest budget.
+        n_epochs = 1
+    return dict(config, n_epochs=n_epochs)
+
+
+def _prune_ranking(results):
+    # Rank on validation loss when every trial logged one, otherwise on the held out eval_fn score.
+    if all(val_loss is not None for _, val_loss in results):
+        return sorted(range(len(results)), key=lambda i: results[i][1])
+    return sorted(range(len(results)), key=lambda i: -results[i][0])
+
+
+def successive_halving(runner, configs, split, halving_rounds=0, halving_eta=3):
+    """
+    Evaluates configs on split. For each of halving_rounds, the surviving configs are trained with
+    1 / halving_eta ** (rounds remaining) of their epochs and only the best 1 / halving_eta are kept. Survivors
+    are then trained with their full budget.
+
+    :returns: A score for each config, None for configs that were pruned.
+    """
+    scores = [None] * len(configs)
+    alive = list(range(len(configs)))
+    for round_idx in range(halving_rounds):
+        if len(alive) <= 1:
+            break
+        fraction = halving_eta ** (round_idx - halving_rounds)
+        results = runner.run([_reduced_budget(configs[i], fraction) for i in alive], split)
+        n_keep = max(1, math.ceil(len(alive) / halving_eta))
+        alive = sorted(alive[i] for i in _prune_ranking(results)[:n_keep])
+        LOGGER.info(
+            "Successive halving round {}: keeping {} of {} configs".format(round_idx, n_keep, len(results))
+        )
+
+    for i, (score, _) in zip(alive, runner.run([configs[i] for i in alive], split)):
+        scores[i] = score
+    return scores
+
+
+@contextmanager
+def _shared_token_cache(configs):
+    if all(config["tokenize_cache_dir"] is not None for config in configs):
+        yield configs
+        return
+    with tempfile.TemporaryDirectory() as cache_dir:
+        yield [
+            dict(config, tokenize_cache_dir=config["tokenize_cache_dir"] or cache_dir)
+            for config in configs
+        ]
+
+
+def grid_search(
+    cls,
+    Xs,
+    Y,
+    config,
+    *,
+    n_splits,
+    test_size,
+    eval_fn=None,
+    probs=False,
+    n_workers=1,
+    devices=None,
+    halving_rounds=0,
+    halving_eta=3,
+):
+    """
+    Runs every config of the grid defined by config on n_splits random train / test splits of the data.
+
+    :returns: A list with an entry for each config of the grid, [config, [score for each split]]. Scores are None
+        for splits in which the config was pruned.
+    """
+    if halving_eta < 2:
+        raise FinetuneError("halving_eta must be at least 2, got {}".format(halving_eta))
+    Xs = [list(x) for x in Xs]
+    Y = list(Y)
+    configs = grid_configs(config)
+    splits = [
+        train_test_split(np.arange(len(Y)), test_size=test_size, shuffle=True)
+        for _ in range(n_splits)
+    ]
+    scores = []
+    with _shared_token_cache(configs) as trial_configs:
+        runner = TrialRunner(
+            cls, (Xs, Y), eval_fn=eval_fn, probs=probs, n_workers=n_workers, devices=devices
+        )
+        try:
+            stats = runner.warm_token_cache(trial_configs[0])
+            LOGGER.info("Tokenized grid search data once: {}".format(stats))
+            for split in splits:
+                scores.append(
+                    successive_halving(
+                        runner,
+                        trial_configs,
+                        split,
+                        halving_rounds=halving_rounds,
+                        halving_eta=halving_eta,
+                    )
+                )
+        finally:
+            runner.close()
+    return [(config_, list(split_scores)) for config_, split_scores in zip(configs, zip(*scores))]
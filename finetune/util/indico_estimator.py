@@ -51,16 +51,32 @@ class IndicoEstimator(tf.estimator.Estimator):
 
     def cached_predict(
         self,
-        input_fn,
+        input_fn=None,
         predict_keys=None,
         hooks=None,
         checkpoint_path=None,
         yield_single_examples=True,
+        features=None,
+        feature_spec=None,
     ):
+        """
+        Predict while keeping the graph and session alive between calls.
+
+        Inputs are either an input_fn, which is run to completion in a throwaway graph, or an
+        iterable of numpy feature dicts along with feature_spec, a tuple of (types, shapes) for
+        those dicts. The latter is fed straight into the placeholders batch by batch.
+        """
         # Check that model has been trained.
         self.g = self.g or tf.Graph()
         tf.compat.v1.set_random_seed(self._config.tf_random_seed)
-        features_real, features = self.get_features_from_fn(input_fn)
+        if features is not None:
+            features_real = features
+            types, shapes = feature_spec
+            features = {
+                k: tf.TensorSpec(shape=shapes[k], dtype=types[k]) for k in types
+            }
+        else:
+            features_real, features = self.get_features_from_fn(input_fn)
         with self.g.as_default():
             if self.estimator_spec is None:
                 self._create_and_assert_global_step(self.g)
@@ -1,5 +1,6 @@
 import math
 
+import numpy as np
 import tensorflow as tf
 
 from finetune.util.timing import ProgressBar
@@ -61,20 +62,120 @@ def add_length(x, y=None):
     return x
 
 
-def batch_dataset(dataset, batch_size, shapes, n_epochs=1):
+def bucket_settings(max_length, batch_size, max_tokens_per_batch=None, min_bucket_length=8):
+    """
+    Bucket boundaries for bucket_by_sequence_length, doubling from min_bucket_length up to max_length,
+    along with a batch size for each bucket.
+
+    If max_tokens_per_batch is provided each bucket gets as many sequences as fit in the token budget
+    when padded to the longest sequence the bucket can hold, otherwise every bucket uses batch_size.
+    """
+    boundaries = []
+    boundary = min_bucket_length
+    while boundary < max_length:
+        boundaries.append(boundary)
+        boundary *= 2
+
+    if max_tokens_per_batch is None:
+        return boundaries, [batch_size] * (len(boundaries) + 1)
+
+    # Bucket i holds sequences of length boundaries[i - 1] <= length < boundaries[i]
+    bucket_max_lengths = [b - 1 for b in boundaries] + [max_length]
+    batch_sizes = [max(1, max_tokens_per_batch // l) for l in bucket_max_lengths]
+    return boundaries, batch_sizes
+
+
+def n_bucketed_batches(lengths, boundaries, batch_sizes):
+    """
+    The number of batches bucket_by_sequence_length produces for a single pass over sequences of the given lengths.
+    """
+    bucket_ids = np.searchsorted(boundaries, lengths, side="right")
+    counts = np.bincount(bucket_ids, minlength=len(batch_sizes))
+    return int(sum(math.ceil(c / b) for c, b in zip(counts, batch_sizes)))
+
+
+def example_length(example):
+    if isinstance(example, tuple):
+        example = example[0]
+    return len(example["tokens"])
+
+
+def token_budget_batches(examples, max_tokens_per_batch, max_batch_size=None):
+    """
+    Groups consecutive examples into lists such that each batch, padded to its longest member,
+    holds at most max_tokens_per_batch tokens. Order is preserved, so this works best on inputs
+    that have already been sorted by length.
+    """
+    batch = []
+    batch_max_length = 0
+    for example in examples:
+        length = example_length(example)
+        new_max_length = max(batch_max_length, length)
+        if batch and (
+            new_max_length * (len(batch) + 1) > max_tokens_per_batch
+            or (max_batch_size is not None and len(batch) >= max_batch_size)
+        ):
+            yield batch
+            batch = []
+            new_max_length = length
+        batch.append(example)
+        batch_max_length = new_max_length
+    if batch:
+        yield batch
+
+
+def pad_batch(examples, types):
+    """
+    Numpy equivalent of padded_batch for a list of feature dicts, pads every dimension
+    of each feature to the largest in the batch with zeros.
+    """
+    batch = {}
+    for key, dtype in types.items():
+        values = [np.asarray(example[key]) for example in examples]
+        max_shape = np.max([v.shape for v in values], axis=0)
+        padded = np.zeros((len(values),) + tuple(max_shape), dtype=dtype.as_numpy_dtype)
+        for i, value in enumerate(values):
+            padded[(i,) + tuple(slice(0, d) for d in value.shape)] = value
+        batch[key] = padded
+    batch["length"] = np.asarray(
+        [example_length(example) for example in examples], dtype=np.int32
+    )
+    return batch
+
+
+def batch_dataset(
+    dataset,
+    batch_size,
+    shapes,
+    n_epochs=1,
+    bucket_boundaries=None,
+    bucket_batch_sizes=None,
+):
     if isinstance(shapes, tuple):
         shapes = ({**shapes[0], "length": tf.TensorShape([])}, shapes[1])
     else:
         shapes = {**shapes, "length": tf.TensorShape([])}
 
+    def element_length(x, *_):
+        return x["length"]
+
     def batched_dataset():
-        return (
-            dataset()
-            .map(add_length)
-            .padded_batch(batch_size, padded_shapes=shapes, drop_remainder=False)
-            .repeat(n_epochs)
-            .prefetch(tf.data.experimental.AUTOTUNE)
-        )
+        with_length = dataset().map(add_length)
+        if bucket_boundaries is not None:
+            batched = with_length.apply(
+                tf.data.experimental.bucket_by_sequence_length(
+                    element_length,
+                    bucket_boundaries=bucket_boundaries,
+                    bucket_batch_sizes=bucket_batch_sizes,
+                    padded_shapes=shapes,
+                    drop_remainder=False,
+                )
+            )
+        else:
+            batched = with_length.padded_batch(
+                batch_size, padded_shapes=shapes, drop_remainder=False
+            )
+        return batched.repeat(n_epochs).prefetch(tf.data.experimental.AUTOTUNE)
 
     return batched_dataset
 
@@ -136,6 +237,16 @@ def wrap_tqdm(
     return internal_gen
 
 
+def context_width_for_recompute_factor(max_length, recompute_factor):
+    """
+    The largest total_context_width for which a Chunker runs each token through the model at most
+    recompute_factor times on average, ie. chunk_size / useful_chunk_width <= recompute_factor.
+    """
+    chunk_size = max_length - 2
+    useful_chunk_width = min(chunk_size, math.ceil(chunk_size / recompute_factor))
+    return chunk_size - useful_chunk_width
+
+
 class Chunker:
     def __init__(self, max_length, total_context_width, justify="c"):
         if total_context_width is None:
@@ -158,14 +269,35 @@ class Chunker:
 
         self.normal_end = self.normal_start + self.useful_chunk_width
 
+    @property
+    def recompute_factor(self):
+        """
+        Average number of times each token of a long document is run through the model.
+        """
+        return self.chunk_size / self.useful_chunk_width
+
+    def chunk_bounds(self, length):
+        """
+        Computes the chunks of a sequence of length tokens all at once.
+
+        :return: int arrays (starts, ends, useful_starts, useful_ends), with an entry for each chunk.
+        """
+        if length <= 0:
+            empty = np.zeros([0], dtype=np.int64)
+            return empty, empty, empty, empty
+        # The last chunk is the first one that reaches the end of the sequence.
+        n_chunks = max(0, math.ceil((length - self.chunk_size) / self.useful_chunk_width)) + 1
+        starts = np.arange(n_chunks, dtype=np.int64) * self.useful_chunk_width
+        ends = starts + self.chunk_size
+        useful_starts = np.full(n_chunks, self.normal_start, dtype=np.int64)
+        useful_ends = np.full(n_chunks, self.normal_end, dtype=np.int64)
+        useful_starts[0] = 0
+        useful_ends[-1] = self.max_length
+        return starts, ends, useful_starts, useful_ends
+
     def generate_chunks(self, length):
-        for start in range(0, length, self.useful_chunk_width):
-            end = start + self.chunk_size
-            is_start = start == 0
-            is_end = end >= length
-            yield start, end, self.useful_chunk_section(is_start, is_end)
-            if is_end:
-                break
+        for start, end, useful_start, useful_end in zip(*self.chunk_bounds(length)):
+            yield int(start), int(end), (int(useful_start), int(useful_end))
 
     def useful_chunk_section(self, start_of_doc, end_of_doc):
         start = self.normal_start
@@ -175,3 +307,46 @@ class Chunker:
         if end_of_doc:
             end = self.max_length
         return start, end
+
+
+def chunk_windows(value, starts, ends, add_eos_bos=False):
+    """
+    Slices value[start:end] for every chunk of Chunker.chunk_bounds. All chunks are views into a single
+    preallocated [n_chunks, longest chunk + 2] array rather than separately allocated arrays.
+
+    :param add_eos_bos: If True, chunks that do not already start with the first element of value are prefixed
+        with it, and chunks that do not already end with the last element of value are suffixed with it.
+    :return: (list of chunks, bool array of which chunks were prefixed)
+    """
+    value = np.asarray(value)
+    length = len(value)
+    n_chunks = len(starts)
+    if length == 0:
+        # An empty document has no first or last element to add.
+        return [value[:0] for _ in range(n_chunks)], np.zeros(n_chunks, dtype=bool)
+    ends = np.minimum(ends, length)
+    lengths = ends - starts
+    width = int(lengths.max()) if n_chunks else 0
+    windows = np.empty([n_chunks, width + 2], dtype=value.dtype)
+    # Chunks are evenly spaced, so the full width ones (all but the last few) are the rows of a strided view.
+    n_full = int(np.sum(lengths == width))
+    if n_full:
+        step = int(starts[1] - starts[0]) if n_full > 1 else 0
+        windows[:n_full, 1 : width + 1] = np.lib.stride_tricks.as_strided(
+            value[starts[0] :],
+            shape=(n_full, width),
+            strides=(step * value.strides[0], value.strides[0]),
+            writeable=False,
+        )
+    for i in range(n_full, n_chunks):
+        windows[i, 1 : lengths[i] + 1] = value[starts[i] : ends[i]]
+    if add_eos_bos:
+        prefixed = value[starts] != value[0]
+        suffixed = value[ends - 1] != value[-1]
+        windows[:, 0] = value[0]
+        windows[np.arange(n_chunks), lengths + 1] = value[-1]
+    else:
+        prefixed = suffixed = np.zeros(n_chunks, dtype=bool)
+    firsts = 1 - prefixed
+    lasts = 1 + lengths + suffixed
+    return [windows[i, first:last] for i, (first, last) in enumerate(zip(firsts, lasts))], prefixed
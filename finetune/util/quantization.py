@@ -0,0 +1,135 @@
+"""
+Post-training int8 inference for the dense layers of the featurizers.
+
+While int8_inference is active, the dense layers of the BERT and GPT2 featurizers create their kernels as uint8
+variables alongside a float [min, max] range variable named "<kernel name>_quant_range". Saver quantizes the
+float weights it loads into these variables, so models are saved, trained and shipped in float32 as before.
+At run time activations are quantized per batch with their observed range, multiplied against the uint8 kernels
+with QuantizedMatMul (int32 accumulation), and dequantized back to float32.
+"""
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+
+from finetune.util.shapes import shape_list
+
+QUANT_RANGE_SUFFIX = "_quant_range"
+_STATE = threading.local()
+
+
+@contextmanager
+def int8_inference(enabled=True):
+    """
+    Dense layers built within this context, in this thread, use int8 weights and activations.
+    """
+    previous = int8_inference_enabled()
+    _STATE.enabled = enabled
+    try:
+        yield
+    finally:
+        _STATE.enabled = previous
+
+
+def int8_inference_enabled():
+    return getattr(_STATE, "enabled", False)
+
+
+def quant_range_name(name):
+    """
+    Name of the range variable of a quantized kernel, eg. a/kernel:0 -> a/kernel_quant_range:0
+    """
+    base, sep, idx = name.rpartition(":")
+    if not sep:
+        return name + QUANT_RANGE_SUFFIX
+    return "{}{}:{}".format(base, QUANT_RANGE_SUFFIX, idx)
+
+
+def is_quant_range(name):
+    return name.rpartition(":")[0].endswith(QUANT_RANGE_SUFFIX) or name.endswith(QUANT_RANGE_SUFFIX)
+
+
+def quantize_uint8(value):
+    """
+    Quantizes a float array to uint8 with a single range for the whole tensor, matching the MIN_FIRST scheme
+    that QuantizedMatMul expects. The range always includes 0 so that it is exactly representable.
+
+    :returns: (uint8 array, float32 array [min, max])
+    """
+    value = np.asarray(value, dtype=np.float32)
+    min_value = min(float(value.min()), 0.0) if value.size else 0.0
+    max_value = max(float(value.max()), 0.0) if value.size else 0.0
+    if max_value - min_value < 1e-6:
+        max_value = min_value + 1e-6
+    scale = 255.0 / (max_value - min_value)
+    quantized = np.round(value * scale) - np.round(min_value * scale)
+    return (
+        np.clip(quantized, 0, 255).astype(np.uint8),
+        np.array([min_value, max_value], dtype=np.float32),
+    )
+
+
+def quantized_kernel(name, shape):
+    """
+    Creates the uint8 kernel and range variables that Saver fills from a float kernel called name.
+    """
+    kernel = tf.compat.v1.get_variable(
+        name, shape, dtype=tf.uint8, initializer=tf.compat.v1.zeros_initializer(), trainable=False
+    )
+    kernel_range = tf.compat.v1.get_variable(
+        name + QUANT_RANGE_SUFFIX,
+        [2],
+        dtype=tf.float32,
+        initializer=tf.compat.v1.zeros_initializer(),
+        trainable=False,
+    )
+    return kernel, kernel_range
+
+
+def int8_matmul(x, kernel, kernel_range):
+    """
+    Computes x @ kernel for a float [batch, nx] x and a uint8 [nx, nf] kernel, quantizing x dynamically.
+    """
+    x_min = tf.minimum(tf.reduce_min(input_tensor=x), 0.0)
+    x_max = tf.maximum(tf.maximum(tf.reduce_max(input_tensor=x), 0.0), x_min + 1e-6)
+    x_quantized, x_min, x_max = tf.quantization.quantize(x, x_min, x_max, tf.quint8, mode="MIN_FIRST")
+    output, output_min, output_max = tf.raw_ops.QuantizedMatMul(
+        a=x_quantized,
+        b=tf.bitcast(kernel, tf.quint8),
+        min_a=x_min,
+        max_a=x_max,
+        min_b=kernel_range[0],
+        max_b=kernel_range[1],
+        Toutput=tf.qint32,
+    )
+    return tf.quantization.dequantize(output, output_min, output_max, mode="MIN_FIRST")
+
+
+def dense(inputs, units, activation=None, name=None, kernel_initializer=None, use_bias=True):
+    """
+    Drop in replacement for tf.compat.v1.layers.dense that builds an int8 layer under int8_inference.
+    Variable names match those of tf.compat.v1.layers.dense.
+    """
+    if not int8_inference_enabled():
+        return tf.compat.v1.layers.dense(
+            inputs,
+            units,
+            activation=activation,
+            name=name,
+            kernel_initializer=kernel_initializer,
+            use_bias=use_bias,
+        )
+    with tf.compat.v1.variable_scope(name, default_name="dense"):
+        *start, _ = shape_list(inputs)
+        nx = int(inputs.shape[-1])
+        kernel, kernel_range = quantized_kernel("kernel", [nx, units])
+        outputs = int8_matmul(tf.reshape(inputs, [-1, nx]), kernel, kernel_range)
+        if use_bias:
+            outputs += tf.compat.v1.get_variable(
+                "bias", [units], initializer=tf.compat.v1.zeros_initializer()
+            )
+        outputs = tf.reshape(outputs, start + [units])
+        if activation is not None:
+            outputs = activation(outputs)
+        return outputs
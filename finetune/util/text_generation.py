@@ -1,6 +1,8 @@
+import numpy as np
 import tensorflow as tf
 
 from finetune.util.shapes import shape_list
+from finetune.util.beam_search import beam_search, top_k_logits
 
 
 def sample_with_temperature(logits, temperature):
@@ -20,3 +22,156 @@ def sample_with_temperature(logits, temperature):
         choices = tf.random.categorical(logits=reshaped_logits, num_samples=1)
         choices = tf.reshape(choices, logits_shape[:-1])
         return choices
+
+
+def _left_pad_positions(key_mask):
+    # Positions count from the first real token of each row, so left padding does not shift them.
+    return tf.maximum(tf.cumsum(tf.cast(key_mask, tf.int32), axis=1) - 1, 0)
+
+
+def kv_cached_generate(
+    incremental_featurizer,
+    tokens,
+    lengths,
+    max_new_tokens,
+    *,
+    encoder,
+    config,
+    temperature=1.0,
+    top_k=0,
+    beam_size=1,
+    beam_alpha=0.0,
+    use_extra_toks=True,
+):
+    """
+    Builds a graph that continues a batch of prompts with a language model, keeping the attention keys and values
+    of earlier positions between steps so that each step only runs the featurizer over the newest token.
+
+    :param incremental_featurizer: The incremental_featurizer of the base model.
+    :param tokens: [batch, prompt_length] int32 prompts, left padded.
+    :param lengths: [batch] int32 number of real tokens in each prompt, at least 1.
+    :param max_new_tokens: Scalar, the number of tokens to generate for each prompt.
+    :param temperature: Sampling temperature, 0.0 for greedy decoding. Ignored by beam search.
+    :param top_k: If > 0, only sample from the top_k most likely tokens. Ignored by beam search.
+    :param beam_size: Beam search is used when > 1.
+    :param beam_alpha: Length penalty of beam search.
+    :param use_extra_toks: If False, the start, delimiter and end tokens are never generated.
+    :return: [batch, max_new_tokens] int32 generated tokens. Rows that emit the end token are padded with it.
+    """
+    batch_size, prompt_length = shape_list(tokens)
+    key_mask = tf.cast(
+        tf.range(prompt_length)[None, :] >= (prompt_length - lengths)[:, None], tf.float32
+    )
+    positions = _left_pad_positions(key_mask)
+
+    logit_mask = np.zeros([encoder.vocab_size], dtype=np.float32)
+    if not use_extra_toks:
+        for token in [encoder.start_token, encoder.delimiter_token, encoder.end_token]:
+            logit_mask[token] = -1e10
+
+    def step(last_token, position, past, key_mask):
+        # Rows that finished early can run past the last position embedding, their outputs are discarded.
+        position = tf.minimum(position, config.max_length - 1)
+        state = incremental_featurizer(
+            last_token[:, None],
+            position[:, None],
+            past,
+            key_mask,
+            encoder=encoder,
+            config=config,
+        )
+        hidden = state["sequence_features"][:, -1]
+        embed_weights = state["embed_weights"][: encoder.vocab_size]
+        logits = tf.matmul(hidden, embed_weights, transpose_b=True) + logit_mask
+        return logits, tf.concat([past, state["present"]], axis=-2)
+
+    # The prompt, but for its last token, is run in a single pass to fill the cache. The last token is the input
+    # of the first decoding step.
+    past = incremental_featurizer(
+        tokens[:, :-1],
+        positions[:, :-1],
+        None,
+        key_mask[:, :-1],
+        encoder=encoder,
+        config=config,
+    )["present"]
+    last_token = tokens[:, -1]
+    position = positions[:, -1]
+
+    if beam_size > 1:
+
+        def symbols_to_logits_fn(ids, i, states, first=False):
+            key_mask = tf.concat([states["key_mask"][:, :, 0], tf.ones_like(ids[:, -1:], tf.float32)], 1)
+            logits, past = step(ids[:, -1], states["position"], states["past"], key_mask)
+            return logits, {
+                "past": past,
+                "key_mask": key_mask[:, :, None],
+                "position": states["position"] + 1,
+            }
+
+        beams, scores, _ = beam_search(
+            symbols_to_logits_fn=symbols_to_logits_fn,
+            initial_ids=last_token,
+            beam_size=beam_size,
+            decode_length=max_new_tokens,
+            vocab_size=encoder.vocab_size,
+            alpha=beam_alpha,
+            states={"past": past, "key_mask": key_mask[:, :-1, None], "position": position},
+            eos_id=encoder.end_token,
+            stop_early=True,
+            use_top_k_with_unique=False,
+        )
+        best_beam = tf.argmax(scores, -1, output_type=tf.int32)
+        generated = tf.gather_nd(beams, tf.stack([tf.range(batch_size), best_beam], -1))[:, 1:]
+        # Beam search stops early once the best beam is found, pad back out to max_new_tokens.
+        generated = tf.pad(
+            generated,
+            [[0, 0], [0, max_new_tokens - tf.shape(generated)[1]]],
+            constant_values=encoder.end_token,
+        )
+        # Beams that did not finish can have arbitrary tokens after the end token.
+        finished = tf.cumsum(tf.cast(tf.equal(generated, encoder.end_token), tf.int32), axis=1, exclusive=True)
+        return tf.where(finished > 0, tf.fill(tf.shape(generated), encoder.end_token), generated)
+
+    def body(i, last_token, position, past, key_mask, finished, generated):
+        key_mask = tf.concat([key_mask, tf.ones([batch_size, 1])], 1)
+        logits, past = step(last_token, position, past, key_mask)
+        if top_k:
+            logits = top_k_logits(logits, top_k)
+        next_token = tf.cast(sample_with_temperature(logits, temperature), tf.int32)
+        next_token = tf.where(finished, tf.fill([batch_size], encoder.end_token), next_token)
+        finished = tf.logical_or(finished, tf.equal(next_token, encoder.end_token))
+        generated = tf.concat([generated, next_token[:, None]], 1)
+        return i + 1, next_token, position + 1, past, key_mask, finished, generated
+
+    def cond(i, last_token, position, past, key_mask, finished, generated):
+        return tf.logical_and(i < max_new_tokens, tf.logical_not(tf.reduce_all(finished)))
+
+    _, _, _, _, _, _, generated = tf.while_loop(
+        cond=cond,
+        body=body,
+        loop_vars=[
+            tf.constant(0),
+            last_token,
+            position,
+            past,
+            key_mask[:, :-1],
+            tf.zeros([batch_size], tf.bool),
+            tf.zeros([batch_size, 0], tf.int32),
+        ],
+        shape_invariants=[
+            tf.TensorShape([]),
+            tf.TensorShape([None]),
+            tf.TensorShape([None]),
+            tf.TensorShape([None] * (past.shape.ndims - 1) + [past.shape[-1]]),
+            tf.TensorShape([None, None]),
+            tf.TensorShape([None]),
+            tf.TensorShape([None, None]),
+        ],
+        back_prop=False,
+    )
+    return tf.pad(
+        generated,
+        [[0, 0], [0, max_new_tokens - tf.shape(generated)[1]]],
+        constant_values=encoder.end_token,
+    )
@@ -0,0 +1,210 @@
+"""
+Content addressed, disk backed cache of tokenized (and chunked) documents.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from finetune.encoding.input_encoder import EncodedOutput
+
+LOGGER = logging.getLogger("finetune")
+
+# Bump this whenever the layout of an entry or the output of _text_to_ids changes.
+CACHE_VERSION = 1
+ARRAY_FIELDS = ["token_ids", "tokens", "token_ends", "token_starts"]
+META_FILENAME = "meta.json"
+
+
+def encoder_identity(encoder):
+    """
+    A string that identifies the tokenization produced by an encoder.
+    """
+    return "{}.{}:{}:{}:{}".format(
+        type(encoder).__module__,
+        type(encoder).__qualname__,
+        getattr(encoder, "encoder_path", None),
+        getattr(encoder, "vocab_path", None),
+        len(encoder.encoder) if getattr(encoder, "encoder", None) is not None else None,
+    )
+
+
+class TokenCache:
+    """
+    Stores the EncodedOutput chunks produced for a document on disk so that repeated runs over the same
+    corpus can skip tokenization and chunking entirely.
+
+    Each entry is a directory holding one .npy file per array field (concatenated across chunks) and a small
+    json file describing the chunk boundaries. Arrays are memory-mapped when read back.
+
+    :param cache_dir: Directory to store cache entries in. Created if it does not exist.
+    :param max_bytes: Approximate cap on the total size of the cache, least recently used entries are evicted
+        once it is exceeded. None means unbounded.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._index = self._scan()
+        self.total_bytes = sum(self._index.values())
+
+    def _scan(self):
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                if not os.path.exists(os.path.join(entry_dir, META_FILENAME)):
+                    continue
+                entries.append(
+                    (os.path.getmtime(entry_dir), key, _dir_size(entry_dir))
+                )
+        index = OrderedDict()
+        for _, key, size in sorted(entries):
+            index[key] = size
+        return index
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    @staticmethod
+    def key(Xs, encoder, settings):
+        """
+        Builds the content address of a document.
+
+        :param Xs: The (formatted) text to be encoded.
+        :param encoder: The text encoder used to tokenize Xs.
+        :param settings: A json serializable dict of every setting that affects encoding or chunking.
+        """
+        h = hashlib.sha1()
+        h.update(str(CACHE_VERSION).encode("utf-8"))
+        h.update(encoder_identity(encoder).encode("utf-8"))
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+        h.update(repr(Xs).encode("utf-8", "surrogatepass"))
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the list of cached EncodedOutputs for key or None if there is no entry.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, META_FILENAME)) as f:
+                meta = json.load(f)
+            arrays = {
+                field: np.load(os.path.join(entry_dir, field + ".npy"), mmap_mode="r")
+                for field in meta["fields"]
+            }
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touch(key, entry_dir)
+        bounds = meta["bounds"]
+        chunks = []
+        for (start, end), useful_start, useful_end in zip(
+            zip(bounds[:-1], bounds[1:]), meta["useful_starts"], meta["useful_ends"]
+        ):
+            chunks.append(
+                EncodedOutput(
+                    useful_start=useful_start,
+                    useful_end=useful_end,
+                    **{field: value[start:end] for field, value in arrays.items()}
+                )
+            )
+        return chunks
+
+    def put(self, key, chunks):
+        """
+        Adds the EncodedOutputs for a document to the cache.
+        """
+        fields = [
+            field for field in ARRAY_FIELDS if getattr(chunks[0], field) is not None
+        ]
+        arrays = {
+            field: np.concatenate([np.asarray(getattr(c, field)) for c in chunks])
+            for field in fields
+        }
+        if any(a.dtype == object for a in arrays.values()):
+            # Not representable without pickling, don't cache.
+            return
+        lengths = [len(c.token_ids) for c in chunks]
+        meta = {
+            "fields": fields,
+            "bounds": np.cumsum([0] + lengths).tolist(),
+            "useful_starts": [_to_int(c.useful_start) for c in chunks],
+            "useful_ends": [_to_int(c.useful_end) for c in chunks],
+        }
+
+        entry_dir = self._entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        try:
+            for field, value in arrays.items():
+                np.save(os.path.join(tmp_dir, field + ".npy"), value, allow_pickle=False)
+            with open(os.path.join(tmp_dir, META_FILENAME), "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # Most likely written concurrently by another process.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        size = _dir_size(entry_dir)
+        self.total_bytes += size - self._index.pop(key, 0)
+        self._index[key] = size
+        self._evict()
+
+    def _touch(self, key, entry_dir):
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+        if key in self._index:
+            self._index.move_to_end(key)
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._index),
+            "bytes": self.total_bytes,
+        }
+
+    def clear(self):
+        for key in list(self._index):
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+        self._index.clear()
+        self.total_bytes = 0
+
+
+def _to_int(value):
+    return None if value is None else int(value)
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(path, filename)) for filename in os.listdir(path)
+    )
@@ -0,0 +1,106 @@
+"""
+Memory mapped model file format.
+
+Layout:
+    MAGIC (8 bytes) | header length (uint64, little endian) | pickled header | padding | aligned tensor blobs
+
+The header holds the pickled python object saved alongside the weights (the finetune model, or None for
+base model weights) and, for each tensor, its name, dtype, shape and offset from the start of the blob
+section. Every blob starts on an ALIGNMENT byte boundary so that tensors can be viewed directly out of a
+read-only np.memmap of the file without copying, and pages are only read from disk when first touched.
+"""
+import os
+import pickle
+import struct
+
+import joblib
+import numpy as np
+
+MAGIC = b"FTWGHT01"
+ALIGNMENT = 64
+_HEADER_LEN = struct.Struct("<Q")
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_weight_file(path):
+    """
+    True if path is a file in the memory mapped format, False for anything else (eg. joblib files or file objects).
+    """
+    if not isinstance(path, (str, os.PathLike)) or not os.path.isfile(path):
+        return False
+    with open(path, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def write_weight_file(path, variables, obj=None):
+    """
+    Writes a dict of name -> np.ndarray to path in the memory mapped format, along with an arbitrary
+    picklable object.
+    """
+    arrays = [(name, np.require(value, requirements="C")) for name, value in variables.items()]
+    tensors = []
+    offset = 0
+    for name, value in arrays:
+        if value.dtype.hasobject:
+            raise ValueError("Cannot memory map variable {} of dtype {}".format(name, value.dtype))
+        tensors.append((name, value.dtype.str, value.shape, offset))
+        offset = _align(offset + value.nbytes)
+
+    header = pickle.dumps({"obj": obj, "tensors": tensors}, protocol=pickle.HIGHEST_PROTOCOL)
+    data_start = _align(len(MAGIC) + _HEADER_LEN.size + len(header))
+
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as fp:
+        fp.write(MAGIC)
+        fp.write(_HEADER_LEN.pack(len(header)))
+        fp.write(header)
+        for (_, value), (_, _, _, tensor_offset) in zip(arrays, tensors):
+            fp.seek(data_start + tensor_offset)
+            fp.write(value.tobytes())
+        # Ensure the file covers any trailing padding of the final blob.
+        fp.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_weight_file(path):
+    """
+    Reads a file written by write_weight_file.
+
+    :returns: (variables, obj) where variables is a dict of name -> read-only array backed by a memory map of the file.
+    """
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a finetune weight file".format(path))
+        (header_len,) = _HEADER_LEN.unpack(fp.read(_HEADER_LEN.size))
+        header = pickle.loads(fp.read(header_len))
+    data_start = _align(len(MAGIC) + _HEADER_LEN.size + header_len)
+
+    variables = dict()
+    if os.path.getsize(path) > data_start:
+        # Plain ndarray views of the map, so that results of arithmetic on them are not np.memmap instances.
+        mm = np.asarray(np.memmap(path, dtype=np.uint8, mode="r"))
+        for name, dtype, shape, offset in header["tensors"]:
+            dtype = np.dtype(dtype)
+            start = data_start + offset
+            nbytes = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+            variables[name] = np.reshape(mm[start : start + nbytes].view(dtype), shape)
+    else:
+        # np.memmap cannot map an empty region, which happens when no variables were saved.
+        for name, dtype, shape, _ in header["tensors"]:
+            variables[name] = np.zeros(shape, dtype=np.dtype(dtype))
+    return variables, header["obj"]
+
+
+def convert_joblib_to_weight_file(src, dst):
+    """
+    Converts a joblib model file saved with Saver.save, or a joblib base model file, to the memory mapped format.
+    """
+    contents = joblib.load(src)
+    if isinstance(contents, tuple):
+        variables, obj = contents
+    else:
+        variables, obj = contents, None
+    write_weight_file(dst, variables, obj)
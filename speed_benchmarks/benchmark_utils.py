@@ -0,0 +1,43 @@
+"""
+Helpers shared by the scripts in speed_benchmarks.
+"""
+import argparse
+import time
+
+from tabulate import tabulate
+
+
+def argument_parser(doc):
+    """
+    An ArgumentParser that shows the module docstring of the benchmark as its help text.
+    """
+    return argparse.ArgumentParser(description=doc, formatter_class=argparse.RawDescriptionHelpFormatter)
+
+
+def mean_time(fn, runs=1):
+    """
+    Calls fn runs times.
+
+    :return: (output of the last call, mean seconds per call)
+    """
+    start = time.perf_counter()
+    for _ in range(runs):
+        output = fn()
+    return output, (time.perf_counter() - start) / runs
+
+
+def cached_predict_time(model, x, runs=1, method="predict"):
+    """
+    Steady state time of calling method of model on x, the graph is built and the weights loaded by a warm up
+    call on a single document that is not timed.
+
+    :return: (predictions, mean seconds per call)
+    """
+    predict = getattr(model, method)
+    with model.cached_predict():
+        predict(x[:1])
+        return mean_time(lambda: predict(x), runs)
+
+
+def print_table(rows, headers):
+    print(tabulate(rows, headers=headers))
@@ -0,0 +1,75 @@
+"""
+Compares int8_predict with float32 prediction on CPU.
+
+For each base model a classifier is fine-tuned on synthetic data and saved, then loaded once in float32 and once
+with int8_predict. Reports steady state throughput of each, the accuracy of each, how often their predictions
+agree and the largest difference between their class probabilities.
+
+    python int8_predict.py --num-docs 200
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from finetune import Classifier
+from finetune.base_models import BERT, RoBERTa, GPT2
+from benchmark_utils import argument_parser, cached_predict_time, print_table
+from synthetic_data import classification_data
+
+
+def as_array(probas, classes):
+    return np.array([[p[c] for c in classes] for p in probas])
+
+
+def benchmark(base_model, x, y, runs):
+    model = Classifier(base_model=base_model, visible_gpus=[], n_epochs=1)
+    model.fit(x, y)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "model.jl")
+        model.save(path)
+        fp32_model = Classifier.load(path, visible_gpus=[])
+        int8_model = Classifier.load(path, visible_gpus=[], int8_predict=True)
+
+        classes = list(model.input_pipeline.label_encoder.classes_)
+        fp32_probas, fp32_time = cached_predict_time(fp32_model, x, runs, method="predict_proba")
+        int8_probas, int8_time = cached_predict_time(int8_model, x, runs, method="predict_proba")
+
+    fp32_probas = as_array(fp32_probas, classes)
+    int8_probas = as_array(int8_probas, classes)
+    fp32_preds = np.array(classes)[fp32_probas.argmax(axis=1)]
+    int8_preds = np.array(classes)[int8_probas.argmax(axis=1)]
+    fp32_accuracy = np.mean(fp32_preds == np.array(y))
+    int8_accuracy = np.mean(int8_preds == np.array(y))
+    return [
+        base_model.__name__,
+        len(x) / fp32_time,
+        len(x) / int8_time,
+        fp32_time / int8_time,
+        fp32_accuracy,
+        int8_accuracy - fp32_accuracy,
+        np.mean(fp32_preds == int8_preds),
+        np.abs(fp32_probas - int8_probas).max(),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argument_parser(__doc__)
+    parser.add_argument("--num-docs", type=int, default=100)
+    parser.add_argument("--length", type=int, default=256)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    x, y = classification_data(num_docs=args.num_docs, length=args.length)
+    headers = [
+        "Base Model",
+        "fp32 docs/s",
+        "int8 docs/s",
+        "Speedup",
+        "fp32 Accuracy",
+        "int8 Accuracy Delta",
+        "Prediction Agreement",
+        "Max Proba Delta",
+    ]
+    output = [benchmark(base_model, x, y, args.runs) for base_model in [BERT, RoBERTa, GPT2]]
+    print_table(output, headers)
@@ -0,0 +1,33 @@
+from finetune import SequenceLabeler
+from finetune.encoding.target_encoders import SequenceLabelingEncoder
+from benchmark_utils import mean_time, print_table
+from synthetic_data import sequence_predictions
+
+CLASSES = ["<PAD>", "date", "name", "organization", "total"]
+
+
+def benchmark(decode_fn, zipped_data, predictions, runs, **kwargs):
+    return mean_time(lambda: decode_fn(zipped_data, iter(predictions), **kwargs), runs)[1]
+
+
+if __name__ == "__main__":
+    runs = 3
+    output = []
+    headers = ["Subtoken Predictions", "Mean Span Length", "Tokenwise (s)", "Vectorized (s)", "Speedup"]
+    for subtoken_predictions in [True, False]:
+        model = SequenceLabeler(subtoken_predictions=subtoken_predictions)
+        label_encoder = SequenceLabelingEncoder(pad_token=model.config.pad_token)
+        label_encoder.fit([[{"label": label} for label in CLASSES]])
+        model.input_pipeline.label_encoder = label_encoder
+        for mean_span_length in [2, 8, 64]:
+            zipped_data, predictions = sequence_predictions(
+                label_encoder.classes_, num_docs=10, num_tokens=10000, mean_span_length=mean_span_length
+            )
+            tokenwise = benchmark(
+                model._predict_decode_tokenwise, zipped_data, predictions, runs, return_negative_confidence=True
+            )
+            vectorized = benchmark(
+                model._predict_decode, zipped_data, predictions, runs, return_negative_confidence=True
+            )
+            output.append([subtoken_predictions, mean_span_length, tokenwise, vectorized, tokenwise / vectorized])
+    print_table(output, headers)
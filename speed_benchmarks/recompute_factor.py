@@ -0,0 +1,68 @@
+"""
+Compares predict_recompute_factor settings for long document inference.
+
+A SequenceLabeler and a Classifier are fine-tuned on synthetic long documents and saved, then loaded with each
+predict_recompute_factor. Reports the tokens pushed through the model per useful (kept) token, throughput, and
+token F1 / accuracy against the synthetic labels, relative to the default chunk_context.
+
+    python recompute_factor.py --factors 2.0 1.5 1.0
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from finetune import Classifier, SequenceLabeler
+from finetune.util.metrics import sequence_labeling_micro_token_f1
+from benchmark_utils import argument_parser, cached_predict_time, print_table
+from synthetic_data import sequence_data, classification_data
+
+
+def tokens_per_useful_token(model, x):
+    pipeline = model.input_pipeline
+    processed = useful = 0
+    for doc in x:
+        for chunk in pipeline._text_to_ids([doc]):
+            processed += len(chunk.token_ids)
+            useful += len(chunk.token_ids[chunk.useful_start : chunk.useful_end])
+    return processed / useful
+
+
+def benchmark(model_cls, x, y, factors, score_fn):
+    model = model_cls(visible_gpus=[], n_epochs=1)
+    model.fit(x, y)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "model.jl")
+        model.save(path)
+        for factor in [None] + factors:
+            loaded = model_cls.load(path, visible_gpus=[], predict_recompute_factor=factor)
+            predictions, elapsed = cached_predict_time(loaded, x)
+            rows.append(
+                [
+                    model_cls.__name__,
+                    "default" if factor is None else factor,
+                    tokens_per_useful_token(loaded, x),
+                    len(x) / elapsed,
+                    score_fn(y, predictions),
+                ]
+            )
+    baseline = rows[0][-1]
+    return [row + [row[-1] - baseline] for row in rows]
+
+
+if __name__ == "__main__":
+    parser = argument_parser(__doc__)
+    parser.add_argument("--num-docs", type=int, default=20)
+    parser.add_argument("--length", type=int, default=8000)
+    parser.add_argument("--factors", type=float, nargs="+", default=[2.0, 1.5, 1.0])
+    args = parser.parse_args()
+
+    headers = ["Model", "Recompute Factor", "Tokens / Useful Token", "docs/s", "Score", "Score Delta"]
+    x, y = sequence_data(num_docs=args.num_docs, length=args.length)
+    output = benchmark(SequenceLabeler, x, y, args.factors, sequence_labeling_micro_token_f1)
+    x, y = classification_data(num_docs=args.num_docs, length=args.length)
+    output += benchmark(
+        Classifier, x, y, args.factors, lambda true, pred: np.mean(np.array(true) == np.array(pred))
+    )
+    print_table(output, headers)
@@ -0,0 +1,197 @@
+"""
+Per-stage benchmark harness.
+
+Breaks prediction time down into tokenization, chunking, batching, graph build, session init (including
+weight loading), forward pass, decode and post-processing, and reports throughput and peak RSS. Runs
+on CPU against the generators in synthetic_data.py and writes results as JSON so runs can be diffed
+across versions.
+
+    python stages.py --output results.json
+"""
+import functools
+import json
+import platform
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import tensorflow as tf
+
+import finetune
+from finetune import Classifier, SequenceLabeler
+from finetune.util.indico_estimator import IndicoEstimator
+from benchmark_utils import argument_parser
+from synthetic_data import sequence_data, multi_label_sequence_data, classification_data
+
+
+class StageTimer:
+    """
+    Attributes wall time to the innermost active stage, so nested and interleaved stages
+    (e.g. tokenization running inside the forward pass's input generator) are never double counted.
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.stack = []
+        self.last = None
+
+    def _switch(self):
+        now = time.perf_counter()
+        if self.stack:
+            self.totals[self.stack[-1]] += now - self.last
+        self.last = now
+
+    @contextmanager
+    def stage(self, name):
+        self._switch()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self.stack.pop()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+
+    def wrap(self, fn, name):
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapped
+
+    def wrap_gen(self, fn, name):
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            with self.stage(name):
+                gen = iter(fn(*args, **kwargs))
+            while True:
+                with self.stage(name):
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        return
+                yield item
+
+        return wrapped
+
+
+@contextmanager
+def instrumented(model, timer):
+    """
+    Patches the stages of model's prediction path to report to timer, restoring them on exit.
+    """
+    pipeline = model.input_pipeline
+    encoder = pipeline.text_encoder
+    patches = [
+        (encoder, "encode_multi_input", timer.wrap, "tokenization"),
+        (pipeline, "_encode_and_chunk", timer.wrap_gen, "chunking"),
+        (pipeline, "text_to_tokens_mask", timer.wrap_gen, "chunking"),
+        (pipeline, "get_predict_batches", timer.wrap_gen, "batching"),
+        (pipeline.label_encoder, "inverse_transform", timer.wrap, "decode"),
+    ]
+    if hasattr(model, "_predict_decode"):
+        patches.append((model, "_predict_decode", timer.wrap, "post_processing"))
+
+    originals = []
+    for obj, attr, wrapper, name in patches:
+        originals.append((obj, attr, obj.__dict__.get(attr)))
+        setattr(obj, attr, wrapper(getattr(obj, attr), name))
+
+    original_call_model_fn = IndicoEstimator._call_model_fn
+    original_monitored_session = tf.compat.v1.train.MonitoredSession
+
+    def monitored_session(*args, **kwargs):
+        with timer.stage("session_init"):
+            sess = original_monitored_session(*args, **kwargs)
+        sess.run = timer.wrap(sess.run, "forward")
+        return sess
+
+    IndicoEstimator._call_model_fn = timer.wrap(original_call_model_fn, "graph_build")
+    tf.compat.v1.train.MonitoredSession = monitored_session
+    try:
+        yield
+    finally:
+        IndicoEstimator._call_model_fn = original_call_model_fn
+        tf.compat.v1.train.MonitoredSession = original_monitored_session
+        for obj, attr, original in originals:
+            if original is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, original)
+
+
+def count_tokens(model, x):
+    return sum(
+        len(chunk.token_ids) for doc in x for chunk in model.input_pipeline._text_to_ids(doc)
+    )
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(name, model_cls, config, x, y):
+    model = model_cls(**config)
+    fit_start = time.perf_counter()
+    model.fit(x, y)
+    fit_time = time.perf_counter() - fit_start
+
+    n_tokens = count_tokens(model, x)
+    timer = StageTimer()
+    results = {"name": name, "config": {k: str(v) for k, v in config.items()}, "fit_time": fit_time}
+    with instrumented(model, timer), model.cached_predict():
+        # The first call builds the graph and loads weights, the second is steady state.
+        for run in ["first_predict", "steady_state_predict"]:
+            timer.reset()
+            with timer.stage("other"):
+                start = time.perf_counter()
+                model.predict(x)
+                total = time.perf_counter() - start
+            results[run] = {
+                "total_time": total,
+                "stages": dict(timer.totals),
+                "docs_per_sec": len(x) / total,
+                "tokens_per_sec": n_tokens / total,
+            }
+    results["n_docs"] = len(x)
+    results["n_tokens"] = n_tokens
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argument_parser(__doc__)
+    parser.add_argument("--output", default="stage_benchmarks.json")
+    parser.add_argument("--num-docs", type=int, default=50)
+    args = parser.parse_args()
+
+    base_config = {"visible_gpus": [], "n_epochs": 1}
+    benchmarks = [
+        ("classification", Classifier, {}, classification_data(num_docs=args.num_docs)),
+        ("sequence", SequenceLabeler, {}, sequence_data(num_docs=args.num_docs)),
+        (
+            "multi_label_sequence",
+            SequenceLabeler,
+            {"multi_label_sequences": True},
+            multi_label_sequence_data(num_docs=args.num_docs),
+        ),
+    ]
+    output = {
+        "finetune_version": finetune.__version__,
+        "tensorflow_version": tf.__version__,
+        "platform": platform.platform(),
+        "benchmarks": [],
+    }
+    for name, model_cls, config, (x, y) in benchmarks:
+        result = benchmark(name, model_cls, {**base_config, **config}, x, y)
+        output["benchmarks"].append(result)
+        stages = result["steady_state_predict"]["stages"]
+        print(name, json.dumps({k: round(v, 3) for k, v in stages.items()}))
+
+    with open(args.output, "wt") as fp:
+        json.dump(output, fp, indent=2)
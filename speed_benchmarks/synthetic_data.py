@@ -1,3 +1,5 @@
+import numpy as np
+
 
 def sequence_data(num_docs=50, length=8000):
     return multi_label_sequence_data(num_docs=num_docs, length=length, num_labels=1)
@@ -31,3 +33,38 @@ def classification_data(num_docs=50, length=1024):
     
 
     
+
+def sequence_predictions(classes, num_docs=10, num_tokens=10000, chunk_size=512, mean_span_length=8, seed=42):
+    """
+    Synthetic output of SequenceLabeler.process_long_sequence for documents of num_tokens words,
+    used to benchmark prediction post-processing without running the model.
+    """
+    rng = np.random.RandomState(seed)
+    zipped_data = []
+    predictions = []
+    for _ in range(num_docs):
+        words = ["word{}".format(i) for i in rng.randint(1000, size=num_tokens)]
+        starts = np.cumsum([0] + [len(w) + 1 for w in words[:-1]])
+        ends = starts + np.asarray([len(w) for w in words])
+        zipped_data.append({"X": " ".join(words)})
+        n_spans = num_tokens // mean_span_length + 1
+        labels = np.repeat(rng.randint(len(classes), size=n_spans), mean_span_length)[:num_tokens]
+        for chunk_start in range(0, num_tokens, chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            n_chunk_tokens = len(starts[chunk])
+            # Special tokens at either end of the chunk are marked with -1 offsets
+            token_starts = [-1] + starts[chunk].tolist() + [-1]
+            token_ends = [-1] + ends[chunk].tolist() + [-1]
+            label_seq = [classes[0]] + [classes[l] for l in labels[chunk]] + [classes[0]]
+            proba_seq = rng.dirichlet(np.ones(len(classes)), size=n_chunk_tokens + 2).astype(np.float32)
+            predictions.append((
+                token_starts,
+                token_ends,
+                chunk_start == 0,
+                chunk_start + chunk_size >= num_tokens,
+                label_seq,
+                proba_seq,
+                0,
+                n_chunk_tokens + 2,
+            ))
+    return zipped_data, predictions
@@ -0,0 +1,70 @@
+"""
+Compares kv-cached text generation with generation that re-runs the whole sequence for every new token.
+
+For each base model, generates from the same prompts with greedy decoding both ways and reports tokens per second
+of each and whether their outputs match.
+
+    python text_generation.py --max-length 128
+"""
+from finetune import Classifier
+from finetune.base_models import GPT2, GPT2Medium
+from benchmark_utils import argument_parser, mean_time, print_table
+
+PROMPTS = [
+    "The quick brown fox",
+    "In a shocking finding, scientists discovered",
+    "Machine learning is",
+]
+
+
+def benchmark(base_model, max_length):
+    model = Classifier(base_model=base_model, visible_gpus=[], lm_temp=0.0)
+    encoder = model.input_pipeline.text_encoder
+    prompts = [encoder._encode([prompt]).token_ids[0] for prompt in PROMPTS]
+
+    full_outputs, full_time = mean_time(
+        lambda: [
+            model._generate_text_full_recompute(prompt, max_length, use_extra_toks=False)[len(prompt):]
+            for prompt in prompts
+        ]
+    )
+    cached_outputs, cached_time = mean_time(
+        lambda: [
+            model._generate_tokens(
+                [prompt],
+                max_new_tokens=max_length - 1 - len(prompt),
+                temperature=0.0,
+                top_k=0,
+                beam_size=1,
+                beam_alpha=0.0,
+                use_extra_toks=False,
+            )[0]
+            for prompt in prompts
+        ]
+    )
+    num_tokens = sum(len(output) for output in cached_outputs)
+    return [
+        base_model.__name__,
+        num_tokens,
+        sum(len(output) for output in full_outputs) / full_time,
+        num_tokens / cached_time,
+        full_time / cached_time,
+        full_outputs == cached_outputs,
+    ]
+
+
+if __name__ == "__main__":
+    parser = argument_parser(__doc__)
+    parser.add_argument("--max-length", type=int, default=128)
+    args = parser.parse_args()
+
+    headers = [
+        "Base Model",
+        "Tokens Generated",
+        "Full Recompute tokens/s",
+        "KV Cached tokens/s",
+        "Speedup",
+        "Outputs Match",
+    ]
+    output = [benchmark(base_model, args.max_length) for base_model in [GPT2, GPT2Medium]]
+    print_table(output, headers)
@@ -21,7 +21,7 @@ from finetune.util.metrics import (
     sequence_labeling_token_recall,
 )
 from finetune.datasets.reuters import Reuters
-from finetune.encoding.input_encoder import tokenize_context, EncodedOutput
+from finetune.encoding.input_encoder import prepare_context, tokenize_context, EncodedOutput
 
 
 # prevent excessive warning logs
@@ -61,3 +61,10 @@ class TestAuxiliaryTokenization(unittest.TestCase):
             [False, 0]
         ]
         np.testing.assert_array_equal(expected, expanded_context)
+
+        # Context prepared once for a whole document aligns the same way
+        prepared = prepare_context(context, config)
+        np.testing.assert_array_equal(expected, tokenize_context(prepared, encoded_output, config))
+
+        with self.assertRaises(ValueError):
+            tokenize_context(context[:2], encoded_output, config)
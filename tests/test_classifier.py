@@ -8,6 +8,7 @@ from copy import copy
 import time
 from pathlib import Path
 from unittest.mock import MagicMock
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 
 # prevent excessive warning logs
@@ -25,8 +26,12 @@ from finetune import Classifier
 from finetune.model import PredictMode
 from finetune.base_models import GPTModelSmall, GPT
 from finetune.datasets import generic_download
-from finetune.config import get_config
+from finetune.config import get_config, GridSearchable
 from finetune.errors import FinetuneError
+from finetune.inference_engine import InferenceEngine
+from finetune.multi_head import MultiHeadPredictor
+from finetune.serving import ExportedModel
+from finetune.util.weight_file import is_weight_file
 
 SST_FILENAME = "SST-binary.csv"
 
@@ -54,6 +59,11 @@ class TestClassifier(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         cls._download_sst()
+        cls._shared_model = None
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._shared_model = None
 
     def setUp(self):
         self.dataset = pd.read_csv(self.dataset_path, nrows=self.n_sample * 3)
@@ -73,6 +83,21 @@ class TestClassifier(unittest.TestCase):
         defaults.update(kwargs)
         return dict(get_config(**defaults))
 
+    def shared_model(self):
+        """
+        A Classifier with a frozen featurizer that is fit once and shared by tests that only predict with it.
+        Tests must not change its config or weights.
+
+        :returns: (model, train_sample)
+        """
+        cls = type(self)
+        if cls._shared_model is None:
+            model = Classifier(**self.default_config(num_layers_trained=0, train_embeddings=False))
+            train_sample = self.dataset.sample(n=self.n_sample)
+            model.fit(train_sample.Text.values, train_sample.Target.values)
+            cls._shared_model = (model, train_sample)
+        return cls._shared_model
+
     def test_fit_lm_only(self):
         """
         Ensure LM only training does not error out
@@ -134,6 +159,163 @@ class TestClassifier(unittest.TestCase):
         second_prediction_time = second - first
         self.assertLess(second_prediction_time, first_prediction_time / 2.0)
 
+    def test_predict_iter(self):
+        """
+        Ensure streaming prediction over a lazy iterator matches predict
+        """
+        model, _ = self.shared_model()
+        valid_sample = self.dataset.sample(n=self.n_sample)
+
+        predictions = model.predict(valid_sample.Text.values)
+        streamed = model.predict_iter(
+            (text for text in valid_sample.Text.values), window_size=7
+        )
+        self.assertEqual(list(streamed), list(predictions))
+        self.assertFalse(model._cached_predict)
+
+    def test_predict_iter_streams(self):
+        """
+        Ensure predict_iter yields the first prediction before inference over its window has finished
+        """
+        model, _ = self.shared_model()
+        texts = sorted(self.dataset.sample(n=self.n_sample).Text.values, key=len)
+        inferred = []
+        inference = model._current_inference()
+
+        def counting_inference(*args, **kwargs):
+            for pred in inference(*args, **kwargs):
+                inferred.append(pred)
+                yield pred
+
+        with model.inference_override(counting_inference):
+            streamed = model.predict_iter(iter(texts), window_size=len(texts))
+            first = next(streamed)
+            self.assertLess(len(inferred), len(texts))
+            streamed.close()
+        self.assertEqual(first, model.predict(texts[:1])[0])
+
+    def test_inference_engine(self):
+        """
+        Ensure micro-batched predictions from many threads match predict
+        """
+        model, _ = self.shared_model()
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        predictions = model.predict(valid_sample.Text.values)
+
+        with InferenceEngine(model, max_wait_ms=20) as engine:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = list(executor.map(engine.submit, valid_sample.Text.values))
+            engine_predictions = [future.result() for future in futures]
+            self.assertLess(engine.n_batches, len(engine_predictions))
+
+        self.assertEqual(engine_predictions, list(predictions))
+
+    def test_fit_cached_featurizer_outputs(self):
+        """
+        Ensure a head can be trained over cached outputs of a frozen featurizer
+        """
+        model = Classifier(
+            **self.default_config(
+                num_layers_trained=0, train_embeddings=False, cache_featurizer_outputs=True
+            )
+        )
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+        self.assertTrue(os.listdir(model._featurizer_cache_dir.name))
+        self.assertFalse(any(k.startswith("model/featurizer") for k in model.saver.variables))
+
+        predictions = model.predict(valid_sample.Text.values)
+        self.assertEqual(len(predictions), self.n_sample)
+        for prediction in predictions:
+            self.assertIn(prediction, set(train_sample.Target.values))
+
+    def test_fit_cached_featurizer_outputs_gpt(self):
+        """
+        Ensure caching featurizer outputs works for base models that also output attention weights
+        """
+        model = Classifier(
+            **self.default_config(
+                base_model=GPTModelSmall,
+                num_layers_trained=0,
+                train_embeddings=False,
+                cache_featurizer_outputs=True,
+            )
+        )
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+        self.assertTrue(os.listdir(model._featurizer_cache_dir.name))
+
+        predictions = model.predict(valid_sample.Text.values)
+        self.assertEqual(len(predictions), self.n_sample)
+
+    def test_multi_head_predictor(self):
+        """
+        Ensure heads sharing a frozen featurizer predict the same from one graph as they do separately
+        """
+        model_a, train_sample = self.shared_model()
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model_b = Classifier(**self.default_config(num_layers_trained=0, train_embeddings=False))
+        model_b.fit(train_sample.Text.values, train_sample.Target.values == train_sample.Target.values[0])
+        predictions = [model_a.predict(valid_sample.Text.values), model_b.predict(valid_sample.Text.values)]
+
+        with MultiHeadPredictor([model_a, model_b]) as predictor:
+            multi_head_predictions = predictor.predict(valid_sample.Text.values)
+        for preds, multi_head_preds in zip(predictions, multi_head_predictions):
+            self.assertEqual(list(preds), list(multi_head_preds))
+
+        model_c = Classifier(**self.default_config())
+        model_c.fit(train_sample.Text.values, train_sample.Target.values)
+        with self.assertRaises(FinetuneError):
+            MultiHeadPredictor([model_a, model_c])
+
+        model_b.config.collapse_whitespace = not model_a.config.collapse_whitespace
+        with self.assertRaises(FinetuneError):
+            MultiHeadPredictor([model_a, model_b])
+
+    def test_export(self):
+        """
+        Ensure an exported model predicts the same as the model it was exported from
+        """
+        model, _ = self.shared_model()
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        predictions = model.predict(valid_sample.Text.values)
+        probabilities = model.predict_proba(valid_sample.Text.values)
+
+        export_dir = "tests/saved-models/exported"
+        model.export(export_dir)
+        with self.assertRaises(FinetuneError):
+            model.export(export_dir)
+
+        with ExportedModel.load(export_dir) as exported:
+            self.assertEqual(list(exported.predict(valid_sample.Text.values)), list(predictions))
+            for proba, exported_proba in zip(probabilities, exported.predict_proba(valid_sample.Text.values)):
+                for label, value in proba.items():
+                    self.assertAlmostEqual(exported_proba[label], value, places=4)
+
+    def test_grid_search_halving(self):
+        """
+        Ensure successive halving prunes configs and only picks from those it trained fully
+        """
+        sample = self.dataset.sample(n=self.n_sample)
+        results = Classifier.finetune_grid_search(
+            sample.Text.values,
+            sample.Target.values,
+            test_size=0.5,
+            return_all=True,
+            halving_rounds=1,
+            halving_eta=2,
+            batch_size=2,
+            max_length=128,
+            n_epochs=2,
+            l2_reg=GridSearchable(0.01, [0.0, 0.01]),
+        )
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sum(score is None for _, score in results), 1)
+        for config, score in results:
+            self.assertIsNone(config.tokenize_cache_dir)
+
     def test_correct_cached_predict(self):
         model = Classifier(**self.default_config())
         train_sample = self.dataset.sample(n=self.n_sample)
@@ -262,6 +444,27 @@ class TestClassifier(unittest.TestCase):
         model.fit(train_sample.Text.values, train_sample.Target.values)
         model.predict(valid_sample.Text.values)
 
+    def test_fit_predict_token_budget(self):
+        """
+        Ensure predict_max_tokens="auto" calibrates once, is persisted on save and
+        does not change predictions
+        """
+        save_file = "tests/saved-models/test-token-budget"
+        model = Classifier(**self.default_config(bucket_by_length=True))
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+        predictions = model.predict(valid_sample.Text.values)
+
+        model.config.predict_max_tokens = "auto"
+        budget_predictions = model.predict(valid_sample.Text.values)
+        self.assertIsInstance(model.config.predict_max_tokens, int)
+        self.assertEqual(predictions, budget_predictions)
+
+        model.save(save_file)
+        model = Classifier.load(save_file)
+        self.assertIsInstance(model.config.predict_max_tokens, int)
+
     def test_save_load(self):
         """
         Ensure saving + loading does not cause errors
@@ -289,6 +492,24 @@ class TestClassifier(unittest.TestCase):
         for i, prediction in enumerate(predictions):
             self.assertEqual(prediction, new_predictions[i])
 
+    def test_save_load_mmap(self):
+        """
+        Ensure models saved in the memory mapped format load to the same predictions
+        """
+        save_file = "tests/saved-models/test-save-load-mmap"
+        model = Classifier(**self.default_config(save_format="mmap"))
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text, train_sample.Target)
+        predictions = model.predict(valid_sample.Text)
+        model.save(save_file)
+        self.assertTrue(is_weight_file(save_file))
+
+        model = Classifier.load(save_file)
+        new_predictions = model.predict(valid_sample.Text)
+        for i, prediction in enumerate(predictions):
+            self.assertEqual(prediction, new_predictions[i])
+
     def test_featurize(self):
         """
         Ensure featurization returns an array of the right shape
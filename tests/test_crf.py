@@ -0,0 +1,32 @@
+import unittest
+
+import numpy as np
+
+from finetune.nn.crf import viterbi_decode, viterbi_decode_batch
+
+
+class TestViterbiDecodeBatch(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.scores = rng.randn(8, 30, 5).astype(np.float32)
+        self.transitions = rng.randn(5, 5).astype(np.float32)
+        self.lengths = np.array([30, 1, 2, 10, 15, 29, 30, 7])
+
+    def test_matches_viterbi_decode(self):
+        tags, trellis = viterbi_decode_batch(self.scores, self.transitions)
+        for score, seq_tags, seq_trellis in zip(self.scores, tags, trellis):
+            expected_tags, expected_trellis = viterbi_decode(score, self.transitions)
+            self.assertEqual(list(seq_tags), list(expected_tags))
+            np.testing.assert_allclose(seq_trellis, expected_trellis, rtol=1e-5)
+
+    def test_sequence_lengths(self):
+        tags, trellis = viterbi_decode_batch(self.scores, self.transitions, self.lengths)
+        self.assertEqual(tags.shape, (8, 30))
+        self.assertEqual(trellis.shape, (8, 30, 5))
+        for score, length, seq_tags, seq_trellis in zip(self.scores, self.lengths, tags, trellis):
+            expected_tags, expected_trellis = viterbi_decode(score[:length], self.transitions)
+            self.assertEqual(list(seq_tags[:length]), list(expected_tags))
+            np.testing.assert_allclose(seq_trellis[:length], expected_trellis, rtol=1e-5)
+            # Padding repeats the final tag
+            self.assertTrue(np.all(seq_tags[length:] == seq_tags[length - 1]))
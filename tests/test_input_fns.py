@@ -138,3 +138,53 @@ class TestInputFns(unittest.TestCase):
             
 
         
+
+    def test_predict_batches(self):
+        model = Classifier(max_length=10, chunk_long_sequences=False, predict_batch_size=7)
+        train_sample = self.dataset.sample(n=20)
+        model.input_pipeline._post_data_initialization(
+            model.input_pipeline.zip_list_to_dict(X=train_sample.Text.values, Y=train_sample.Target.values)
+        )
+        zipped_data = model.input_pipeline.zip_list_to_dict(X=train_sample.Text.values)
+        dataset = model.input_pipeline.get_dataset_from_generator(
+            lambda: iter(zipped_data), InputMode.PREDICT
+        )["predict_dataset"]()
+        batches = list(model.input_pipeline.get_predict_batches(lambda: iter(zipped_data)))
+        dataset_batches = list(dataset.as_numpy_iterator())
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(len(batches), len(dataset_batches))
+        for batch, dataset_batch in zip(batches, dataset_batches):
+            self.assertEqual(set(batch.keys()), set(dataset_batch.keys()))
+            for key in batch:
+                np.testing.assert_array_equal(batch[key], dataset_batch[key])
+
+    def test_tokenize_workers(self):
+        """
+        Ensure tokenizing in worker processes yields the same examples, in the same order, as the main process
+        """
+        train_sample = self.dataset.sample(n=20)
+        outputs = []
+        for tokenize_workers in [1, 2]:
+            model = Classifier(max_length=10, tokenize_workers=tokenize_workers, tokenize_shard_size=3)
+            pipeline = model.input_pipeline
+            train_data = pipeline.zip_list_to_dict(X=train_sample.Text.values, Y=train_sample.Target.values)
+            pipeline._post_data_initialization(train_data)
+            # List path
+            train_examples = list(pipeline._tokenized_examples(train_data))
+            # Generator path, tokenized from within tf.data's generator thread
+            zipped_data = pipeline.zip_list_to_dict(X=train_sample.Text.values)
+            dataset = pipeline.get_dataset_from_generator(
+                lambda: iter(zipped_data), InputMode.PREDICT
+            )["predict_dataset"]()
+            outputs.append((train_examples, list(dataset.as_numpy_iterator())))
+            pipeline.close()
+
+        (train_examples, batches), (worker_train_examples, worker_batches) = outputs
+        self.assertEqual(len(train_examples), len(worker_train_examples))
+        for (feats, target), (worker_feats, worker_target) in zip(train_examples, worker_train_examples):
+            np.testing.assert_array_equal(feats["tokens"], worker_feats["tokens"])
+            np.testing.assert_array_equal(target, worker_target)
+        self.assertEqual(len(batches), len(worker_batches))
+        for batch, worker_batch in zip(batches, worker_batches):
+            for key in batch:
+                np.testing.assert_array_equal(batch[key], worker_batch[key])
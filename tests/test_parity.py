@@ -104,3 +104,64 @@ class TestActivationParity(unittest.TestCase):
             atol=1e-1
         )
                                          
+
+    def _assert_int8_close(self, base_model):
+        fp32_features = Classifier(base_model=base_model).featurize(self.TEST_DATA)[0]
+        int8_features = Classifier(base_model=base_model, int8_predict=True).featurize(self.TEST_DATA)[0]
+        cosine = np.dot(fp32_features, int8_features) / (
+            np.linalg.norm(fp32_features) * np.linalg.norm(int8_features)
+        )
+        self.assertGreater(cosine, 0.95)
+
+    def test_bert_featurize_int8(self):
+        self._assert_int8_close(BERT)
+
+    def test_gpt2_featurize_int8(self):
+        self._assert_int8_close(GPT2)
+
+    def test_gpt2_kv_cached_generation(self):
+        model = Classifier(base_model=GPT2, lm_temp=0.0)
+        seed = "The quick brown fox"
+        cached = model.generate_text(seed, max_length=16)
+        token_ids = model.input_pipeline.text_encoder._encode([seed]).token_ids[0]
+        full_recompute = model.input_pipeline.text_encoder.decode(
+            model._generate_text_full_recompute(token_ids, 16, use_extra_toks=False)
+        )
+        self.assertEqual(cached, full_recompute)
+
+        # Left padding a prompt within a batch does not change its greedy continuation.
+        short, long = model._generate_tokens(
+            [token_ids, token_ids + token_ids],
+            max_new_tokens=8,
+            temperature=0.0,
+            top_k=0,
+            beam_size=1,
+            beam_alpha=0.0,
+            use_extra_toks=False,
+        )
+        [alone] = model._generate_tokens(
+            [token_ids],
+            max_new_tokens=8,
+            temperature=0.0,
+            top_k=0,
+            beam_size=1,
+            beam_alpha=0.0,
+            use_extra_toks=False,
+        )
+        self.assertEqual(short, alone)
+
+        beam_out = model.generate_text(seed, max_length=16, beam_size=3)
+        self.assertTrue(beam_out.startswith(seed))
+
+    def test_gpt2_generate_texts(self):
+        model = Classifier(base_model=GPT2, lm_temp=0.0)
+        prompts = ["The quick brown fox", "Hello", "In a shocking finding, scientists discovered"]
+        with model.cached_predict():
+            batched = model.generate_texts(prompts, max_length=20, batch_size=2)
+            self.assertEqual(len(model._generation_graphs), 1)
+            single = [model.generate_text(prompt, max_length=20) for prompt in prompts]
+            self.assertEqual(len(model._generation_graphs), 1)
+        self.assertEqual(model._generation_graphs, {})
+        self.assertEqual(batched, single)
+        for prompt, text in zip(prompts, batched):
+            self.assertTrue(text.startswith(prompt))
@@ -79,3 +79,55 @@ class TestScheduler(unittest.TestCase):
         self.assertEqual(pred1a, pred1b)
         pred2a = shed.predict(m2, ["A"]) # Load another model.
         self.assertEqual(len(shed.loaded_models), 1)
+
+    def test_scheduler_cpu_tier(self):
+        m1 = os.path.join(self.folder, self.model1)
+        m2 = os.path.join(self.folder, self.model2)
+        shed = Scheduler(max_models=1)
+        pred1a = shed.predict(m1, ["A"])
+        shed.predict(m2, ["A"])
+        self.assertIn(m1, shed.cpu_cache)
+        # Re-activating an evicted model should not read it from disk again.
+        pred1b = shed.predict(m1, ["A"])
+        self.assertEqual(pred1a, pred1b)
+        self.assertEqual(shed.metrics["misses"], 2)
+        self.assertEqual(shed.metrics["cpu_hits"], 1)
+        self.assertEqual(shed.metrics["gpu_evictions"], 2)
+        self.assertIn(m1, shed.footprints)
+
+    def test_scheduler_lfu(self):
+        m1 = os.path.join(self.folder, self.model1)
+        m2 = os.path.join(self.folder, self.model2)
+        m3 = os.path.join(self.folder, "3.jl")
+        shutil.copy(m1, m3)
+        shed = Scheduler(max_models=2, eviction_policy="lfu", max_cpu_models=0)
+        shed.predict(m1, ["A"])
+        shed.predict(m1, ["A"])
+        shed.predict(m2, ["A"])
+        # m1 is least recently used but most frequently used, so lfu evicts m2 where lru would evict m1.
+        shed.predict(m3, ["A"])
+        self.assertEqual(shed.loaded_models, [m1, m3])
+        self.assertEqual(len(shed.cpu_cache), 0)
+
+    def test_scheduler_resident_weights_budget(self):
+        m1 = os.path.join(self.folder, self.model1)
+        m2 = os.path.join(self.folder, self.model2)
+        shed = Scheduler(max_models=2, max_cpu_bytes=0)
+        shed.predict(m1, ["A"])
+        shed.predict(m2, ["A"])
+        # Weights kept for models in the GPU tier count against the host RAM budget.
+        self.assertEqual(shed.resident_bytes, 0)
+        self.assertEqual(shed.metrics["resident_weights_dropped"], 2)
+
+    def test_scheduler_prefetch(self):
+        m1 = os.path.join(self.folder, self.model1)
+        m2 = os.path.join(self.folder, self.model2)
+        shed = Scheduler(max_models=1)
+        futures = shed.prefetch([m1, m2])
+        # Only one model fits under max_models, prefetching never evicts.
+        self.assertEqual([f.result() for f in futures], [True, False])
+        self.assertEqual(shed.loaded_models, [m1])
+        time_pre = time.time()
+        shed.predict(m1, ["A"])
+        self.assertLess(time.time() - time_pre, 1)
+        self.assertEqual(shed.metrics["gpu_hits"], 1)
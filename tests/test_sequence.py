@@ -28,6 +28,7 @@ from finetune import SequenceLabeler
 from finetune.base_models import GPT
 from finetune.config import get_config
 from finetune.encoding.sequence_encoder import finetune_to_indico_sequence
+from finetune.encoding.target_encoders import SequenceLabelingEncoder
 from finetune.util.metrics import (
     sequence_labeling_token_precision,
     sequence_labeling_token_recall,
@@ -690,3 +691,47 @@ class TestSequenceLabelerNoCRF(TestSequenceLabeler):
         )
         d.update(**kwargs)
         return d
+
+
+class TestPredictDecode(unittest.TestCase):
+    classes = ["<PAD>", "date", "name"]
+
+    def predictions(self):
+        # "Call John Smith on Jan 5th", with "John" and "5th" split into subtokens and the
+        # name span crossing the boundary between the two chunks of the document.
+        zipped_data = [{"X": "Call John Smith on Jan 5th"}]
+        chunks = [
+            ([0, 5, 7], [4, 7, 9], True, False, ["<PAD>", "name", "name"]),
+            ([10, 16, 19, 23, 24], [15, 18, 22, 24, 26], False, True, ["name", "<PAD>", "date", "date", "date"]),
+        ]
+        rng = np.random.RandomState(0)
+        predictions = []
+        for starts, ends, start_of_doc, end_of_doc, labels in chunks:
+            probas = rng.dirichlet(np.ones(len(self.classes)), size=len(labels) + 2)
+            predictions.append((
+                [-1] + starts + [-1],
+                [-1] + ends + [-1],
+                start_of_doc,
+                end_of_doc,
+                ["<PAD>"] + labels + ["<PAD>"],
+                probas.astype(np.float32),
+                0,
+                len(labels) + 2,
+            ))
+        return zipped_data, predictions
+
+    def test_vectorized_matches_tokenwise(self):
+        for subtoken_predictions in [True, False]:
+            model = SequenceLabeler(subtoken_predictions=subtoken_predictions)
+            label_encoder = SequenceLabelingEncoder(pad_token=model.config.pad_token)
+            label_encoder.fit([[{"label": label} for label in self.classes]])
+            model.input_pipeline.label_encoder = label_encoder
+            zipped_data, predictions = self.predictions()
+            for return_negative_confidence in [True, False]:
+                expected = model._predict_decode_tokenwise(
+                    zipped_data, iter(predictions), return_negative_confidence=return_negative_confidence
+                )
+                actual = model._predict_decode(
+                    zipped_data, iter(predictions), return_negative_confidence=return_negative_confidence
+                )
+                self.assertEqual(expected, actual)
@@ -0,0 +1,82 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from finetune.encoding.input_encoder import EncodedOutput
+from finetune.util.token_cache import TokenCache
+
+
+class FakeEncoder:
+    encoder_path = "encoder.json"
+    vocab_path = "vocab.bpe"
+    encoder = {"a": 0, "b": 1}
+
+
+def make_chunks(n_chunks=3, length=10):
+    chunks = []
+    for i in range(n_chunks):
+        start = i * length
+        chunks.append(
+            EncodedOutput(
+                token_ids=np.arange(start, start + length),
+                tokens=np.array(["tok{}".format(j) for j in range(start, start + length)]),
+                token_ends=np.arange(start, start + length) + 1,
+                token_starts=np.arange(start, start + length),
+                useful_start=i,
+                useful_end=length - i,
+            )
+        )
+    return chunks
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_round_trip(self):
+        cache = TokenCache(self.cache_dir)
+        key = cache.key([["some text"]], FakeEncoder(), {"max_length": 10})
+        self.assertIsNone(cache.get(key))
+        chunks = make_chunks()
+        cache.put(key, chunks)
+        cached = cache.get(key)
+        self.assertEqual(len(cached), len(chunks))
+        for original, loaded in zip(chunks, cached):
+            for field in ["token_ids", "tokens", "token_ends", "token_starts"]:
+                np.testing.assert_array_equal(getattr(original, field), getattr(loaded, field))
+            self.assertEqual(original.useful_start, loaded.useful_start)
+            self.assertEqual(original.useful_end, loaded.useful_end)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_key_depends_on_settings(self):
+        key_a = TokenCache.key([["text"]], FakeEncoder(), {"max_length": 10})
+        key_b = TokenCache.key([["text"]], FakeEncoder(), {"max_length": 20})
+        key_c = TokenCache.key([["other text"]], FakeEncoder(), {"max_length": 10})
+        self.assertEqual(len({key_a, key_b, key_c}), 3)
+
+    def test_persists_between_instances(self):
+        key = TokenCache.key([["text"]], FakeEncoder(), {})
+        TokenCache(self.cache_dir).put(key, make_chunks())
+        cache = TokenCache(self.cache_dir)
+        self.assertEqual(len(cache.get(key)), 3)
+
+    def test_lru_eviction(self):
+        cache = TokenCache(self.cache_dir)
+        keys = [cache.key([[str(i)]], FakeEncoder(), {}) for i in range(3)]
+        cache.put(keys[0], make_chunks())
+        entry_size = cache.total_bytes
+        cache.max_bytes = int(entry_size * 2.5)
+        cache.put(keys[1], make_chunks())
+        # Touch the first entry so that the second is the least recently used
+        cache.get(keys[0])
+        cache.put(keys[2], make_chunks())
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[2]))
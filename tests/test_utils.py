@@ -1,3 +1,4 @@
+import gc
 import unittest
 import os.path
 import random
@@ -19,6 +20,22 @@ from finetune.optimizers.gradient_accumulation import get_grad_accumulation_opti
 from finetune.util.imbalance import compute_class_weights
 from finetune.util.optimize_loss import OPTIMIZERS
 from finetune.util.timing import ProgressBar
+from finetune.util.input_utils import (
+    bucket_settings,
+    n_bucketed_batches,
+    token_budget_batches,
+    pad_batch,
+    Chunker,
+    chunk_windows,
+    context_width_for_recompute_factor,
+)
+from finetune.util.weight_file import (
+    is_weight_file,
+    read_weight_file,
+    write_weight_file,
+    convert_joblib_to_weight_file,
+)
+from finetune.saver import Saver, FALLBACK_REGISTRY, RowSparseDelta, encode_sparse_deltas, decode_sparse_deltas
 from finetune.errors import FinetuneError
 from finetune import Classifier, SequenceLabeler
 from finetune.base_models import GPT, GPT2, BERT
@@ -304,6 +321,178 @@ class TestProgressBar(unittest.TestCase):
         pbar = ProgressBar(range(1000), update_hook=update_state)
         assert state['hook_run']
 
+class TestLengthBucketing(unittest.TestCase):
+
+    def test_bucket_settings(self):
+        boundaries, batch_sizes = bucket_settings(max_length=64, batch_size=4)
+        self.assertEqual(boundaries, [8, 16, 32])
+        self.assertEqual(batch_sizes, [4, 4, 4, 4])
+
+        boundaries, batch_sizes = bucket_settings(max_length=64, batch_size=4, max_tokens_per_batch=128)
+        self.assertEqual(batch_sizes, [18, 8, 4, 2])
+
+    def test_n_bucketed_batches(self):
+        boundaries, batch_sizes = [8, 16], [4, 2, 1]
+        lengths = [1, 2, 3, 4, 5, 8, 9, 16, 20]
+        # 5 short sequences -> 2 batches, 2 medium -> 1 batch, 2 long -> 2 batches
+        self.assertEqual(n_bucketed_batches(lengths, boundaries, batch_sizes), 5)
+
+    def test_token_budget_batches(self):
+        examples = [{"tokens": [1] * l} for l in [2, 2, 3, 3, 8, 9]]
+        batches = list(token_budget_batches(examples, max_tokens_per_batch=10))
+        self.assertEqual([len(b) for b in batches], [3, 1, 1, 1])
+        # Order is preserved
+        self.assertEqual([ex for b in batches for ex in b], examples)
+
+    def test_pad_batch(self):
+        examples = [{"tokens": [1, 2]}, {"tokens": [3, 4, 5]}]
+        batch = pad_batch(examples, {"tokens": tf.int32})
+        np.testing.assert_array_equal(batch["tokens"], [[1, 2, 0], [3, 4, 5]])
+        np.testing.assert_array_equal(batch["length"], [2, 3])
+
+
+class TestChunking(unittest.TestCase):
+
+    def test_chunk_bounds(self):
+        chunker = Chunker(max_length=10, total_context_width=4, justify="center")
+        starts, ends, useful_starts, useful_ends = chunker.chunk_bounds(20)
+        np.testing.assert_array_equal(starts, [0, 4, 8, 12])
+        np.testing.assert_array_equal(ends, [8, 12, 16, 20])
+        np.testing.assert_array_equal(useful_starts, [0, 2, 2, 2])
+        np.testing.assert_array_equal(useful_ends, [6, 6, 6, 10])
+        self.assertEqual(len(chunker.chunk_bounds(0)[0]), 0)
+
+    def test_chunk_windows(self):
+        value = np.array([100, 1, 2, 3, 4, 5, 6, 101])
+        starts, ends = np.array([0, 3, 6]), np.array([4, 7, 10])
+        chunks, prefixed = chunk_windows(value, starts, ends, add_eos_bos=True)
+        self.assertEqual([list(c) for c in chunks], [[100, 1, 2, 3, 101], [100, 3, 4, 5, 6, 101], [100, 6, 101]])
+        np.testing.assert_array_equal(prefixed, [False, True, True])
+        # All chunks share one buffer
+        self.assertTrue(all(np.shares_memory(c, chunks[0].base) for c in chunks))
+
+        chunks, prefixed = chunk_windows(value, starts, ends)
+        self.assertEqual([list(c) for c in chunks], [[100, 1, 2, 3], [3, 4, 5, 6], [6, 101]])
+        self.assertFalse(prefixed.any())
+
+    def test_chunk_windows_empty(self):
+        starts, ends = Chunker(max_length=10, total_context_width=4, justify="center").chunk_bounds(0)[:2]
+        for add_eos_bos in [True, False]:
+            chunks, prefixed = chunk_windows(np.array([], dtype=np.int32), starts, ends, add_eos_bos=add_eos_bos)
+            self.assertEqual(chunks, [])
+            self.assertEqual(len(prefixed), 0)
+
+    def test_recompute_factor(self):
+        width = context_width_for_recompute_factor(512, 1.5)
+        self.assertLessEqual(Chunker(512, width).recompute_factor, 1.5)
+        self.assertGreater(Chunker(512, width + 1).recompute_factor, 1.5)
+        self.assertEqual(context_width_for_recompute_factor(512, 1.0), 0)
+
+        model = Classifier(base_model=GPT, max_length=64, predict_recompute_factor=1.5)
+        pipeline = model.input_pipeline
+        self.assertLessEqual(pipeline.chunker.recompute_factor, 1.5)
+        with pipeline.training_chunks():
+            self.assertEqual(pipeline.chunker.total_context_width, 2 * 64 // 3)
+        self.assertLessEqual(pipeline.chunker.recompute_factor, 1.5)
+
+
+class TestWeightFile(unittest.TestCase):
+
+    def setUp(self):
+        self.variables = {
+            "model/featurizer/we:0": np.random.rand(7, 5).astype(np.float32),
+            "model/target/bias:0": np.arange(3, dtype=np.float16),
+            "global_step:0": np.array(12, dtype=np.int64),
+        }
+
+    def test_round_trip(self):
+        path = "tests/saved-models/weights.ftw"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_weight_file(path, self.variables, {"config": "value"})
+        self.assertTrue(is_weight_file(path))
+        variables, obj = read_weight_file(path)
+        self.assertEqual(obj, {"config": "value"})
+        self.assertEqual(set(variables), set(self.variables))
+        for name, value in self.variables.items():
+            self.assertEqual(variables[name].dtype, value.dtype)
+            np.testing.assert_array_equal(variables[name], value)
+            self.assertFalse(variables[name].flags.writeable)
+
+    def test_convert_joblib(self):
+        src = "tests/saved-models/weights.jl"
+        dst = "tests/saved-models/weights-converted.ftw"
+        os.makedirs(os.path.dirname(src), exist_ok=True)
+        jl.dump(self.variables, src)
+        self.assertFalse(is_weight_file(src))
+        convert_joblib_to_weight_file(src, dst)
+        variables, obj = read_weight_file(dst)
+        self.assertIsNone(obj)
+        for name, value in self.variables.items():
+            np.testing.assert_array_equal(variables[name], value)
+
+
+class TestFallbackRegistry(unittest.TestCase):
+
+    def test_shared_fallback(self):
+        path = "tests/saved-models/fallback.jl"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        jl.dump({"model/featurizer/we:0": np.ones((4, 2), dtype=np.float32)}, path)
+        saver_a = Saver(fallback_filename=path)
+        saver_b = Saver(fallback_filename=path)
+        self.assertIs(saver_a.fallback, saver_b.fallback)
+        self.assertFalse(saver_a.fallback["model/featurizer/we:0"].flags.writeable)
+
+        n_resident = len(FALLBACK_REGISTRY)
+        saver_a.release()
+        saver_b.release()
+        gc.collect()
+        self.assertEqual(len(FALLBACK_REGISTRY), n_resident - 1)
+        # Released savers transparently reload their fallback when it is needed again.
+        self.assertEqual(saver_a.fallback["model/featurizer/we:0"].shape, (4, 2))
+
+
+class TestRemoveUnchanged(unittest.TestCase):
+
+    def setUp(self):
+        self.fallback = {
+            "we:0": np.random.rand(100, 8).astype(np.float32),
+            "bias:0": np.zeros(8, dtype=np.float32),
+            "kernel:0": np.random.rand(8, 8).astype(np.float32),
+        }
+        we = self.fallback["we:0"].copy()
+        we[[3, 50]] += 1.0
+        self.variables = {
+            "we:0": we,
+            "bias:0": self.fallback["bias:0"].copy(),
+            "kernel:0": self.fallback["kernel:0"] + 1.0,
+            "target/w:0": np.ones(3, dtype=np.float32),
+        }
+
+    def test_remove_unchanged(self):
+        names, values = Saver().remove_unchanged(
+            self.variables.keys(), self.variables.values(), self.fallback
+        )
+        self.assertEqual(names, ["we:0", "kernel:0", "target/w:0"])
+        self.assertIs(values[0], self.variables["we:0"])
+
+    def test_sparse_deltas(self):
+        saver = Saver(save_sparse_deltas=True)
+        saver.fallback_ = self.fallback
+        names, values = saver.remove_unchanged(
+            self.variables.keys(), self.variables.values(), self.fallback
+        )
+        reduced = dict(zip(names, values))
+        self.assertIsInstance(reduced["we:0"], RowSparseDelta)
+        np.testing.assert_array_equal(reduced["we:0"].indices, [3, 50])
+        # Fully changed tensors are stored densely.
+        self.assertIsInstance(reduced["kernel:0"], np.ndarray)
+
+        decoded = decode_sparse_deltas(encode_sparse_deltas(reduced))
+        np.testing.assert_array_equal(
+            saver.materialize("we:0", decoded["we:0"]), self.variables["we:0"]
+        )
+
+
 class TestOptimizers(unittest.TestCase):
 
     @tf.function